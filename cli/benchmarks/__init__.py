@@ -0,0 +1 @@
+# the benchmark scripts (run as `python benchmarks/<script>.py`), importable by the tests
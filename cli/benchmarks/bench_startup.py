@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Measures drone-deploy cold start time and the number of imported modules for a few cheap
+commands (version, list, --help, shell completion).
+
+Runs from source by default and compares the lazy command loading in cli.py against eagerly
+importing every sub command module (which is what cli.py used to do). If a frozen PyInstaller
+binary is present (cli/dist/drone-deploy) it is measured too, optionally against an older
+release binary given with --baseline-binary. Modules are counted by
+hooks/rthook_count_modules.py, a PyInstaller runtime hook in the binary that's also run before
+the cli from source (binaries built without it report no count).
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 20] [--binary dist/drone-deploy]
+                                       [--baseline-binary ~/Downloads/drone-deploy] [--json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+CLI_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(CLI_DIR))
+from cli import SUB_COMMANDS    # noqa
+
+SCENARIOS = {
+    'version': (['version'], {}),
+    'list': (['list'], {}),
+    'help': (['--help'], {}),
+    'complete': ([], {'_DRONE_DEPLOY_COMPLETE': 'complete',
+                      'COMP_WORDS': 'drone-deploy ', 'COMP_CWORD': '1'}),
+}
+
+# prints the number of imported modules on exit when DRONE_DEPLOY_COUNT_MODULES is set (the
+# frozen binary runs it as a runtime hook, source runs before importing the cli)
+COUNT_MODULES = CLI_DIR.joinpath('hooks', 'rthook_count_modules.py').read_text()
+
+
+def source_cmd(eager=False):
+    '''returns a command that runs the cli from source (optionally importing everything)'''
+    imports = ''
+    if eager:
+        modules = sorted({module for module, _, _ in SUB_COMMANDS.values()})
+        imports = ''.join(f'import {m}\n' for m in modules)
+    code = f"{COUNT_MODULES}\nimport sys\nsys.argv[0] = 'drone-deploy'\n{imports}" \
+        "from cli import cli\ncli()\n"
+    return [sys.executable, '-c', code]
+
+
+def measure(cmd, args, extra_env, runs, cwd=CLI_DIR):
+    '''runs cmd + args `runs` times and returns timings (ms) and the imported module count'''
+    env = dict(os.environ, DRONE_DEPLOY_COUNT_MODULES='1', **extra_env)
+    timings = []
+    modules = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        p = subprocess.run(cmd + args, cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, text=True)
+        timings.append((time.perf_counter() - start) * 1000)
+        for line in p.stderr.splitlines():
+            if line.startswith('modules: '):
+                modules = int(line.split()[1])
+    return {
+        'min_ms': round(min(timings), 1),
+        'median_ms': round(statistics.median(timings), 1),
+        'modules': modules,
+    }
+
+
+def targets(args):
+    '''returns (label, command) pairs to benchmark'''
+    found = [('source (eager)', source_cmd(eager=True)), ('source (lazy)', source_cmd())]
+    if args.baseline_binary and Path(args.baseline_binary).exists():
+        found.append(('frozen (baseline)', [str(Path(args.baseline_binary).resolve())]))
+    if Path(args.binary).exists():
+        found.append(('frozen', [str(Path(args.binary).resolve())]))
+    else:
+        print(f"skipping frozen binary, {args.binary} not found (run 'make release')",
+              file=sys.stderr)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--binary', default=str(CLI_DIR.joinpath('dist', 'drone-deploy')))
+    parser.add_argument('--baseline-binary')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    results = {}
+    for label, cmd in targets(args):
+        results[label] = {name: measure(cmd, argv, env, args.runs)
+                          for name, (argv, env) in SCENARIOS.items()}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'target':<18} {'command':<10} {'min ms':>8} {'median ms':>10} {'modules':>8}")
+    for label, scenarios in results.items():
+        for name, r in scenarios.items():
+            print(f"{label:<18} {name:<10} {r['min_ms']:>8} {r['median_ms']:>10} "
+                  f"{r['modules'] if r['modules'] is not None else '-':>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+"""
+Benchmarks drone-deploy's hot paths and compares them against a saved JSON baseline.
+
+Groups (run them all, or pick some with --only):
+    startup     cold start of a few cheap commands (see bench_startup.py)
+    deployment  Deployment() with small and large tfstate/manifest files, cold and cached
+    vars        resolving the config and rendering the terraform/packer var files
+    pump        streaming a stub terraform/packer's output to sinks at high line rates
+    init        packing and extracting the templates archive
+    list        'list --long' summaries of a fleet of deployments
+
+Everything runs in a scratch dir with stub terraform and packer executables (see
+stubs.py), so no AWS account, network, or real tools are needed. Results are timings in ms
+(min and median of --runs runs), keyed by benchmark name.
+
+Usage:
+    python benchmarks/bench_suite.py [--runs 5] [--only pump,list] [--json]
+    python benchmarks/bench_suite.py --save                 # => baselines/<version>.json
+    python benchmarks/bench_suite.py --compare benchmarks/baselines/0.1.21.json [--threshold 0.25]
+
+--compare exits with 1 if any benchmark's best (min) time is more than --threshold slower
+than the baseline's (and by more than NOISE_MS). The min is compared, not the median, as
+it's the least affected by whatever else the machine is doing.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import statistics
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+CLI_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(CLI_DIR))
+from version import __version__    # noqa
+from bench_startup import SCENARIOS, measure, source_cmd    # noqa
+from stubs import write_stubs    # noqa
+
+BASELINE_DIR = BENCH_DIR.joinpath('baselines')
+
+# differences smaller than this are never reported as regressions
+NOISE_MS = 1.0
+
+# (resources in the tfstate, builds in the packer manifest)
+STATE_SIZES = {'small': (10, 1), 'large': (20000, 200)}
+
+# deployments in the fleet listed by the 'list' group
+FLEET_SIZE = 200
+
+
+def timed(func, runs, setup=None):
+    '''
+    runs func `runs` times (after setup(), which isn't timed), returns min/median ms. An
+    untimed first run warms up imports and the page cache.
+    '''
+    timings = []
+    for run in range(runs + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        if run:
+            timings.append((time.perf_counter() - start) * 1000)
+    return {'min_ms': round(min(timings), 2), 'median_ms': round(statistics.median(timings), 2)}
+
+
+def tfstate(resources, serial=1):
+    '''a terraform 0.12 state with an instance (so it has an AMI) and `resources` more'''
+    instance = {"mode": "managed", "type": "aws_instance", "name": "drone-server",
+                "instances": [{"attributes": {"ami": "ami-0123456789abcdef0",
+                                              "instance_type": "t2.micro"}}]}
+    params = [{"mode": "managed", "type": "aws_ssm_parameter", "name": f"param{i}",
+               "instances": [{"attributes": {"name": f"/drone/param{i}", "value": "x" * 64}}]}
+              for i in range(resources)]
+    return {"version": 4, "terraform_version": "0.12.29", "serial": serial,
+            "lineage": "68212074-5905-8b20-e769-6cc400e53eb1",
+            "outputs": {"DRONE_BUILDER_ROLE_ARN": {"value": "arn:aws:iam::1234567890:role/b",
+                                                   "type": "string"}},
+            "resources": [instance] + params}
+
+
+def manifest(builds):
+    '''a packer manifest with `builds` builds (the last one is current)'''
+    return {"builds": [{"name": "amazon-ebs", "builder_type": "amazon-ebs",
+                        "build_time": 1600000000 + i, "files": None,
+                        "artifact_id": f"us-east-1:ami-{i:017x},us-west-2:ami-{i + 1:017x}",
+                        "packer_run_uuid": f"run-{i}",
+                        "custom_data": {"drone_deployment_id": "bench-id",
+                                        "build_fingerprint": f"{i:064x}"}}
+                       for i in range(builds)],
+            "last_run_uuid": f"run-{builds - 1}"}
+
+
+class Workspace():
+    """
+    A scratch deployments root (templates/ and deployments/) with stub terraform and
+    packer executables first on the PATH. The benchmarks run with it as the cwd, like the
+    cli does.
+    """
+
+    def __init__(self, root):
+        from drone_deploy.materialize import Materializer
+        from drone_deploy.new_deployment_cli import deployment_templates
+
+        self.root = Path(root)
+        self.templates_dir = self.root.joinpath('templates')
+        shutil.copytree(CLI_DIR.parent.joinpath('templates'), self.templates_dir)
+        self.deployments_dir = self.root.joinpath('deployments')
+        self.deployments_dir.mkdir()
+        self.bin_dir = write_stubs(self.root.joinpath('bin'))
+        self.env = dict(os.environ, PATH=f"{self.bin_dir}{os.pathsep}{os.environ['PATH']}")
+        self.templates = deployment_templates(self.templates_dir)
+        self.materializer = Materializer()
+        os.chdir(self.root)
+
+    def deployment(self, name, resources=0, builds=0):
+        '''creates a deployment with a tfstate and packer manifest, returns its config.yaml'''
+        from drone_deploy.new_deployment_cli import create_deployment
+
+        deployment_dir = create_deployment(name, self.templates, self.materializer)
+        if resources:
+            deployment_dir.joinpath('terraform', 'terraform.tfstate').write_text(
+                json.dumps(tfstate(resources), indent=2))
+        if builds:
+            deployment_dir.joinpath('packer', 'manifest.json').write_text(
+                json.dumps(manifest(builds), indent=2))
+        return deployment_dir.joinpath('config.yaml')
+
+    def clear_caches(self):
+        for cache_dir in self.deployments_dir.glob('*/.cache'):
+            shutil.rmtree(cache_dir)
+
+
+def bench_startup(workspace, runs):
+    results = {}
+    env = {'PYTHONPATH': str(CLI_DIR)}
+    for name, (args, extra_env) in SCENARIOS.items():
+        results[f"startup.{name}"] = measure(source_cmd(), args, dict(extra_env, **env), runs)
+    return results
+
+
+def bench_deployment(workspace, runs):
+    from drone_deploy.deployment import Deployment
+
+    results = {}
+    for size, (resources, builds) in STATE_SIZES.items():
+        config_file = workspace.deployment(f"deployment-{size}", resources, builds)
+        cache_dir = config_file.parent.joinpath('.cache')
+        results[f"deployment.init.{size}"] = timed(
+            lambda: Deployment(config_file), runs,
+            setup=lambda: shutil.rmtree(cache_dir, ignore_errors=True))
+        Deployment(config_file, use_cache=True)
+        results[f"deployment.init.{size}.cached"] = timed(
+            lambda: Deployment(config_file, use_cache=True), runs)
+    return results
+
+
+def bench_vars(workspace, runs):
+    from drone_deploy.deployment import Deployment
+    from drone_deploy.resolved_config import resolve_config
+
+    config_file = workspace.deployment('vars', *STATE_SIZES['small'])
+    deployment = Deployment(config_file)
+    terraform, packer = deployment.terraform, deployment.packer
+    var_files = [Path(terraform.working_dir).joinpath(terraform.VAR_FILE),
+                 Path(packer.working_dir).joinpath(packer.VAR_FILE)]
+
+    def remove_var_files():
+        for var_file in var_files:
+            if var_file.exists():
+                var_file.unlink()
+
+    def render():
+        terraform.write_var_file()
+        packer.write_var_file()
+
+    return {
+        'vars.resolve': timed(lambda: resolve_config(
+            deployment.config, config_file.parent.name,
+            builder_role_arn=terraform.drone_builder_role_arn,
+            deployment_id=packer.drone_deployment_id,
+            server_ami=packer.drone_server_ami), runs),
+        'vars.render': timed(render, runs, setup=remove_var_files),
+        'vars.render.unchanged': timed(render, runs),
+    }
+
+
+def bench_pump(workspace, runs):
+    from drone_deploy.process import LineSink, run_process, arun_process
+    from drone_deploy.packer_progress import BuildProgress
+
+    lines = 200000
+    env = dict(workspace.env, STUB_LINES=str(lines), STUB_STDERR_EVERY='10')
+    count = [0]
+
+    def on_line(name, line):
+        count[0] += 1
+
+    def sync():
+        run_process(['terraform', 'apply'], env=env, shell=False, sinks=[LineSink(on_line)])
+
+    def run_async():
+        asyncio.run(arun_process(['terraform', 'apply'], env=env, sinks=[], on_line=on_line))
+
+    def packer():
+        progress = BuildProgress('packer_build_drone_server_ami.json', stream=io.StringIO())
+        run_process(['packer', 'build', '-machine-readable', 'template.json'], env=env,
+                    shell=False, sinks=[LineSink(progress.feed)])
+        progress.close()
+
+    results = {}
+    for name, func in (('terraform.sync', sync), ('terraform.async', run_async),
+                       ('packer.progress', packer)):
+        count[0] = 0
+        result = timed(func, runs)
+        assert count[0] in (0, lines * (runs + 1)), f"{name} lost lines ({count[0]})"
+        result['lines_per_sec'] = round(lines / result['median_ms'] * 1000)
+        results[f"pump.{name}"] = result
+
+    # a paced stub: anything over the time the output takes to arrive is pumping lag
+    rate, paced_lines = 50000, 25000
+    paced_env = dict(env, STUB_LINES=str(paced_lines), STUB_RATE=str(rate))
+    result = timed(lambda: run_process(['terraform', 'apply'], env=paced_env, shell=False,
+                                       sinks=[LineSink(on_line)]), runs)
+    result['lag_ms'] = round(result['median_ms'] - paced_lines / rate * 1000, 2)
+    results['pump.terraform.paced'] = result
+    return results
+
+
+def bench_init(workspace, runs):
+    from drone_deploy.template_cache import pack_templates, extract_templates
+
+    archive = workspace.root.joinpath('templates.zip')
+    dest = workspace.root.joinpath('extracted')
+    return {
+        'init.pack': timed(lambda: pack_templates(workspace.templates_dir, archive, __version__),
+                           runs),
+        'init.extract': timed(lambda: extract_templates(archive, dest), runs,
+                              setup=lambda: shutil.rmtree(dest, ignore_errors=True)),
+    }
+
+
+def bench_list(workspace, runs):
+    from drone_deploy.filter import deployment_names
+    from drone_deploy.deployment_summary import summarize_all
+
+    for index in range(FLEET_SIZE):
+        deployment_dir = workspace.deployments_dir.joinpath(f"fleet-{index:04}")
+        deployment_dir.joinpath('terraform').mkdir(parents=True)
+        deployment_dir.joinpath('config.yaml').write_text('drone_aws_region: us-east-1\n')
+        deployment_dir.joinpath('terraform', 'terraform.tfstate').write_text(
+            json.dumps(tfstate(50 if index % 2 else 0, serial=index)))
+    names = deployment_names(workspace.root)
+
+    return {
+        'list.summaries.cold': timed(lambda: summarize_all(workspace.deployments_dir, names),
+                                     runs, setup=workspace.clear_caches),
+        'list.summaries.cached': timed(lambda: summarize_all(workspace.deployments_dir, names),
+                                       runs),
+        'list.long': measure(source_cmd(), ['list', '--long'], {'PYTHONPATH': str(CLI_DIR)},
+                             runs, cwd=workspace.root),
+    }
+
+
+GROUPS = {
+    'startup': bench_startup,
+    'deployment': bench_deployment,
+    'vars': bench_vars,
+    'pump': bench_pump,
+    'init': bench_init,
+    'list': bench_list,
+}
+
+
+def run(groups, runs):
+    cwd = os.getcwd()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='drone-deploy-bench-') as root:
+        try:
+            workspace = Workspace(root)
+            for group in groups:
+                print(f"running {group}...", file=sys.stderr)
+                results.update(GROUPS[group](workspace, runs))
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def report(results, runs):
+    return {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'runs': runs,
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''prints each benchmark against the baseline, returns the names that regressed'''
+    regressions = []
+    print(f"{'benchmark':<30} {'baseline min':>12} {'min ms':>10} {'change':>8}")
+    for name, result in results.items():
+        old = baseline['results'].get(name, {}).get('min_ms')
+        new = result['min_ms']
+        if not old:
+            print(f"{name:<30} {'-':>12} {new:>10} {'new':>8}")
+            continue
+        change = new / old - 1
+        regressed = change > threshold and new - old > NOISE_MS
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<30} {old:>12} {new:>10} {change:>+8.0%}"
+              f"{'  REGRESSED' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--only', help=f"comma separated groups ({', '.join(GROUPS)})")
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    parser.add_argument('--save', nargs='?', metavar='FILE',
+                        const=str(BASELINE_DIR.joinpath(f"{__version__}.json")),
+                        help='save the results as a baseline (default: baselines/<version>.json)')
+    parser.add_argument('--compare', metavar='FILE', help='a baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown (vs. the baseline min) that fails --compare')
+    args = parser.parse_args()
+
+    groups = args.only.split(',') if args.only else list(GROUPS)
+    unknown = [group for group in groups if group not in GROUPS]
+    if unknown:
+        parser.error(f"unknown group(s): {', '.join(unknown)}")
+
+    results = report(run(groups, args.runs), args.runs)
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.save).write_text(json.dumps(results, indent=2) + '\n')
+        print(f"saved {args.save}", file=sys.stderr)
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        print(f"baseline: {baseline['version']} (python {baseline['python']}, "
+              f"{baseline['created']})")
+        regressions = compare(results['results'], baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+        return
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'benchmark':<30} {'min ms':>10} {'median ms':>10}  extra")
+    for name, result in results['results'].items():
+        extra = ', '.join(f"{key}={value}" for key, value in result.items()
+                          if key not in ('min_ms', 'median_ms') and value is not None)
+        print(f"{name:<30} {result['min_ms']:>10} {result['median_ms']:>10}  {extra}")
+
+
+if __name__ == '__main__':
+    main()
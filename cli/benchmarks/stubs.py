@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Stand-in terraform and packer executables for the benchmarks. They print synthetic output
+(terraform's plan/apply progress, or packer's -machine-readable ui lines) at a configurable
+rate, so output pumping can be measured without AWS or the real tools.
+
+Usage:
+    python benchmarks/stubs.py terraform|packer [args...]
+    write_stubs(bin_dir)    # writes bin_dir/terraform and bin_dir/packer wrappers
+    write_executable(bin_dir, name, script)    # any other stub (the tests use this too)
+
+Environment:
+    STUB_LINES          lines to print (default 1000)
+    STUB_RATE           lines per second, 0 for as fast as possible (default 0)
+    STUB_STDERR_EVERY   print every Nth line to stderr instead, 0 for never (default 0)
+    STUB_EXIT           exit code (default 0)
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+# lines written per flush when the rate is limited (keeps the pacing smooth)
+BATCH_INTERVAL = 0.01
+
+
+def terraform_lines(args):
+    resource = 0
+    while True:
+        resource += 1
+        yield (f"aws_ssm_parameter.param{resource}: Still creating... "
+               f"[{resource % 60}s elapsed] (id=/drone/deployment/param{resource})")
+
+
+def packer_lines(args):
+    # the messages BuildProgress turns into phases, padded out with provisioner output
+    phases = ["Prevalidating any provided VPC information",
+              "Launching a source AWS instance...",
+              "Waiting for SSH to become available...",
+              "Provisioning with shell script: base-scripts/bootstrap_docker.sh",
+              "Stopping the source instance...",
+              "Creating AMI drone-server from instance i-0123456789abcdef0",
+              "Terminating the source AWS instance..."]
+    machine_readable = '-machine-readable' in args
+    line = 0
+    while True:
+        line += 1
+        if line % 1000 == 1:
+            message = f"==> amazon-ebs: {phases[(line // 1000) % len(phases)]}"
+        else:
+            message = f"    amazon-ebs: [docker] step {line}: pulling layer {line:08x}"
+        if machine_readable:
+            message = message.replace(',', '%!(PACKER_COMMA)')
+            yield f"{1600000000 + line // 100},,ui,say,{message}"
+        else:
+            yield message
+
+
+def run(tool, args, environ=os.environ):
+    lines = int(environ.get('STUB_LINES', 1000))
+    rate = float(environ.get('STUB_RATE', 0))
+    stderr_every = int(environ.get('STUB_STDERR_EVERY', 0))
+    if tool == 'terraform' and args[:1] == ['version']:
+        print("Terraform v0.12.29")
+        return 0
+
+    source = packer_lines(args) if tool == 'packer' else terraform_lines(args)
+    start = time.monotonic()
+    out, err = sys.stdout, sys.stderr
+    for number in range(1, lines + 1):
+        line = next(source)
+        (err if stderr_every and number % stderr_every == 0 else out).write(line + '\n')
+        if rate and number % max(1, int(rate * BATCH_INTERVAL)) == 0:
+            out.flush()
+            err.flush()
+            delay = start + number / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    out.flush()
+    err.flush()
+    return int(environ.get('STUB_EXIT', 0))
+
+
+def write_executable(bin_dir, name, script):
+    '''writes script (e.g. starting with #!/bin/sh) to bin_dir/name, returns its Path'''
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    executable = bin_dir.joinpath(name)
+    executable.write_text(script)
+    executable.chmod(0o755)
+    return executable
+
+
+def write_stubs(bin_dir):
+    '''writes terraform and packer executables into bin_dir that run this stub'''
+    for tool in ('terraform', 'packer'):
+        write_executable(bin_dir, tool, f"#!/bin/sh\nexec {sys.executable} "
+                                        f"{Path(__file__).resolve()} {tool} \"$@\"\n")
+    return Path(bin_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(run(sys.argv[1], sys.argv[2:]))
@@ -2,21 +2,78 @@ import os
 import click
 from version import __version__
 from pathlib import Path
-from dotenv import load_dotenv
-from drone_deploy import new_deployment, prepare_deployment,\
-                         list_deployments, show, plan, deploy,\
-                         edit_deployment, build_ami, destroy,\
-                         show_agent_command, init_dir
+from drone_deploy.lazy_group import LazyGroup
+from drone_deploy.filter import deployment_argument
+
+
+# 'drone-deploy' sub commands. Each entry maps a command name to the module and attribute
+# that implement it, plus the short help shown in `drone-deploy --help` (a copy of the
+# command's short_help, see test_cli_sub_commands_short_help). Modules are only imported
+# when their command is run (see drone_deploy/lazy_group.py).
+SUB_COMMANDS = {
+    'ami': ('drone_deploy.ami_cli', 'ami',
+            "Lists and cleans up the AMIs built for a deployment."),
+    'build-ami': ('drone_deploy.build_ami_cli', 'build_ami',
+                  "Builds the drone server AMI (Amazon Machine Image)."),
+    'deploy': ('drone_deploy.deploy_cli', 'deploy',
+               "Deploys (runs 'terraform apply') on a deployment."),
+    'destroy': ('drone_deploy.destroy_cli', 'destroy',
+                "!!! Destroys (runs 'terraform destroy') on a deployment."),
+    'edit': ('drone_deploy.edit_deployment_cli', 'edit_deployment',
+             "Edits a deployment's config file with $EDITOR."),
+    'init': ('drone_deploy.init_cli', 'init_dir',
+             "Initializes a 'deployments' working directory."),
+    'list': ('drone_deploy.list_cli', 'list_deployments',
+             "Lists deployments."),
+    'new': ('drone_deploy.new_deployment_cli', 'new_deployment',
+            "Creates a new deployment in the deployments directory."),
+    'plan': ('drone_deploy.plan_cli', 'plan',
+             "Runs 'terraform plan' on a deployment."),
+    'prepare': ('drone_deploy.prepare_deployment_cli', 'prepare_deployment',
+                "Runs 'terraform init' and creates the builder IAM roles."),
+    'provider-cache': ('drone_deploy.provider_cache_cli', 'provider_cache',
+                       "Shows (or prunes) the shared terraform provider cache."),
+    'show': ('drone_deploy.show_cli', 'show',
+             "Shows a deployment's configuration."),
+    'show-agent-command': ('drone_deploy.show_agent_command_cli', 'show_agent_command',
+                           "Shows the docker command used to launch agents."),
+}
+
+
+def completion_placeholders():
+    '''
+    Stand-ins for the sub commands that take a deployment name, used during shell completion
+    so deployment names complete without importing the command's module.
+    '''
+    def placeholder(name, cls=click.Command, **kwargs):
+        return cls(name, short_help=SUB_COMMANDS[name][2], **kwargs)
+
+    placeholders = {name: placeholder(name, params=[deployment_argument()]) for name in (
+        'build-ami', 'deploy', 'destroy', 'edit', 'plan', 'prepare', 'show',
+        'show-agent-command')}
+    placeholders['ami'] = placeholder('ami', cls=click.Group, commands={
+        name: click.Command(name, params=[deployment_argument()]) for name in ('list', 'gc')})
+    return placeholders
 
 
 # $> drone-deploy
-@click.group()
+@click.group(cls=LazyGroup, lazy_commands=SUB_COMMANDS, placeholders=completion_placeholders())
+@click.option('--profile', is_flag=True, envvar='DRONE_DEPLOY_PROFILE',
+              help='Print where the time went (nested timing spans) when the command exits.')
+@click.option('--profile-output', metavar='FILE', envvar='DRONE_DEPLOY_PROFILE_OUTPUT',
+              type=click.Path(dir_okay=False),
+              help='Also write a Chrome trace (FILE.json) or a cProfile dump (any other FILE).')
 @click.pass_context
-def cli(ctx):
+def cli(ctx, profile, profile_output):
     """
     Deploys and manages Drone CI/CD deployments on AWS.
     """
-    pass
+    if profile or profile_output:
+        # imported here, profiling is off unless asked for
+        from drone_deploy import profiler
+        profiler.enable(f"drone-deploy {ctx.invoked_subcommand or ''}".strip(),
+                        output=profile_output)
+        ctx.call_on_close(profiler.finish)
 
 
 @cli.command()
@@ -31,6 +88,10 @@ def setup():
     # load env vars from .env file. They will be available, along with any other
     # env vars, by using os.getenv("ENV_VAR_NAME") in the project
 
+    # shell completion only needs command and deployment names, skip loading .env
+    if os.getenv('_DRONE_DEPLOY_COMPLETE'):
+        return
+
     # are we running from release or src? cli.py vs cli.pyc
     if Path(__file__).name == 'cli.py':
         # try to load .env from parent dir if running from src
@@ -38,15 +99,9 @@ def setup():
     else:
         # look for .env in the cwd
         env_path = Path(os.getcwd()).joinpath('.env')
-    load_dotenv(dotenv_path=env_path)
 
-    # hookup 'drone-deploy' sub commands
-    sub_commands = [new_deployment, edit_deployment, prepare_deployment,
-                    build_ami, list_deployments, show, plan, destroy,
-                    show_agent_command, deploy, init_dir]
-
-    for command in sub_commands:
-        cli.add_command(command)
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=env_path)
 
 
 setup()
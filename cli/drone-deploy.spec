@@ -17,6 +17,10 @@ def Entrypoint(dist, group, name, **kwargs):
     for distribution in kwargs['hiddenimports']:
         packages += get_toplevel(distribution)
 
+    # sub commands are imported by name at runtime (see drone_deploy/lazy_group.py), so
+    # PyInstaller can't find them on its own
+    kwargs['hiddenimports'] = kwargs['hiddenimports'] + kwargs.pop('lazy_imports', [])
+
     kwargs.setdefault('pathex', [])
     # get the entry point
     ep = pkg_resources.get_entry_info(dist, group, name)
@@ -35,7 +39,22 @@ def Entrypoint(dist, group, name, **kwargs):
         [script_path] + kwargs.get('scripts', []),
         **kwargs
     )
-a = Entrypoint('drone-deploy', 'console_scripts', 'drone-deploy', hiddenimports=['configparser'])
+import sys
+from PyInstaller.utils.hooks import collect_submodules
+sys.path.insert(0, SPECPATH)
+from version import __version__
+from drone_deploy.template_cache import pack_templates, EMBEDDED_TEMPLATES
+
+# pack the templates into the exe so `init` and `new` don't download them (they're read
+# with importlib.resources, see drone_deploy/template_cache.py)
+templates_zip = pack_templates(os.path.join(SPECPATH, '..', 'templates'),
+                               os.path.join(workpath, EMBEDDED_TEMPLATES), __version__)
+a = Entrypoint('drone-deploy', 'console_scripts', 'drone-deploy', hiddenimports=['configparser'],
+               lazy_imports=collect_submodules('drone_deploy'),
+               datas=[(templates_zip, 'drone_deploy')],
+               # reports the imported modules when DRONE_DEPLOY_COUNT_MODULES is set (used by
+               # benchmarks/bench_startup.py)
+               runtime_hooks=[os.path.join(SPECPATH, 'hooks', 'rthook_count_modules.py')])
 pyz = PYZ(a.pure, a.zipped_data,
              cipher=block_cipher)
 exe = EXE(pyz,
@@ -1,12 +1,38 @@
-from .deployment import Deployment                      # noqa
-from .new_deployment_cli import new_deployment          # noqa
-from .edit_deployment_cli import edit_deployment        # noqa
-from .prepare_deployment_cli import prepare_deployment  # noqa
-from .build_ami_cli import build_ami                    # noqa
-from .list_cli import list_deployments                  # noqa
-from .deploy_cli import deploy                          # noqa
-from .show_cli import show                              # noqa
-from .plan_cli import plan                              # noqa
-from .destroy_cli import destroy                        # noqa
-from .show_agent_command_cli import show_agent_command  # noqa
-from .init_cli import init_dir                          # noqa
+from importlib import import_module
+
+# Public names and the submodule that provides them. They are imported on first access
+# (PEP 562) so that importing the package, e.g. for `drone-deploy version`, stays cheap.
+_exports = {
+    'Deployment': 'deployment',
+    'new_deployment': 'new_deployment_cli',
+    'edit_deployment': 'edit_deployment_cli',
+    'prepare_deployment': 'prepare_deployment_cli',
+    'build_ami': 'build_ami_cli',
+    'ami': 'ami_cli',
+    'list_deployments': 'list_cli',
+    'deploy': 'deploy_cli',
+    'show': 'show_cli',
+    'plan': 'plan_cli',
+    'destroy': 'destroy_cli',
+    'show_agent_command': 'show_agent_command_cli',
+    'init_dir': 'init_cli',
+    'provider_cache': 'provider_cache_cli',
+}
+
+
+def __getattr__(name):
+    if name in _exports:
+        module = import_module(f'.{_exports[name]}', __name__)
+        return getattr(module, name)
+
+    # allow `drone_deploy.<submodule>` access without an explicit import
+    try:
+        return import_module(f'.{name}', __name__)
+    except ModuleNotFoundError as e:
+        if e.name != f'{__name__}.{name}':
+            raise
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'") from None
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
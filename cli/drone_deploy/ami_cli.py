@@ -0,0 +1,104 @@
+import click
+import time
+from pathlib import Path
+from drone_deploy.deployment import Deployment
+from drone_deploy.filter import filter_deployments
+from drone_deploy.packer import BuildError
+
+
+def load_deployment(deployment_name):
+    '''returns the deployment, or None (after saying so) if it doesn't exist'''
+    config_file = Path.cwd().joinpath('deployments', deployment_name, 'config.yaml').resolve()
+    if not config_file.exists():
+        click.echo("Couldn't find the deployment. "
+                   "Run 'drone-deploy list' to see available deployemnts.")
+        return None
+    return Deployment(config_file)
+
+
+def echo_builds(builds):
+    click.echo(f"{'AMI':<21}  {'REGION':<14}  {'KIND':<6}  {'BUILT':<16}  "
+               f"{'FINGERPRINT':<12}  STATUS")
+    for build in builds:
+        built = time.strftime('%Y-%m-%d %H:%M', time.localtime(build.build_time)) \
+            if build.build_time else '-'
+        status = ', '.join(name for name, flag in (('current', build.current),
+                                                   ('in use', build.in_use)) if flag)
+        click.echo(f"{build.ami:<21}  {build.region:<14}  {build.kind:<6}  {built:<16}  "
+                   f"{build.fingerprint[:12] or '-':<12}  {status or '-'}")
+
+
+# $> drone-deploy ami
+@click.group(short_help='Lists and cleans up the AMIs built for a deployment.')
+def ami():
+    """
+    Lists and cleans up the AMIs built for a deployment.
+
+    Packer adds every build to the deployment's manifest, so old AMIs (and the EBS
+    snapshots behind them) are kept until they're garbage collected.
+
+    Usage:
+        drone-deploy ami list drone.mydomain.com
+        drone-deploy ami gc drone.mydomain.com --keep 2
+    """
+    pass
+
+
+# $> drone-deploy ami list <deployment-name>
+@ami.command(name='list')
+@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
+def list_amis(deployment_name):
+    """
+    Lists <deployment-name>'s AMIs, newest first, with the ones in use by terraform.
+    """
+    deployment = load_deployment(deployment_name)
+    if deployment is None:
+        return False
+    history = deployment.ami_history()
+    if not len(history):
+        click.echo("No AMIs have been built yet.")
+        return
+    echo_builds(history)
+
+
+# $> drone-deploy ami gc <deployment-name> --keep N
+@ami.command()
+@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
+@click.option('--keep', type=click.IntRange(min=0), default=2, show_default=True,
+              help='AMIs to keep of each kind (server and base) in each region.')
+@click.option('--dry-run', is_flag=True, help='Only show the AMIs that would be deleted.')
+@click.option('--yes', '-y', is_flag=True, help="Don't ask before deleting the AMIs.")
+@click.option('--endpoint-url', metavar='URL',
+              help='Send the sts and ec2 calls to URL (e.g. a local AWS stand-in) instead of '
+                   'AWS.')
+def gc(deployment_name, keep, dry_run, yes, endpoint_url):
+    """
+    Deregisters <deployment-name>'s old AMIs and deletes their snapshots.
+
+    The newest --keep AMIs of each kind in each region are kept, as are the current
+    builds and any AMI in use (in the terraform state or set in config.yaml). Deleted
+    AMIs are removed from the packer manifests. Asks before deleting anything, unless
+    --yes is given.
+    """
+    # imported here so the other commands don't pay for botocore
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    deployment = load_deployment(deployment_name)
+    if deployment is None:
+        return False
+    builds = deployment.gc_amis(keep, dry_run=True)
+    if not builds:
+        click.echo("Nothing to delete.")
+        return
+    click.echo("Would delete:" if dry_run else "Deleting:")
+    echo_builds(builds)
+    if dry_run:
+        return
+    if not yes:
+        click.confirm(f"Deregister {len(builds)} AMI(s) and delete their snapshots?",
+                      abort=True)
+    try:
+        builds = deployment.gc_amis(keep, endpoint_url=endpoint_url)
+    except (BuildError, BotoCoreError, ClientError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Deleted {len(builds)} AMI(s) and their snapshots.")
@@ -0,0 +1,200 @@
+import sys
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from drone_deploy.files import write_if_changed
+from drone_deploy.ami_regions import parse_artifact_id, format_artifact_id
+
+# image ids per describe_images call
+DESCRIBE_BATCH = 100
+
+# ec2 calls in flight at once (deregister_image and delete_snapshot take one id per call)
+MAX_WORKERS = 8
+
+
+class AmiBuild():
+    '''One AMI from a packer build. A build copied to other regions has one per region.'''
+    __slots__ = ('ami', 'region', 'kind', 'build_time', 'fingerprint', 'run_uuid', 'current',
+                 'in_use')
+
+    def __init__(self, ami, region, kind, build_time=0, fingerprint='', run_uuid='',
+                 current=False, in_use=False):
+        self.ami = ami
+        self.region = region
+        self.kind = kind
+        self.build_time = build_time
+        self.fingerprint = fingerprint
+        self.run_uuid = run_uuid
+        self.current = current
+        self.in_use = in_use
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"AmiBuild({self.ami!r}, {self.region!r}, {self.kind!r})"
+
+
+def manifest_builds(manifest, kind, in_use=()):
+    '''returns an AmiBuild for each region of each build in a packer manifest (oldest first)'''
+    builds = manifest.get('builds') or []
+    amis = []
+    for index, build in enumerate(builds):
+        custom_data = build.get('custom_data') or {}
+        fingerprint = (custom_data.get('build_fingerprint') or
+                       custom_data.get('base_fingerprint', ''))
+        for region, ami in parse_artifact_id(build.get('artifact_id')).items():
+            amis.append(AmiBuild(ami, region, kind, build.get('build_time') or 0, fingerprint,
+                                 build.get('packer_run_uuid', ''),
+                                 current=index == len(builds) - 1, in_use=ami in in_use))
+    return amis
+
+
+class AmiHistory():
+    """
+    Every AMI in a deployment's packer manifests (packer appends each build, so old AMIs
+    stay listed after they're replaced), indexed by AMI id. E.g.,
+        history = AmiHistory(packer_dir, {'server': 'manifest.json'}, in_use={'ami-0edf...'})
+        history['ami-0edf58c4682eddea0'].in_use         => True
+        history.garbage(keep=2)                         => [AmiBuild(...), ...]
+
+    The last build in each manifest is `current`. AMIs in in_use (e.g. from the terraform
+    state) are flagged `in_use`.
+    """
+
+    def __init__(self, packer_dir, manifests, in_use=()):
+        self.packer_dir = Path(packer_dir)
+        self.manifests = manifests
+        self.in_use = set(in_use)
+        self.load()
+
+    def load(self):
+        self.builds = []
+        for kind, name in self.manifests.items():
+            manifest = self.read_manifest(name)
+            self.builds += manifest_builds(manifest, kind, self.in_use)
+        self.builds.sort(key=lambda build: build.build_time, reverse=True)
+        self.index = {build.ami: build for build in self.builds}
+
+    def read_manifest(self, name):
+        try:
+            with open(self.packer_dir.joinpath(name), 'r') as read_file:
+                return json.load(read_file)
+        except (OSError, ValueError):
+            return {}
+
+    def __getitem__(self, ami):
+        return self.index[ami]
+
+    def __contains__(self, ami):
+        return ami in self.index
+
+    def __iter__(self):
+        return iter(self.builds)
+
+    def __len__(self):
+        return len(self.builds)
+
+    def garbage(self, keep):
+        '''
+        Returns the AMIs that can be deleted: all but the newest `keep` of each kind in each
+        region, never the current build or one that's in use.
+        '''
+        kept = {}
+        garbage = []
+        for build in self.builds:
+            key = (build.kind, build.region)
+            if build.current or build.in_use or kept.get(key, 0) < keep:
+                kept[key] = kept.get(key, 0) + 1
+            else:
+                garbage.append(build)
+        return garbage
+
+    def remove(self, amis):
+        '''removes amis from the manifests (dropping builds with no AMIs left)'''
+        amis = set(amis)
+        for name in self.manifests.values():
+            manifest = self.read_manifest(name)
+            builds = manifest.get('builds')
+            if not builds:
+                continue
+            for build in builds:
+                kept = {region: ami for region, ami
+                        in parse_artifact_id(build.get('artifact_id')).items() if ami not in amis}
+                build['artifact_id'] = format_artifact_id(kept)
+            # the last build is the current one, it stays even if it has no AMIs left
+            manifest['builds'] = ([build for build in builds[:-1] if build['artifact_id']] +
+                                  builds[-1:])
+            write_if_changed(self.packer_dir.joinpath(name),
+                             json.dumps(manifest, indent=2) + '\n', mode=0o644)
+        self.load()
+
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def image_snapshots(ec2, amis):
+    '''returns {AMI id: [snapshot ids]} for the amis that still exist (one call per batch)'''
+    snapshots = {}
+    for batch in batches(sorted(amis), DESCRIBE_BATCH):
+        # a filter, unlike ImageIds, doesn't fail the whole call when an image is already gone
+        response = ec2.describe_images(Owners=['self'],
+                                       Filters=[{'Name': 'image-id', 'Values': batch}])
+        for image in response.get('Images', []):
+            snapshots[image['ImageId']] = [mapping['Ebs']['SnapshotId']
+                                           for mapping in image.get('BlockDeviceMappings', [])
+                                           if mapping.get('Ebs', {}).get('SnapshotId')]
+    return snapshots
+
+
+def delete_images(session, builds, stream=None, endpoint_url=None, max_workers=MAX_WORKERS):
+    '''
+    Deregisters the AMIs of builds and deletes their snapshots. Images are described in
+    batches (per region), then deregistered and their snapshots deleted concurrently.
+    AMIs that are already gone count as deleted. Returns ([deleted AMI ids], {id: error}).
+    '''
+    stream = sys.stdout if stream is None else stream
+    regions = {}
+    for build in builds:
+        regions.setdefault(build.region, []).append(build.ami)
+    clients = {region: session.client('ec2', region_name=region, endpoint_url=endpoint_url)
+               for region in regions}
+    errors = {}
+
+    def call(description, region, ami, method, **kwargs):
+        try:
+            method(**kwargs)
+            stream.write(f"[{region}] {description}\n")
+            stream.flush()
+            return True
+        except Exception as e:
+            errors[ami] = str(e)
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        found = dict(zip(regions, executor.map(
+            lambda region: image_snapshots(clients[region], regions[region]), regions)))
+
+        deregistered = {}
+        for region, amis in regions.items():
+            for ami in amis:
+                if ami in found[region]:
+                    deregistered[(region, ami)] = executor.submit(
+                        call, f"deregistered {ami}", region, ami,
+                        clients[region].deregister_image, ImageId=ami)
+
+        # an image's snapshots can only be deleted once it's deregistered
+        deletions = []
+        for (region, ami), future in deregistered.items():
+            if future.result():
+                for snapshot in found[region][ami]:
+                    deletions.append(executor.submit(
+                        call, f"deleted {snapshot} ({ami})", region, ami,
+                        clients[region].delete_snapshot, SnapshotId=snapshot))
+        for future in deletions:
+            future.result()
+
+    deleted = [build.ami for build in builds if build.ami not in errors]
+    return deleted, errors
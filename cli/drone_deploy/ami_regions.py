@@ -0,0 +1,126 @@
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# seconds between checks on an AMI that's being copied
+POLL_INTERVAL = 15
+
+# seconds to wait for a copy before giving up (copies of an 8GB image take ~10 minutes)
+COPY_TIMEOUT = 60 * 60
+
+
+def parse_artifact_id(artifact_id):
+    '''
+    Returns {region: ami} for a packer amazon-ebs artifact id. Packer writes one region:ami
+    pair per region, e.g. 'us-east-1:ami-0edf58c4682eddea0,us-west-2:ami-0a1b2c3d4e5f67890'.
+    '''
+    amis = {}
+    for pair in (artifact_id or '').split(','):
+        region, _, ami = pair.strip().partition(':')
+        if region and ami:
+            amis[region] = ami
+    return amis
+
+
+def format_artifact_id(amis):
+    '''the reverse of parse_artifact_id'''
+    return ','.join(f"{region}:{ami}" for region, ami in amis.items())
+
+
+def parse_regions(regions):
+    '''returns a list of regions from 'a,b,c' (or a list), without blanks or duplicates'''
+    if isinstance(regions, str):
+        regions = regions.split(',')
+    names = []
+    for region in regions or []:
+        region = region.strip()
+        if region and region not in names:
+            names.append(region)
+    return names
+
+
+class RegionProgress():
+    """
+    Prints one line per region each time a copy changes state, and a summary table at the
+    end. Safe to call from the copy threads. E.g.,
+        [us-west-2] copying ami-0a1b2c3d4e5f67890 (pending, 45s)
+    """
+
+    def __init__(self, regions, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.width = max([len(r) for r in regions] + [len('REGION')])
+        self.status = {region: ('waiting', '', 0.0) for region in regions}
+
+    def update(self, region, status, ami=''):
+        seconds = time.monotonic() - self.start
+        with self.lock:
+            if self.status.get(region, ('', ''))[:2] == (status, ami):
+                return
+            self.status[region] = (status, ami, seconds)
+            detail = f" {ami}" if ami else ''
+            self.stream.write(f"[{region}] {status}{detail} ({seconds:.0f}s)\n")
+            self.stream.flush()
+
+    def print_summary(self):
+        lines = [f"{'REGION':<{self.width}}  {'AMI':<21}  {'STATUS':<9}  {'TIME':>8}"]
+        for region, (status, ami, seconds) in self.status.items():
+            lines.append(f"{region:<{self.width}}  {ami or '-':<21}  {status:<9}  "
+                         f"{seconds:>7.1f}s")
+        with self.lock:
+            self.stream.write('\n' + '\n'.join(lines) + '\n')
+            self.stream.flush()
+
+
+def copy_image(session, source_region, source_ami, region, progress,
+               poll_interval=POLL_INTERVAL, timeout=COPY_TIMEOUT):
+    '''
+    Copies source_ami to region (with its name, description, and tags) and waits for the
+    copy to become available. Returns the new AMI id.
+    '''
+    source = session.client('ec2', region_name=source_region)
+    image = source.describe_images(ImageIds=[source_ami])['Images'][0]
+
+    ec2 = session.client('ec2', region_name=region)
+    progress.update(region, 'copying')
+    ami = ec2.copy_image(SourceRegion=source_region, SourceImageId=source_ami,
+                         Name=image['Name'], Description=image.get('Description', ''))['ImageId']
+    if image.get('Tags'):
+        ec2.create_tags(Resources=[ami], Tags=image['Tags'])
+
+    deadline = time.monotonic() + timeout
+    while True:
+        state = ec2.describe_images(ImageIds=[ami])['Images'][0]['State']
+        if state == 'available':
+            progress.update(region, 'available', ami)
+            return ami
+        if state in ('failed', 'invalid', 'error', 'deregistered'):
+            raise RuntimeError(f"Copying {source_ami} to {region} failed ({state}).")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Timed out waiting for {ami} in {region}.")
+        progress.update(region, 'copying', ami)
+        time.sleep(poll_interval)
+
+
+def copy_to_regions(session, source_region, source_ami, regions, stream=None,
+                    poll_interval=POLL_INTERVAL):
+    '''
+    Copies source_ami to each region at once. Returns ({region: ami} for the copies that
+    succeeded, {region: error} for those that didn't).
+    '''
+    progress = RegionProgress(regions, stream=stream)
+    amis, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max(len(regions), 1)) as pool:
+        futures = {region: pool.submit(copy_image, session, source_region, source_ami, region,
+                                       progress, poll_interval)
+                   for region in regions}
+        for region, future in futures.items():
+            try:
+                amis[region] = future.result()
+            except Exception as e:
+                errors[region] = e
+                progress.update(region, 'failed')
+    progress.print_summary()
+    return amis, errors
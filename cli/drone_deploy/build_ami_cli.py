@@ -5,11 +5,37 @@ from drone_deploy.filter import filter_deployments
 
 
 # $> drone-deploy build-ami
-@click.group(invoke_without_command=True)
+@click.group(invoke_without_command=True,
+             short_help='Builds the drone server AMI (Amazon Machine Image).')
 @click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
-def build_ami(deployment_name):
+@click.option('--force', is_flag=True,
+              help='Build even if nothing has changed since the last build.')
+@click.option('--regions', metavar='REGION,...',
+              help='Copy the AMI to these regions too (all at once), e.g. us-west-2,eu-west-1.')
+@click.option('--rebuild-base', is_flag=True,
+              help='Rebuild the base AMI (OS updates, docker, compose) even if it is current.')
+def build_ami(deployment_name, force, regions, rebuild_base):
     """
     Builds the drone server AMI (Amazon Machine Image).
+
+    The AMI is built on a base AMI with the OS updates, docker, compose, and the aws-cli
+    image. The base is only rebuilt when its files change or it's older than
+    drone_base_ami_max_age days (see config.yaml), so most builds just add the drone
+    configs and images.
+
+    Each build records a fingerprint of the packer dir and packer vars. If they haven't
+    changed since the last build the existing AMI is kept, use --force to build anyway.
+
+    The AMI is built once, in the deployment's region, and copied to --regions. Copies
+    are kept in the manifest and only made for regions that don't have the AMI yet.
+
+    Progress is shown one line per phase of the build (launching the instance, waiting
+    for SSH, each provisioner, creating the AMI). The phase timings are written to
+    packer/build-timings.json and packer's full output to packer/build.log.
+
+    Usage:
+        drone-deploy build-ami drone.mydomain.com
+        drone-deploy build-ami drone.mydomain.com --regions us-west-2,eu-west-1
     """
     deployment_dir = Path.cwd().joinpath('deployments', deployment_name)
     if not deployment_dir.exists():
@@ -19,4 +45,4 @@ def build_ami(deployment_name):
     else:
         # load the deployment
         deployment = Deployment(deployment_dir.joinpath('config.yaml').resolve())
-        deployment.build_ami()
+        deployment.build_ami(force=force, regions=regions, rebuild_base=rebuild_base)
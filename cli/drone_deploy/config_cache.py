@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+
+
+class ConfigCache():
+    """
+    Persists a deployment's resolved configuration so read-only commands (show,
+    show-agent-command) can skip parsing config.yaml, terraform.tfstate, and the packer
+    manifest when nothing has changed. E.g.,
+        cache = ConfigCache(config_file, env_names=['DRONE_AWS_REGION'])
+        data = cache.load()     # None on a miss
+        cache.save(data)
+
+    The cache key is the (mtime, size, inode) of config.yaml, terraform/terraform.tfstate, and
+    packer/manifest.json plus the values of the environment variables that can override
+    config settings, so checking it is a few stat calls. The files' content hashes are saved
+    too: when only their metadata changed (e.g. touched, or rewritten as is) they're hashed
+    and the cache is still used, and its key updated. The cache file is written to
+    <deployment>/.cache/resolved-config.json and is only readable by the current user as it
+    may contain secrets.
+
+    Required Attributes
+    ----------
+    config_file: file
+        The full path to a deployment's config.yaml file.
+    env_names: list
+        Names of the environment variables that affect the resolved config.
+
+    Methods
+    -------
+    env_fingerprint(self, environ=os.environ)
+        Returns a hash of the env vars that can override config settings.
+    fingerprint(self, environ=os.environ, stats=None)
+        Returns the cache key for the current (or given) file stats and environment.
+    load
+        Returns the cached data if the fingerprint still matches (or only the metadata of
+        files with the same contents changed), else None.
+    save(self, data)
+        Writes data (a json serializable dict) and the watched files' hashes to the cache
+        file.
+    """
+    CACHE_VERSION = 7
+
+    def __init__(self, config_file, env_names=[], environ=None):
+        self.config_file = Path(config_file)
+        self.deployment_dir = self.config_file.parent
+        self.cache_file = self.deployment_dir.joinpath('.cache', 'resolved-config.json')
+        self.env_names = sorted(env_names)
+
+        # compute the key now, before anything gets a chance to change the environment
+        environ = os.environ if environ is None else environ
+        self.env_key = self.env_fingerprint(environ)
+        self.stats = [file_stat(file) for file in self.watched_files]
+        self.key = self.fingerprint(environ, self.stats)
+
+    @property
+    def watched_files(self):
+        '''files whose changes invalidate the cache'''
+        return [self.config_file,
+                self.deployment_dir.joinpath('terraform', 'terraform.tfstate'),
+                self.deployment_dir.joinpath('packer', 'manifest.json')]
+
+    def env_fingerprint(self, environ=os.environ):
+        '''returns a hash of the env vars that can override config settings'''
+        key = hashlib.sha256(f"v{self.CACHE_VERSION}".encode())
+        for name in self.env_names:
+            key.update(f"{name}={environ.get(name)!r}".encode())
+        return key.hexdigest()
+
+    def fingerprint(self, environ=os.environ, stats=None):
+        '''returns a hash of the watched files' (mtime, size, inode) and env vars'''
+        if stats is None:
+            stats = [file_stat(file) for file in self.watched_files]
+        key = hashlib.sha256(self.env_fingerprint(environ).encode())
+        key.update(json.dumps(stats).encode())
+        return key.hexdigest()
+
+    def load(self):
+        '''returns the cached data if the cache is valid, else None'''
+        try:
+            with open(self.cache_file, "r") as read_file:
+                cache = json.load(read_file)
+        except (OSError, ValueError):
+            return None
+
+        if cache.get('key') == self.key:
+            return cache.get('data')
+        saved_stats, hashes = cache.get('stats'), cache.get('hashes')
+        if cache.get('env_key') != self.env_key or not isinstance(saved_stats, list) or \
+                not isinstance(hashes, list) or len(saved_stats) != len(self.stats):
+            return None
+
+        # only the files whose metadata changed are hashed, if their contents are the same
+        # the cache is still good (and saved with the new key)
+        for file, stat, saved_stat, saved_hash in zip(self.watched_files, self.stats,
+                                                      saved_stats, hashes):
+            if stat != saved_stat and (saved_hash is None or
+                                       file_hash(file, stat) != saved_hash):
+                return None
+        self.save(cache.get('data'), hashes=hashes)
+        return cache.get('data')
+
+    def save(self, data, hashes=None):
+        '''writes data to the cache file (failing to cache is never fatal)'''
+        if hashes is None:
+            hashes = [file_hash(file, stat) for file, stat in zip(self.watched_files, self.stats)]
+        try:
+            self.cache_file.parent.mkdir(exist_ok=True)
+            tmp_file = self.cache_file.with_suffix('.tmp')
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                json.dump({'key': self.key, 'env_key': self.env_key, 'stats': self.stats,
+                           'hashes': hashes, 'data': data}, file, default=str)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            pass
+
+
+def file_stat(file):
+    '''returns [mtime_ns, size, inode] of file, None if it's missing'''
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+def file_hash(file, stat):
+    '''
+    returns the sha256 of file if its metadata still matches stat (see file_stat), else None
+    (a file that's missing, or changing while it's read, never matches a saved hash)
+    '''
+    if stat is None:
+        return None
+    try:
+        with open(file, 'rb') as read_file:
+            digest = hashlib.sha256(read_file.read()).hexdigest()
+    except OSError:
+        return None
+    return digest if file_stat(file) == stat else None
@@ -2,12 +2,18 @@ import click
 from pathlib import Path
 from drone_deploy.deployment import Deployment
 from drone_deploy.filter import filter_deployments
+from drone_deploy.fleet import fleet_options, run_fleet_command
 
 
 # $> drone-deploy deploy [deployment name]
-@click.group(invoke_without_command=True)
-@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
-def deploy(deployment_name):
+@click.group(invoke_without_command=True,
+             short_help="Deploys (runs 'terraform apply') on a deployment.")
+@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments,
+                required=False)
+@fleet_options
+@click.option('--yes', '-y', is_flag=True,
+              help="Don't ask before running unattended on many deployments.")
+def deploy(deployment_name, all_deployments, match, jobs, yes):
     """
     Deploys (runs 'terraform apply') on <deployment_name> resources.
 
@@ -16,7 +22,15 @@ def deploy(deployment_name):
     Usage:
         `drone-deploy deploy drone.yourroute53domain.com`
 
+        Deploy every deployment (or those matching a glob) unattended, 4 at a time:
+        `drone-deploy deploy --all --jobs 4`
+        `drone-deploy deploy --match 'prod-*'`
+
     """
+    if all_deployments or match:
+        return run_fleet_command('deploy', all_deployments, match, jobs, confirm=not yes)
+    if not deployment_name:
+        raise click.UsageError("Missing argument 'DEPLOYMENT_NAME' (or use --all/--match).")
 
     deployment_dir = Path.cwd().joinpath('deployments', deployment_name, 'config.yaml').resolve()
     if not deployment_dir.exists():
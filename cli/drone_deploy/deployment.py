@@ -1,10 +1,12 @@
-import os
 import secrets
 import ruamel.yaml
 from pathlib import Path
 from ruamel.yaml import YAML
 from drone_deploy.packer import Packer
+from drone_deploy.profiler import span
 from drone_deploy.terraform import Terraform
+from drone_deploy.config_cache import ConfigCache
+from drone_deploy.resolved_config import ResolvedConfig, resolve_config, ENV_PARAMS
 
 
 class Deployment():
@@ -34,12 +36,20 @@ class Deployment():
     config_file: file
         The full path to a deployment's config.yaml file.
 
+    Properties
+    ----------
+    resolved: ResolvedConfig
+        The immutable, fully resolved config (env vars, config.yaml, generated values, and
+        terraform/packer artifacts). Nothing is exported to os.environ; instead
+        `env` (resolved.environment()) is passed to the terraform and packer subprocesses.
+    tfvars: dict
+        The resolved variables, written to var files for terraform (drone-deploy.auto.tfvars.json)
+        and packer (drone-deploy.vars.json) instead of being passed on the command line.
+
     Methods
     -------
-    __load_param(self, param_name):
-        Loads specified configs from env vars or from config.yaml if env is not set.
-    __init__(self, config_file)
-        Loads the config.yaml file.
+    __init__(self, config_file, use_cache=False)
+        Loads the config.yaml file (or a cached resolved config for read-only commands).
     setup_terraform
         Attaches an instance of class Terraform to the deployment instance. E.g., mydeploy.terraform.plan().
     setup_packer
@@ -50,136 +60,171 @@ class Deployment():
         Returns a random hexadecimal token (defaults to 128bit) used for rpc secrets.
     init
         Runs `terraform init` in the deployment dir.
+    prepare
+        Runs `terraform init` and applies the IAM resources needed to build the AMI.
     plan
         Runs `terraform plan` in the deployment dir.
     deploy
         Runs `terraform apply` in the deployment dir.
     destroy
         Runs `terraform destroy` in the deployment dir.
-    build_ami
-        Builds the drone server ami using packer.
+    build_ami(force=False, regions=None, rebuild_base=False)
+        Builds the drone server ami using packer, unless the last build had the same inputs,
+        and copies it to regions. The base AMI is rebuilt when it's out of date.
+    ami_history
+        Returns the AmiHistory of the deployment's AMIs, flagging the ones in use.
+    gc_amis(keep, dry_run=False, endpoint_url=None)
+        Deletes old AMIs and their snapshots, keeping the newest keep and any in use.
     deployment_status
         Returns the current state of the deployment.
     """
 
-    def __load_param(self, param_name):
-        '''load config from env or from config.yaml if env is not set'''
-        if os.getenv(param_name.upper()):
-            # env var exists, set param to its value
-            param = os.getenv(param_name.upper(), '')
-        else:
-            # get the value from the config file and export as an env var
-            param = self.config.get(param_name, '')
-            os.environ[param_name.upper()] = str(param)
-
-        # generate a random rpc_secret if not set
-        if param_name == "drone_rpc_secret":
-            if not param and os.environ.get('DRONE_RPC_SECRET') in ("None", ""):
-                param = self.generate_rpc()
-
-        # dynamically name the s3 bucket
-        if param_name == "drone_s3_bucket":
-            if not param and os.environ.get('DRONE_S3_BUCKET') in ("None", ""):
-                machine_name = os.environ.get('DRONE_SERVER_MACHINE_NAME')
-                hosted_zone = os.environ.get('DRONE_SERVER_HOSTED_ZONE')
-                if machine_name and hosted_zone:
-                    param = f"drone-data.{machine_name}.{hosted_zone}"
-
-        # set config entry
-        self.config[param_name] = param
-
-        # get the 'drone_builder_role_arn' from terraform
-        if param_name == "drone_builder_role_arn":
-            self.config[param_name] = self.terraform.drone_builder_role_arn
-
-        # get the 'drone_deployment_id' from packer
-        if param_name == "drone_deployment_id" and not param:
-            self.config[param_name] = self.packer.drone_deployment_id
-            os.environ[param_name.upper()] = self.config[param_name]
-            param = self.config[param_name]
-
-        # get the drone_server_ami from packer unless env var is set
-        if param_name == "drone_server_ami" and not param:
-            self.config[param_name] = self.packer.drone_server_ami
-            os.environ[param_name.upper()] = self.config[param_name]
-            param = self.config[param_name]
-
-        # flatten user-filter for docker-compose (convert ruamel / remove brackets), ticks, spaces
-        if param_name == "drone_user_filter":
-            patched_param = []
-            if param:
-                patched_param = list(param)
-                param = repr(patched_param)
-                param = param.replace('[', '').replace("]", '')
-                param = param.replace("'", "")
-                param = param.replace(" ", "")
-
-        # convert yaml arrays to something hashi compatable.
-        if type(param) == ruamel.yaml.comments.CommentedSeq:
-            patched_param = str(param).replace("'", '"')
-            self.tf_vars.append((param_name, patched_param))
-            param = patched_param
-        else:
-            self.tf_vars.append((param_name, f"\"{param}\""))
-
-        # export configs so they are available in terraform, as terraform automatically
-        # picks up env vars whose names start with TF_VAR_
-        os.environ[f"TF_VAR_{param_name.lower()}"] = str(param)
-        return param
+    # resources 'prepare' applies so the ami can be built before the first full deploy
+    BUILDER_TARGETS = [
+        "aws_iam_policy.drone-builder-ec2",
+        "aws_iam_policy.drone-builder-s3",
+        "aws_iam_policy_attachment.ec2",
+        "aws_iam_policy_attachment.s3",
+        "aws_iam_instance_profile.drone-builder"
+    ]
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, use_cache=False):
         '''
         Load and parse the deployment config.yaml file.
         I'm using 'ruamel' to parse config file as it preserves yaml comments.
+
+        Read-only commands can pass use_cache=True to reuse the resolved config from a
+        previous run when config.yaml, the tfstate, the packer manifest, and the relevant
+        env vars haven't changed (see ConfigCache). A deployment loaded from the cache
+        doesn't export env vars and should not be used to run terraform or packer.
         '''
-        yaml = YAML()
         self.config_file = config_file
-        self.config = yaml.load(self.config_file)
-
-        # list of tuples we'll want to pass to terraform/packer (added via self.__load_param())
-        self.tf_vars = []
-
-        # The 'drone_deployment_name' is dynamically created from the name of the deployment
-        # directory and is used for naming resources in AWS. In order to keep aws resources
-        # clearly labeled we append 'drone' to the name if the user hasn't already. E.g.,
-        # 'drone-deploy new dev' creates dir '/deployments/dev' and creates 'drone-dev-foo' aws resource name
-        if not os.getenv('DRONE_DEPLOYMENT_NAME'):
-            if not self.config.get('drone_deployment_name'):
-                # deployment name wasn't overidden via env var or in the config.yaml file, so
-                # set the env var here and let __load_param handle everything else
-                if 'drone' in self.config_file.parent.name:
-                    os.environ['DRONE_DEPLOYMENT_NAME'] = f"{self.config_file.parent.name}"
-                else:
-                    os.environ['DRONE_DEPLOYMENT_NAME'] = f"drone-{self.config_file.parent.name}"
-        
-        # load the bulk of the params
-        stage1_params = ["drone_deployment_name", "drone_aws_region", "drone_vpc_id",
-                         "drone_server_machine_name", "drone_server_hosted_zone",
-                         "drone_server_key_pair_name", "drone_server_instance_type",
-                         "drone_docker_compose_version", "drone_server_allow_http",
-                         "drone_server_allow_https", "drone_server_allow_ssh",
-                         "drone_open", "drone_admin", "drone_admin_email", "drone_user_filter",
-                         "drone_github_server", "drone_github_client_id","drone_github_client_secret",
-                         "drone_agents_enabled", "drone_tls_autocert", "drone_server_proto",
-                         "drone_server_host", "drone_cli_version", "drone_server_docker_image",
-                         "drone_agent_docker_image", "drone_server_base_ami", "aws_cli_base_image",
-                         "drone_rpc_secret", "drone_s3_bucket"]
-        for p in stage1_params:
-            self.__load_param(p)
-
-        # prepare terraform and load terraform related params
+        self._terraform = None
+        self._packer = None
+        self.from_cache = False
+        with span('Deployment()', deployment=Path(config_file).parent.name):
+            self.__load(use_cache)
+
+    def __load(self, use_cache):
+        cache = None
+        if use_cache:
+            with span('config cache'):
+                cache = ConfigCache(self.config_file, env_names=ENV_PARAMS)
+                cached = cache.load()
+            if cached:
+                self.__load_cache(cached)
+                return
+
+        with span('config.yaml'):
+            yaml = YAML()
+            self.config = yaml.load(self.config_file)
+
+        # load the terraform state and packer manifest, which some params fall back to
+        self.tfvars = {}
+        self.env = None
         self.setup_terraform()
-        self.__load_param("drone_builder_role_arn")
-
-        # prepare packer and load packer related params
         self.setup_packer()
-        self.__load_param("drone_deployment_id")
-        self.__load_param("drone_server_ami")
+
+        # resolve every param without touching os.environ
+        with span('resolve config'):
+            self.resolved = resolve_config(
+                self.config, Path(self.config_file).parent.name,
+                builder_role_arn=self.terraform.drone_builder_role_arn,
+                deployment_id=self.packer.drone_deployment_id,
+                server_ami=self.packer.drone_server_ami, server_amis=self.packer.amis)
+            self.__sync_config()
+
+        # hand the resolved vars and env over to the terraform/packer wrappers
+        self.tfvars = dict(self.resolved.tfvars)
+        self.env = self.resolved.environment()
+        self.terraform.tfvars = self.tfvars
+        self.terraform.env = self.env
+        self.packer.packer_vars = list(self.tfvars.items())
+        self.packer.env = self.env
+        # the manifest's AMI was picked before env overrides (e.g. DRONE_AWS_REGION) applied
+        self.packer.select_server_ami()
+
+        if cache:
+            with span('save config cache'):
+                cache.save(self.__cache_data())
+
+    def pin_rpc_secret(self):
+        '''
+        Saves a generated rpc secret (see ResolvedConfig.generated) to config.yaml, so the
+        next load resolves the same one. Otherwise every run would render different
+        terraform vars (a new secret on every apply, and no saved plan would ever match).
+        Called before running terraform; loading a deployment never writes config.yaml.
+        Only the secret is written, not env var overrides or build artifacts.
+        '''
+        if 'drone_rpc_secret' not in self.resolved.generated:
+            return False
+        yaml = YAML()
+        config = yaml.load(Path(self.config_file))
+        if config.get('drone_rpc_secret') == self.resolved['drone_rpc_secret']:
+            return False
+        config['drone_rpc_secret'] = self.resolved['drone_rpc_secret']
+        with open(self.config_file, 'w') as file:
+            yaml.dump(config, file)
+        return True
+
+    def __sync_config(self):
+        '''
+        Copies resolved values (env var overrides, generated secrets, and build artifacts)
+        into the round-trip config so they show up in `show` and are saved by write_config.
+        '''
+        for name, value in self.resolved.items():
+            if isinstance(value, tuple):
+                value = list(value)
+            if self.config.get(name) != value:
+                self.config[name] = value
+
+    def __cache_data(self):
+        '''returns the resolved deployment as a json serializable dict (see ConfigCache)'''
+        return {
+            'config': dict(self.config),
+            'resolved': self.resolved.to_dict(),
+            'rendered': str(self),
+            'new_build': self.packer.new_build,
+            'has_tf_state': self.terraform.has_tf_state,
+        }
+
+    def __load_cache(self, cached):
+        '''restores a deployment resolved by a previous run'''
+        self.from_cache = True
+        self.config = cached['config']
+        self.resolved = ResolvedConfig.from_dict(cached['resolved'])
+        self.tfvars = dict(self.resolved.tfvars)
+        self.env = self.resolved.environment()
+        self.__rendered = cached['rendered']
+        self.__artifact_status = (cached['new_build'], cached['has_tf_state'])
 
     def __str__(self):
         '''returns pretty formatted yaml'''
+        if self.from_cache:
+            return self.__rendered
         return str(ruamel.yaml.round_trip_dump(self.config))
 
+    @property
+    def terraform(self):
+        '''The Terraform command wrapper (set up on first use when loaded from cache).'''
+        if self._terraform is None:
+            self.setup_terraform()
+        return self._terraform
+
+    @property
+    def packer(self):
+        '''The Packer command wrapper (set up on first use when loaded from cache).'''
+        if self._packer is None:
+            self.setup_packer()
+        return self._packer
+
+    @property
+    def artifact_status(self):
+        '''returns (new_build, has_tf_state) without reloading artifacts when cached'''
+        if self.from_cache:
+            return self.__artifact_status
+        return self.packer.new_build, self.terraform.has_tf_state
+
     def generate_rpc(self, num_bytes=16):
         '''returns a random hexadecimal token (defaults to 128bit) '''
         return secrets.token_hex(num_bytes)
@@ -193,54 +238,86 @@ class Deployment():
     def setup_terraform(self):
         '''Setup our Terraform command wrapper.'''
         tf_dir = Path(self.config_file).parent.joinpath('terraform').resolve()
-        self.terraform = Terraform(tf_dir, tf_vars=self.tf_vars)
+        with span('terraform setup'):
+            self._terraform = Terraform(tf_dir, env=self.env, tfvars=self.tfvars)
 
     def setup_packer(self):
         '''Setup our Packer command wrapper.'''
         packer_dir = Path(self.config_file).parent.joinpath('packer').resolve()
-        packer_vars = [(k, v) for k, v in self.config.items()]
-        self.packer = Packer(packer_dir, packer_vars=packer_vars)
+        packer_vars = list(self.tfvars.items()) or [(k, v) for k, v in self.config.items()]
+        with span('packer manifest'):
+            self._packer = Packer(packer_dir, packer_vars=packer_vars, env=self.env)
 
     def init(self):
         '''runs terraform init in the deployment dir'''
-        self.terraform.init()
-
-    def plan(self, targets=[]):
-        '''runs terraform plan in the deployment dir'''
-        self.terraform.plan(targets)
-
-    def build_ami(self):
-        '''builds the drone server ami using packer'''
-        self.packer.build_ami()
+        return self.terraform.init()
+
+    def prepare(self):
+        '''runs terraform init and applies the IAM roles and policies needed to build the ami'''
+        try:
+            self.init()
+        except Exception:
+            pass
+
+        return self.deploy(["-target={}".format(t) for t in self.BUILDER_TARGETS])
+
+    def plan(self, targets=[], use_cache=True):
+        '''runs terraform plan in the deployment dir (unless an identical plan is saved)'''
+        self.pin_rpc_secret()
+        self.terraform.use_plan_cache = use_cache
+        return self.terraform.plan(targets)
+
+    def build_ami(self, force=False, regions=None, rebuild_base=False):
+        '''builds the drone server ami using packer (if its inputs have changed, or force)'''
+        return self.packer.build_ami(force=force, regions=regions, rebuild_base=rebuild_base)
+
+    def amis_in_use(self):
+        '''the AMIs the terraform state uses, and any set in config.yaml'''
+        amis = self.terraform.state.amis()
+        for name in ('drone_server_ami', 'drone_server_base_ami'):
+            if self.config.get(name):
+                amis.add(self.config.get(name))
+        return amis
+
+    def ami_history(self):
+        '''returns the deployment's AMIs (see AmiHistory), flagging the ones in use'''
+        return self.packer.history(self.amis_in_use())
+
+    def gc_amis(self, keep, dry_run=False, endpoint_url=None):
+        '''deletes the AMIs (and snapshots) beyond the newest keep that aren't in use'''
+        return self.packer.gc_amis(keep, self.amis_in_use(), dry_run=dry_run,
+                                   endpoint_url=endpoint_url)
 
     def deploy(self, targets=[]):
         '''runs `terraform apply`'''
-        self.terraform.apply(targets)
+        self.pin_rpc_secret()
+        return self.terraform.apply(targets)
 
     def destroy(self, targets=[]):
         '''destroys/deletes terraform resources and directory (optional)'''
-        self.terraform.destroy(targets)
+        return self.terraform.destroy(targets)
 
     @property
     def deployment_status(self):
         '''returns the current state of the deployment'''
         status = '---\n'
         deployment_name = self.config.get('drone_deployment_name')
+        new_build, has_tf_state = self.artifact_status
         # packer
-        if self.packer.new_build and not self.config.get('drone_server_ami'):
+        if new_build and not self.config.get('drone_server_ami'):
             status += f"AMI has not been built. Run 'drone-deploy prepare {deployment_name}'\n"
             status += f" and 'drone-deploy build-ami {deployment_name}' to build\n"
         else:
             status += f"drone-server-ami is set to {self.config.get('drone_server_ami')}\n"
 
         # terraform
-        if self.terraform.has_tf_state:
+        if has_tf_state:
             status += f"{deployment_name} has been deployed.\n\n"
         else:
             status += f"{deployment_name} has not been deployed.\n\n"
 
         # ssh tips
-        if self.terraform.has_tf_state:
+        if has_tf_state:
             status += f"You can add the following to your ~/.ssh/config to enable easy ssh access. E.g., `ssh {deployment_name}`\n"
             status += f'\tHost "{deployment_name}"\n'
             status += f'\t\tHostName "{deployment_name}"\n'
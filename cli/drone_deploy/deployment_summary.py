@@ -0,0 +1,67 @@
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from drone_deploy.tfstate import TfState
+
+# deployments summarized at once (the work is mostly stat calls and small reads)
+MAX_WORKERS = 8
+
+
+class DeploymentSummary():
+    '''A one row status of a deployment, from file metadata and the start of its tfstate.'''
+    __slots__ = ('name', 'deployed', 'ami', 'serial', 'applied_at', 'config_changed')
+
+    def __init__(self, name, deployed=False, ami=None, serial=None, applied_at=None,
+                 config_changed=False):
+        self.name = name
+        self.deployed = deployed
+        self.ami = ami
+        self.serial = serial
+        self.applied_at = applied_at
+        self.config_changed = config_changed
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"DeploymentSummary({self.name!r}, deployed={self.deployed!r})"
+
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def summarize(deployment_dir):
+    '''
+    Summarizes a deployment without loading it (no config.yaml parsing, no env): the AMI
+    its resources use, whether it's deployed, the state's serial, when the state was last
+    written (i.e. the last apply), and whether config.yaml has changed since. Only the
+    beginning of the state is parsed, and that (and the AMI scan) is memoized by TfState.
+    '''
+    deployment_dir = Path(deployment_dir)
+    summary = DeploymentSummary(deployment_dir.name)
+    state_file = deployment_dir.joinpath('terraform', 'terraform.tfstate')
+    state = TfState(state_file)
+    if not state.exists():
+        return summary
+
+    amis = state.amis()
+    summary.serial = state.info.get('serial')
+    summary.applied_at = mtime(state_file)
+    # a destroyed deployment keeps its (empty) state
+    summary.deployed = bool(state.outputs or amis)
+    summary.ami = ','.join(sorted(amis)) or None
+    config_mtime = mtime(deployment_dir.joinpath('config.yaml'))
+    summary.config_changed = bool(summary.deployed and config_mtime and summary.applied_at and
+                                  config_mtime > summary.applied_at)
+    return summary
+
+
+def summarize_all(deployments_dir, names, max_workers=MAX_WORKERS):
+    '''returns a DeploymentSummary for each of names, summarized concurrently (in order)'''
+    deployments_dir = Path(deployments_dir)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda name: summarize(deployments_dir.joinpath(name)), names))
@@ -3,12 +3,18 @@ import shutil
 from pathlib import Path
 from drone_deploy.deployment import Deployment
 from drone_deploy.filter import filter_deployments
+from drone_deploy.fleet import fleet_options, run_fleet_command
 
 
-@click.group(invoke_without_command=True)
-@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
+@click.group(invoke_without_command=True,
+             short_help="!!! Destroys (runs 'terraform destroy') on a deployment.")
+@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments,
+                required=False)
 @click.option('--rm/--no-rm', default=False)
-def destroy(deployment_name, rm):
+@fleet_options
+@click.option('--yes', '-y', is_flag=True,
+              help="Don't ask before running unattended on many deployments.")
+def destroy(deployment_name, rm, all_deployments, match, jobs, yes):
     """
     !!! Destroys (runs 'terraform destroy') on <deployment_name> resources.
 
@@ -20,7 +26,16 @@ def destroy(deployment_name, rm):
         Tears down any aws resources created during deploy. The S3 data bucket must
         be emptied and deleted manually.
 
+        Destroy every deployment matching a glob unattended, 4 at a time:
+        drone-deploy destroy --match 'test-*' --jobs 4
+
     """
+    if all_deployments or match:
+        if rm:
+            raise click.UsageError("--rm can't be used with --all or --match.")
+        return run_fleet_command('destroy', all_deployments, match, jobs, confirm=not yes)
+    if not deployment_name:
+        raise click.UsageError("Missing argument 'DEPLOYMENT_NAME' (or use --all/--match).")
 
     deployment_dir = Path.cwd().joinpath('deployments', deployment_name, 'config.yaml').resolve()
     if not deployment_dir.exists():
@@ -5,7 +5,8 @@ from drone_deploy.filter import filter_deployments
 
 
 # $> drone-deploy edit <deployment-name>
-@click.group(invoke_without_command=True, name='edit')
+@click.group(invoke_without_command=True, name='edit',
+             short_help="Edits a deployment's config file with $EDITOR.")
 @click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
 def edit_deployment(deployment_name):
     """
@@ -0,0 +1,24 @@
+import os
+from pathlib import Path
+
+
+def write_if_changed(path, text, mode=0o600):
+    '''
+    Atomically writes text to path unless the file already has exactly that content, so
+    tools that watch mtimes (terraform, our caches) don't see a change. Returns True if the
+    file was written.
+    '''
+    path = Path(path)
+    data = text.encode()
+    try:
+        if path.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+
+    tmp_file = path.with_name(f".{path.name}.tmp")
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_file, path)
+    return True
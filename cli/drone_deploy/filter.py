@@ -1,17 +1,67 @@
+import os
 import click
-from pathlib import Path
+from bisect import bisect_left
+
+# <root>/.cache/deployments-index: a 'v<INDEX_VERSION> <deployments dir mtime>' header line,
+# then one deployment name per line (sorted)
+INDEX_FILE = 'deployments-index'
+INDEX_VERSION = 1
+
+
+def deployment_names(root=None):
+    '''
+    Returns the (sorted) names of the deployments in <root>/deployments (default: the cwd).
+    They're read from a small index, which is only rebuilt when the deployments dir's mtime
+    changes (i.e. a deployment is added, removed, or renamed), so completion doesn't list a
+    directory of thousands of deployments on every TAB. Only uses os, for the same reason.
+    '''
+    root = root or os.getcwd()
+    deployments_dir = os.path.join(root, 'deployments')
+    try:
+        header = f"v{INDEX_VERSION} {os.stat(deployments_dir).st_mtime_ns}"
+    except OSError:
+        return []
+
+    index_file = os.path.join(root, '.cache', INDEX_FILE)
+    try:
+        with open(index_file, 'r') as read_file:
+            lines = read_file.read().splitlines()
+        if lines and lines[0] == header:
+            return lines[1:]
+    except OSError:
+        pass
+
+    names = sorted(entry.name for entry in os.scandir(deployments_dir)
+                   if entry.is_dir() and not entry.name.startswith('.'))
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as write_file:
+            write_file.write('\n'.join([header] + names) + '\n')
+        os.replace(tmp_file, index_file)
+    except OSError:
+        # a read-only checkout still completes, just without the index
+        pass
+    return names
 
 
 def filter_deployments(ctx, args, incomplete):
     """
-    Display list of deployments for bash autocompletion
+    Returns the deployments starting with `incomplete`, for bash autocompletion
     """
-    deployments = []
     try:
-        deployment_dir = Path.cwd().joinpath('deployments').resolve()
-        for deployment in deployment_dir.glob(f'{incomplete}*'):
-            if deployment.is_dir():
-                deployments.append(click.echo(deployment.name))
-        return [k for k in deployments if incomplete in k]
-    except Exception:
-        return ""
+        names = deployment_names()
+    except OSError:
+        return []
+    matches = []
+    for name in names[bisect_left(names, incomplete):]:
+        if not name.startswith(incomplete):
+            break
+        matches.append(name)
+    return matches
+
+
+def deployment_argument():
+    '''a deployment_name argument that only completes names (for completion placeholders)'''
+    return click.Argument(['deployment_name'], required=False,
+                          autocompletion=filter_deployments)
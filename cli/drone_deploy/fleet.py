@@ -0,0 +1,249 @@
+import sys
+import time
+import click
+import random
+import fnmatch
+import threading
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# terraform/aws output that means we're being rate limited and should back off
+THROTTLE_MARKERS = ("Throttling", "RequestLimitExceeded", "Rate exceeded",
+                    "TooManyRequestsException", "SlowDown")
+
+# fleet actions and the Deployment method that runs them
+FLEET_ACTIONS = {
+    'plan': 'plan',
+    'deploy': 'deploy',
+    'destroy': 'destroy',
+    'prepare': 'prepare',
+}
+
+
+def fleet_options(func):
+    '''adds the --all, --match, and --jobs options to a deployment command'''
+    func = click.option('--jobs', '-j', default=4, show_default=True, type=click.IntRange(1),
+                        help='Maximum number of deployments to run at once.')(func)
+    func = click.option('--match', metavar='GLOB',
+                        help="Run on every deployment whose name matches GLOB, e.g. 'prod-*'.")(func)
+    func = click.option('--all', 'all_deployments', is_flag=True,
+                        help='Run on every deployment.')(func)
+    return func
+
+
+def select_deployments(deployments_dir, all_deployments=False, match=None):
+    '''returns the names of the deployments (dirs with a config.yaml) to run on'''
+    names = sorted(d.name for d in Path(deployments_dir).glob('*')
+                   if d.joinpath('config.yaml').is_file())
+    if match:
+        names = [n for n in names if fnmatch.fnmatchcase(n, match)]
+    elif not all_deployments:
+        names = []
+    return names
+
+
+class AdaptiveLimiter():
+    """
+    Bounds how many deployments run at once. The limit starts at max_jobs, is halved each
+    time AWS throttles us, and grows back by one for every run that succeeds.
+    """
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.limit = max_jobs
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.limit = max(1, self.limit // 2)
+
+    def succeeded(self):
+        with self.condition:
+            self.limit = min(self.max_jobs, self.limit + 1)
+            self.condition.notify_all()
+
+
+class PrefixedWriter():
+    """
+    A file-like object that writes complete lines, prefixed with the deployment name, to a
+    shared stream. Keeps the last few lines so we can tell if a run was throttled.
+    """
+
+    def __init__(self, prefix, stream, lock, tail=50):
+        self.prefix = prefix
+        self.stream = stream
+        self.lock = lock
+        self.partial = ''
+        self.tail = deque(maxlen=tail)
+
+    def write(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.__write_line(line)
+        return len(text)
+
+    def flush(self):
+        if self.partial:
+            self.__write_line(self.partial)
+            self.partial = ''
+
+    def __write_line(self, line):
+        self.tail.append(line)
+        with self.lock:
+            self.stream.write(f"{self.prefix} {line}\n")
+            self.stream.flush()
+
+    @property
+    def throttled(self):
+        return any(marker in line for line in self.tail for marker in THROTTLE_MARKERS)
+
+
+class FleetResult():
+    '''the outcome of running an action on one deployment'''
+
+    def __init__(self, name):
+        self.name = name
+        self.status = 'pending'
+        self.returncode = None
+        self.attempts = 0
+        self.seconds = 0.0
+
+
+class Fleet():
+    """
+    Runs a terraform action (plan, deploy, destroy, prepare) on many deployments
+    concurrently. E.g.,
+        fleet = Fleet(deployments_dir, ['foo', 'bar'], jobs=4)
+        results = fleet.run('plan')
+        fleet.print_summary(results)
+
+    Each deployment is loaded in its own worker with its own resolved env (nothing is
+    shared through os.environ), runs unattended, and has its output prefixed with its name.
+    Runs that fail because AWS throttled us are retried with exponential backoff, and the
+    number of concurrent runs is reduced (see AdaptiveLimiter).
+
+    Required Attributes
+    ----------
+    deployments_dir: directory
+        The full path to the 'deployments' directory.
+    names: list
+        The names of the deployments to run on.
+
+    Methods
+    -------
+    run(self, action)
+        Runs the action on every deployment and returns a list of FleetResults.
+    print_summary(self, results)
+        Prints a status and wall time table.
+    """
+
+    def __init__(self, deployments_dir, names, jobs=4, retries=3, backoff=5.0, stream=None):
+        self.deployments_dir = Path(deployments_dir)
+        self.names = list(names)
+        self.jobs = jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.stream = sys.stdout if stream is None else stream
+        self.lock = threading.Lock()
+        self.limiter = AdaptiveLimiter(jobs)
+
+    def run(self, action):
+        '''runs action on every deployment (at most `jobs` at once) and returns the results'''
+        method = FLEET_ACTIONS[action]
+        width = max([len(n) for n in self.names] + [0])
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.run_one, name, method, f"[{name:<{width}}]")
+                       for name in self.names]
+            return [f.result() for f in futures]
+
+    def run_one(self, name, method, prefix):
+        '''runs method on one deployment, retrying with backoff when throttled'''
+        # imported here so `--help` and completion don't pay for it
+        from drone_deploy.deployment import Deployment
+
+        result = FleetResult(name)
+        output = PrefixedWriter(prefix, self.stream, self.lock)
+        start = time.monotonic()
+        try:
+            deployment = Deployment(self.deployments_dir.joinpath(name, 'config.yaml'))
+            deployment.terraform.output = output
+            deployment.terraform.automation = True
+            while True:
+                result.attempts += 1
+                output.tail.clear()
+                with self.limiter:
+                    result.returncode = getattr(deployment, method)()
+                output.flush()
+
+                if result.returncode == 0:
+                    self.limiter.succeeded()
+                    result.status = 'ok'
+                    break
+
+                if not output.throttled or result.attempts > self.retries:
+                    result.status = 'failed'
+                    break
+
+                # aws is throttling us, run fewer deployments at once and try again later
+                self.limiter.throttled()
+                delay = self.backoff * 2 ** (result.attempts - 1) * random.uniform(1, 1.5)
+                output.write(f"throttled by AWS, retrying in {delay:.0f}s...\n")
+                time.sleep(delay)
+        except Exception as e:
+            output.write(f"error: {e}\n")
+            output.flush()
+            result.status = 'error'
+
+        result.seconds = time.monotonic() - start
+        return result
+
+    def print_summary(self, results):
+        '''prints a table with the status and wall time of each deployment'''
+        width = max([len(r.name) for r in results] + [len('DEPLOYMENT')])
+        lines = [f"{'DEPLOYMENT':<{width}}  {'STATUS':<7}  {'TIME':>8}  ATTEMPTS"]
+        for r in results:
+            lines.append(f"{r.name:<{width}}  {r.status:<7}  {r.seconds:>7.1f}s  {r.attempts}")
+        with self.lock:
+            self.stream.write('\n' + '\n'.join(lines) + '\n')
+            self.stream.flush()
+
+
+def run_fleet_command(action, all_deployments, match, jobs, confirm=False):
+    '''
+    Runs a fleet action for a click command (plan/deploy/destroy/prepare --all/--match).
+    Exits with a non-zero status if any deployment failed.
+    '''
+    ctx = click.get_current_context()
+    deployments_dir = Path.cwd().joinpath('deployments')
+    names = select_deployments(deployments_dir, all_deployments, match)
+    if not names:
+        click.echo("No matching deployments found. "
+                   "Run 'drone-deploy list' to see available deployments.")
+        ctx.exit(1)
+
+    click.echo(f"Running {action} on {len(names)} deployment(s): {', '.join(names)}")
+    if confirm:
+        click.confirm(f"{action.capitalize()} will run unattended (auto-approved). Continue?",
+                      abort=True)
+
+    fleet = Fleet(deployments_dir, names, jobs=jobs)
+    results = fleet.run(action)
+    fleet.print_summary(results)
+    if any(r.status != 'ok' for r in results):
+        ctx.exit(1)
+    return results
@@ -1,12 +1,10 @@
-import os
 import sys
 import click
 import shutil
 import version
-import zipfile
-import requests
-import tempfile
 from pathlib import Path
+from drone_deploy.template_cache import (TemplateCache, TemplateError, embedded_templates,
+                                         extract_templates)
 
 
 def setup_deployments(path):
@@ -24,54 +22,49 @@ def copy_templates_from_repo(path):
     else:
         click.echo(click.style(f"\tfailed setting up the templates directory", fg='red'))
 
-    # pull templates from source (use a default repo unless overwritten via env vars)
-    # e.g. https://github.com/keithdadkins/drone-deploy/archive/0.1.16.zip
-    # the zip_base_path var is how the members are presented inside the zip file
-    # e.g., drone-deploy-0.1.16/templates/...
-    default_repo = 'https://github.com/keithdadkins/drone-deploy'
-    template_repo = os.getenv('DRONE_DEPLOY_TEMPLATES_REPO', default_repo)
-    templates_url = f"{template_repo}/archive/{version.__version__}.zip"
-    zip_base_path = f"drone-deploy-{version.__version__}"    
-    tempdir = tempfile.mkdtemp()
-    r = requests.get(templates_url, allow_redirects=True)
-    with tempfile.TemporaryFile() as tmp:
-        tmp.write(r.content)
-        try:
-            with zipfile.ZipFile(tmp) as file:
-                if file.testzip() is not None:
-                    click.echo(click.style(f"\ttemplate download was corrupted.. exiting",
-                                           fg='red'))
-                templates = [member for member in file.namelist()
-                             if member.startswith(f'{zip_base_path}/templates')]
-                file.extractall(path=tempdir, members=templates)
-        except Exception as e:
-            print(type(e))
-            print(e.args)
-            print(e)
-            click.echo(click.style(f"\terror getting templates... exiting.", fg='red'))
-            sys.exit()
-
-        # move files from tmp to templates
-        items = Path(tempdir).joinpath(zip_base_path, 'templates').glob('*')
-        for item in items:
-            shutil.move(str(item), path)
-
-    # cleanup
-    shutil.rmtree(tempdir)
-    click.echo(f"\tdownloaded templates to {path}")
+    # pull templates from source (use a default repo unless overwritten via env vars), e.g.
+    # https://github.com/keithdadkins/drone-deploy/archive/0.1.16.zip. The archive is cached
+    # per version, so only the first init (for each version) downloads it.
+    cache = TemplateCache(version.__version__)
+    try:
+        cached = cache.extract(path)
+    except TemplateError as e:
+        click.echo(click.style(f"\t{e}", fg='red'))
+        click.echo(click.style(f"\terror getting templates... exiting.", fg='red'))
+        sys.exit()
 
+    source = f"cached {cache.archive_file}" if cached else cache.url
+    click.echo(f"\tcopied templates from {source} to {path}")
 
-def setup_templates(path):
-    '''copy templates from releases or locally'''
-    # if we are running from a release exe, then get the templates from a repo
-    # else get them from the local source
+
+def copy_templates_from_release(path):
+    '''extracts the templates embedded in the release exe, returns False if there are none'''
+    archive = embedded_templates()
+    if archive is None:
+        return False
+    with archive:
+        extract_templates(archive, path)
+    click.echo(f"\tcopied templates (release {version.__version__}) to {path}")
+    return True
+
+
+def source_templates_dir():
+    '''returns the templates dir when running from source, else None'''
     if Path(__file__).name == 'init_cli.py':
-        # running from source
         templates_dir = Path(__file__).parent.parent.parent.joinpath('templates')
         if templates_dir.exists():
-            shutil.copytree(templates_dir, path)
+            return templates_dir
+    return None
+
+
+def setup_templates(path):
+    '''copy templates locally, from the release exe, or (failing both) from the repo'''
+    templates_dir = source_templates_dir()
+    if templates_dir is not None:
+        # running from source
+        shutil.copytree(templates_dir, path)
         click.echo(f"\tcopied templates to {path}")
-    else:
+    elif not copy_templates_from_release(path):
         copy_templates_from_repo(path)
 
 
@@ -109,7 +102,8 @@ def setup_init_item(item, path):
     switcher(path)
 
 
-@click.group(invoke_without_command=True, name="init")
+@click.group(invoke_without_command=True, name="init",
+             short_help="Initializes a 'deployments' working directory.")
 @click.argument('path', type=click.Path(file_okay=False, writable=True),
                 default=Path.cwd().joinpath('drone-deployments'))
 def init_dir(path):
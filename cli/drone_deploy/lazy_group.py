@@ -0,0 +1,81 @@
+import click
+from importlib import import_module
+
+
+class LazyGroup(click.Group):
+    """
+    A click group that registers sub commands by name from a static table and only imports
+    a sub command's module when that command is actually run. This keeps `drone-deploy`,
+    `drone-deploy version`, `--help`, and shell completion from importing ruamel.yaml,
+    requests, and the Deployment/Terraform/Packer classes.
+
+    Usage:
+        @click.group(cls=LazyGroup, lazy_commands={
+            'list': ('drone_deploy.list_cli', 'list_deployments', 'Lists deployments.'),
+        })
+        def cli():
+            pass
+
+    Required Attributes
+    ----------
+    lazy_commands: dict
+        Maps a command name to a (module, attribute, short help) tuple.
+
+    Optional Attributes
+    ----------
+    placeholders: dict
+        Maps a lazy command name to the command used in its place during shell completion,
+        e.g. one with just a deployment name argument, so its arguments still complete.
+
+    Methods
+    -------
+    list_commands(self, ctx)
+        Returns eager and lazy command names without importing anything.
+    get_command(self, ctx, name)
+        Imports and returns the named command. During shell completion (resilient parsing)
+        a lightweight placeholder is returned instead so nothing is imported.
+    format_commands(self, ctx, formatter)
+        Writes the 'Commands:' help section using the static short help.
+    """
+
+    def __init__(self, *args, lazy_commands=None, placeholders=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+        self.placeholders = placeholders or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(self.commands) | set(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        if name in self.commands or name not in self.lazy_commands:
+            return self.commands.get(name)
+
+        if ctx is not None and ctx.resilient_parsing:
+            # shell completion only needs names and help, so don't pay for the import
+            return self.placeholder_command(name)
+
+        module_name, attr, _ = self.lazy_commands[name]
+        command = getattr(import_module(module_name), attr)
+        self.add_command(command, name)
+        return command
+
+    def placeholder_command(self, name):
+        '''returns an unimported stand-in for a lazy command (used for completion).'''
+        if name in self.placeholders:
+            return self.placeholders[name]
+        return click.Command(name, short_help=self.lazy_commands[name][2])
+
+    def format_commands(self, ctx, formatter):
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.commands:
+                command = self.commands[name]
+                if command.hidden:
+                    continue
+                rows.append((name, command.get_short_help_str()))
+            else:
+                rows.append((name, self.lazy_commands[name][2]))
+
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
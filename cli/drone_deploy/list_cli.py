@@ -1,14 +1,58 @@
+import json
+import time
 import click
 from pathlib import Path
+from drone_deploy.filter import deployment_names
+
+
+def echo_summaries(summaries):
+    width = max([len(summary.name) for summary in summaries] + [len('NAME')])
+    click.echo(f"{'NAME':<{width}}  {'STATUS':<12}  {'AMI':<21}  {'SERIAL':>6}  "
+               f"{'APPLIED':<16}  CONFIG")
+    for summary in summaries:
+        applied = time.strftime('%Y-%m-%d %H:%M', time.localtime(summary.applied_at)) \
+            if summary.applied_at else '-'
+        serial = '-' if summary.serial is None else summary.serial
+        click.echo(f"{summary.name:<{width}}  "
+                   f"{'deployed' if summary.deployed else 'not deployed':<12}  "
+                   f"{summary.ami or '-':<21}  {serial:>6}  {applied:<16}  "
+                   f"{'changed' if summary.config_changed else '-'}")
+
+
+def summary_json(summary):
+    data = summary.as_dict()
+    if summary.applied_at:
+        data['applied_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(summary.applied_at))
+    return data
 
 
 # $> drone-deploy list
-@click.group(invoke_without_command=True, name="list")
-def list_deployments():
+@click.group(invoke_without_command=True, name="list", short_help='Lists deployments.')
+@click.option('--long', '-l', 'long_format', is_flag=True,
+              help='Show a status summary of each deployment.')
+@click.option('--format', 'output_format', type=click.Choice(['text', 'json']), default='text',
+              show_default=True, help='json always includes the status summaries.')
+@click.option('--jobs', '-j', default=8, show_default=True, type=click.IntRange(1),
+              help='Deployments to summarize at once.')
+def list_deployments(long_format, output_format, jobs):
     """
     Lists deployments.
+
+    With --long (or --format json), each deployment's status is summarized from its files,
+    without loading it: the AMI it's deployed with, whether it's deployed, the terraform
+    state's serial, when it was last applied, and whether config.yaml has changed since.
     """
-    deployment_dir = Path.cwd().joinpath('deployments').resolve()
-    for deployment in deployment_dir.glob("*"):
-        if deployment.is_dir():
-            click.echo(deployment.name)
+    names = deployment_names(Path.cwd())
+    if not long_format and output_format == 'text':
+        for name in names:
+            click.echo(name)
+        return
+
+    # imported here so the plain listing stays cheap
+    from drone_deploy.deployment_summary import summarize_all
+
+    summaries = summarize_all(Path.cwd().joinpath('deployments'), names, max_workers=jobs)
+    if output_format == 'json':
+        click.echo(json.dumps([summary_json(summary) for summary in summaries], indent=2))
+    else:
+        echo_summaries(summaries)
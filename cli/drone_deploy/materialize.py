@@ -0,0 +1,118 @@
+import os
+import stat
+import shutil
+from fnmatch import fnmatch
+from pathlib import Path
+
+# ioctl that clones a file's extents (a reflink), on btrfs, xfs, and other CoW filesystems
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    '''makes dst a copy-on-write clone of src, raises OSError if the filesystem can't'''
+    import fcntl
+
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.unlink(dst)
+            raise
+    shutil.copymode(src, dst)
+
+
+class Materializer():
+    """
+    Puts template files into deployments without copying their bytes when it can. Each file
+    is reflinked (a copy-on-write clone, so the deployment can edit it freely) where the
+    filesystem supports it, else copied. Archives (HARDLINK_PATTERNS, e.g. caddy.tar.gz)
+    can also be hardlinked: they're the bulk of the bytes, and are replaced rather than
+    edited in place. A hardlink shares its inode (and mode) with the template, so the
+    other files, which a deployment may edit, are never hardlinked. `unshare` gives a
+    hardlinked file its own copy. E.g.,
+        materializer = Materializer()
+        materializer.tree(templates.joinpath('packer'), deployment_dir.joinpath('packer'))
+        materializer.unshare(deployment_dir.joinpath('packer', 'drone-server-configs',
+                                                     'caddy.tar.gz'))
+
+    Methods that failed are remembered per (source, destination) device, so a filesystem
+    that can't reflink is only tried once.
+
+    Attributes
+    ----------
+    copy: bool
+        Always copy (e.g. `drone-deploy new --copy`).
+    counts: dict
+        The number of files reflinked, hardlinked, and copied.
+    """
+
+    METHODS = ('reflink', 'hardlink', 'copy')
+
+    # files that may be hardlinked (immutable blobs, never edited in place)
+    HARDLINK_PATTERNS = ('*.tar.gz', '*.tgz', '*.zip')
+
+    def __init__(self, copy=False):
+        self.copy = copy
+        self.unsupported = set()
+        self.counts = dict.fromkeys(self.METHODS, 0)
+
+    def methods(self, src):
+        '''the methods to try for src, in order'''
+        if self.copy:
+            return ['copy']
+        if any(fnmatch(Path(src).name, pattern) for pattern in self.HARDLINK_PATTERNS):
+            return list(self.METHODS)
+        return [method for method in self.METHODS if method != 'hardlink']
+
+    def file(self, src, dst):
+        '''materializes src at dst (which must not exist), returns the method used'''
+        devices = (os.stat(src).st_dev, os.stat(Path(dst).parent).st_dev)
+        for method in self.methods(src):
+            if (devices, method) in self.unsupported:
+                continue
+            try:
+                if method == 'reflink':
+                    reflink(src, dst)
+                elif method == 'hardlink':
+                    os.link(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+            except OSError:
+                if method == 'copy':
+                    raise
+                self.unsupported.add((devices, method))
+                continue
+            self.counts[method] += 1
+            return method
+
+    def tree(self, src_dir, dst_dir, pattern='**/*'):
+        '''materializes the files in src_dir matching pattern into dst_dir (like copytree)'''
+        src_dir, dst_dir = Path(src_dir), Path(dst_dir)
+        for src in sorted(src_dir.glob(pattern)):
+            if src.is_file():
+                dst = dst_dir.joinpath(src.relative_to(src_dir))
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                self.file(src, dst)
+
+    @staticmethod
+    def unshare(path):
+        '''
+        Gives a hardlinked file its own (writable) copy, so it can be edited without
+        changing the template. Does nothing to files that aren't shared.
+        '''
+        path = Path(path)
+        info = path.stat()
+        if info.st_nlink < 2:
+            return False
+        tmp_file = path.with_name(f".{path.name}.tmp")
+        shutil.copy2(path, tmp_file)
+        os.chmod(tmp_file, stat.S_IMODE(info.st_mode) | stat.S_IWUSR)
+        os.replace(tmp_file, path)
+        return True
+
+    def summary(self):
+        '''e.g. '12 hardlinked, 1 copied\''''
+        names = {'reflink': 'reflinked', 'hardlink': 'hardlinked', 'copy': 'copied'}
+        return ', '.join(f"{count} {names[method]}" for method, count in self.counts.items()
+                         if count)
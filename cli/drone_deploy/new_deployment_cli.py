@@ -1,6 +1,11 @@
 import click
 import shutil
+import secrets
 from pathlib import Path
+from ruamel.yaml import YAML
+from drone_deploy.materialize import Materializer
+from drone_deploy.plugin_cache import PluginCache
+from drone_deploy.template_cache import embedded_templates, extract_templates
 
 
 def create_deployment_dir_if_not_exists(name):
@@ -16,61 +21,184 @@ def create_deployment_dir_if_not_exists(name):
     return deployment_path.resolve()
 
 
-def copy_packer_templates_to(deployment_dir):
-    '''copy packer templates to deployment dir'''
-    template_path = Path.cwd().joinpath('templates', 'packer')
-    deployment_path = deployment_dir.joinpath('packer')
-    shutil.copytree(template_path, deployment_path)
-
-
-def copy_terraform_templates_to(deployment_dir):
-    '''copy terraform templates to new deployment folder'''
-    # copies /templates/terraform/*.tf* to /deployments/foo/terraform/
-    template_path = Path.cwd().joinpath('templates', 'terraform')
-    deployment_path = deployment_dir.joinpath('terraform')
-    for file in template_path.glob('*.tf*'):
-        shutil.copy(file, deployment_path)
-
-
-def copy_build_script_to(deployment_dir):
-    # copy the ami build script to the deployment directory
-    build_script = Path.cwd().joinpath('templates', 'build-drone-server-ami.sh').resolve()
-    shutil.copy(build_script, deployment_dir)
+def deployment_file(template):
+    '''
+    Returns where a template (a path relative to templates/) goes in a new deployment, or
+    None if it isn't part of one: templates/packer/**, templates/terraform/*.tf*,
+    build-drone-server-ami.sh, and config.yaml.
+    '''
+    parts = template.parts
+    if parts[0] == 'packer':
+        return template
+    if parts[0] == 'terraform' and len(parts) == 2 and '.tf' in template.name:
+        return template
+    if len(parts) == 1 and template.name in ('build-drone-server-ami.sh', 'config.yaml'):
+        return template
+    return None
+
+
+def deployment_templates(templates_dir):
+    '''
+    Returns [(template file, path in the deployment)] for the templates every new
+    deployment gets, except config.yaml (which is always copied, see generate_config_yaml).
+    '''
+    templates_dir = Path(templates_dir)
+    files = []
+    for path in sorted(templates_dir.rglob('*')):
+        if path.is_file():
+            relative = deployment_file(path.relative_to(templates_dir))
+            if relative is not None and relative != Path('config.yaml'):
+                files.append((path, relative))
+    return files
+
+
+def materialize_templates_to(deployment_dir, templates, materializer):
+    '''reflinks/hardlinks (or copies) the deployment_templates into the deployment dir'''
+    for template, relative in templates:
+        dst = deployment_dir.joinpath(relative)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        materializer.file(template, dst)
 
 
 def generate_config_yaml(deployment_dir):
     '''creates an empty config.yaml file in the deployments folder'''
+    # a real copy, drone-deploy rewrites it in place
     template_file = Path('templates/config.yaml')
     shutil.copy(template_file, deployment_dir)
 
+
+def set_config_values(deployment_dir, values):
+    '''sets values in a new deployment's config.yaml (keeping its comments)'''
+    config_file = deployment_dir.joinpath('config.yaml')
+    yaml = YAML()
+    config = yaml.load(config_file)
+    for key, value in values.items():
+        config[key] = value
+    with open(config_file, 'w') as file:
+        yaml.dump(config, file)
+
+
+def copy_release_templates_to(deployment_dir):
+    '''
+    Extracts the deployment's files straight from the templates embedded in the release
+    exe (used when there's no templates dir). Returns False if there are none.
+    '''
+    archive = embedded_templates()
+    if archive is None:
+        return False
+    with archive:
+        extract_templates(archive, deployment_dir, select=deployment_file)
+    return True
+
+
+def load_batch(batch_file):
+    '''
+    Returns [(name, config values)] from a batch file, e.g.
+        deployments:
+          - drone-a.acme.com
+          - name: drone-b.acme.com
+            config:
+              drone_aws_region: us-west-2
+    '''
+    spec = YAML(typ='safe').load(Path(batch_file)) or {}
+    deployments = []
+    for entry in spec.get('deployments') or []:
+        if isinstance(entry, str):
+            entry = {'name': entry}
+        if not entry.get('name'):
+            raise click.UsageError(f"Every deployment in {batch_file} needs a name.")
+        deployments.append((str(entry['name']), dict(entry.get('config') or {})))
+    return deployments
+
+
+def create_deployment(name, templates, materializer, config=None):
+    '''creates deployments/<name> from templates, returns its dir (or False if it exists)'''
+    deployment_dir = create_deployment_dir_if_not_exists(name)
+    if not deployment_dir:
+        return False
+
+    # copy our configs and generate the config.yaml file (from the templates dir, which
+    # may have been customized, or else the templates in the release exe)
+    if templates is not None:
+        materialize_templates_to(deployment_dir, templates, materializer)
+        generate_config_yaml(deployment_dir)
+    elif not copy_release_templates_to(deployment_dir):
+        shutil.rmtree(deployment_dir)
+        raise click.ClickException("Couldn't find the templates dir. "
+                                   "Run 'drone-deploy init' first.")
+    # a fixed rpc secret, so every run renders the same terraform vars (see
+    # Deployment.pin_rpc_secret)
+    set_config_values(deployment_dir, dict({'drone_rpc_secret': secrets.token_hex(16)},
+                                           **(config or {})))
+
+    # link in cached terraform providers so 'prepare' doesn't download them again
+    PluginCache(Path.cwd()).link_into(deployment_dir.joinpath('terraform'))
+    return deployment_dir
+
+
 # $> drone-deploy new
-@click.group(invoke_without_command=True, name="new")
-@click.argument('name')
-def new_deployment(name):
+@click.group(invoke_without_command=True, name="new",
+             short_help='Creates a new deployment in the deployments directory.')
+@click.argument('name', required=False)
+@click.option('--batch', 'batch_file', type=click.Path(exists=True, dir_okay=False),
+              help='Create every deployment listed in a yaml file.')
+@click.option('--copy', is_flag=True,
+              help='Copy the templates instead of reflinking or hardlinking them.')
+def new_deployment(name, batch_file, copy):
     """
     Creates a new deployment in the /deployments directory.
 
     Usage:
         `drone-deploy new NAME`
+        `drone-deploy new --batch deployments.yaml`
 
     Where NAME == a friendly name for your deployment.
 
+    Template files are reflinked into the deployment where the filesystem supports it,
+    else copied. Archives (e.g. caddy.tar.gz) may be hardlinked instead, the files a
+    deployment might edit never are. config.yaml is always a copy. Use --copy to copy
+    them all.
+
+    A batch file lists deployments by name, optionally with config.yaml values:
+
+    \b
+        deployments:
+          - drone-a.acme.com
+          - name: drone-b.acme.com
+            config:
+              drone_aws_region: us-west-2
+
     Example:
         `drone-deploy new drone.yourdomain.com`
     """
-    # create the deployment/$name directory
-    deployment_dir = create_deployment_dir_if_not_exists(name)
-    if not deployment_dir:
-        click.echo("Deployment with that name already exists.")
+    if batch_file:
+        if name:
+            raise click.UsageError("Use either NAME or --batch, not both.")
+        deployments = load_batch(batch_file)
+    elif name:
+        deployments = [(name, {})]
+    else:
+        raise click.UsageError("Missing argument 'NAME' (or use --batch).")
+
+    # the templates are only listed once, however many deployments are created
+    templates_dir = Path.cwd().joinpath('templates')
+    templates = deployment_templates(templates_dir) if templates_dir.exists() else None
+    materializer = Materializer(copy=copy)
+    created = []
+    for deployment_name, config in deployments:
+        deployment_dir = create_deployment(deployment_name, templates, materializer, config)
+        if not deployment_dir:
+            click.echo("Deployment with that name already exists." if not batch_file else
+                       f"Skipped {deployment_name}, a deployment with that name already exists.")
+            continue
+        created.append(deployment_name)
+        click.echo(f"Deployment created: {deployment_dir}")
+
+    if not created:
         return False
-
-    # copy our configs and generate the config.yaml file
-    copy_terraform_templates_to(deployment_dir)
-    copy_packer_templates_to(deployment_dir)
-    copy_build_script_to(deployment_dir)
-    generate_config_yaml(deployment_dir)
-
-    click.echo(f"Deployment created: {deployment_dir}")
+    if materializer.summary():
+        click.echo(f"Template files: {materializer.summary()}.")
+    name = created[0] if len(created) == 1 else '<name>'
     click.echo("Next steps:")
     click.echo(f"  - edit the config.yaml file ('drone-deploy edit {name}')")
     click.echo(f"  - run 'drone-deploy prepare {name}' to bootstrap the deployment.")
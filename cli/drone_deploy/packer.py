@@ -1,8 +1,24 @@
 import os
-import sys
 import json
-import subprocess
+import time
+import asyncio
+import shutil
+import hashlib
+import secrets
+import tempfile
 from pathlib import Path
+from drone_deploy import profiler
+from drone_deploy.files import write_if_changed
+from drone_deploy.payload import Payload
+from drone_deploy.process import run_process, arun_process, ProcessResult, LineSink
+from drone_deploy.packer_progress import BuildProgress, PHASES
+from drone_deploy.ami_history import AmiHistory, delete_images
+from drone_deploy.ami_regions import (parse_artifact_id, format_artifact_id, parse_regions,
+                                      copy_to_regions)
+
+
+class BuildError(Exception):
+    '''raised when an AMI build can't be started or its result can't be validated'''
 
 
 class Packer():
@@ -20,58 +36,259 @@ class Packer():
     Properties
     ----------
     packer_vars
-        Returns vars formatted for when calling packer via the cli. E.g. '-var foo=bar -var biz=baz'.
+        Returns the packer vars, e.g. {'drone_aws_region': 'us-east-1'}. Set it to a list of
+        (name, value) tuples.
+    env
+        The environment the build runs with (defaults to os.environ).
+    region
+        The deployment's region (drone_aws_region), where packer builds.
+    amis
+        {region: AMI id} for the last build, e.g. {'us-east-1': 'ami-0edf58c4682eddea0'}.
+        drone_server_ami is the AMI for the deployment's own region.
+    base_ami
+        The base AMI (OS updates, docker, compose, aws-cli image) the server AMI is built
+        on, from the last base build (base-manifest.json).
 
     Methods
     -------
-    __init__(self, working_dir, packer_vars=[])
+    __init__(self, working_dir, packer_vars=[], env=None)
         Sets up deployment specific settings
         working_dir and packer_vars are provided when a Deployment is instantiated.
     load_artifacts
         Attempts to get info from any previous builds (from packers manifest file).
-    build_ami
-        Builds the AMI for a deployment. 
-        All this currently does is run the `build-drone-server-ami.sh` bash script and
-        runs the load_artifacts method when complete to update build info.
+    select_server_ami
+        Picks drone_server_ami from the last build's AMIs for the current region.
+    write_var_file
+        Writes the packer vars the template declares to VAR_FILE (drone-deploy.vars.json),
+        only if they changed. Called before each build.
+    build_progress(self, template=None)
+        Returns a BuildProgress that shows the phases of a build as packer's machine-readable
+        output comes in, and writes their timings to TIMINGS (build-timings.json).
+    fingerprint(self, base_ami='')
+        Returns a hash of the packer dir, the packer vars, and the base AMI, saved in the
+        manifest's custom_data (build_fingerprint) by each build.
+    base_fingerprint
+        Returns a hash of the base template, its provisioning files and vars.
+    payload, base_payload
+        The provisioning files (PAYLOAD_DIRS, BASE_PAYLOAD_DIRS) as a single archive, cached
+        by content hash in <deployment>/.cache/packer-payload/.
+    assume_builder_role
+        Returns temporary credentials for the deployment's builder role (via boto3).
+    copy_to_regions(self, regions)
+        Copies the AMI to the regions that don't have it yet, all at once, and adds the
+        copies to the manifest.
+    history(self, in_use=())
+        Returns an AmiHistory of every AMI in the manifests (server and base builds).
+    gc_amis(self, keep, in_use=(), dry_run=False, session=None, endpoint_url=None)
+        Deletes all but the newest keep AMIs (and their snapshots) of each kind in each
+        region, except the current builds and in_use AMIs, and drops them from the manifests.
+    build_ami(self, force=False, regions=None, rebuild_base=False)
+        Builds the AMI for a deployment in two stages. The base AMI is built first, but only
+        if its fingerprint changed or it's older than drone_base_ami_max_age days (or
+        rebuild_base is True). The server AMI is then built on it: assumes the builder role,
+        runs `packer build` and checks the manifest is from this build, then runs the
+        load_artifacts method to update build info. Returns a ProcessResult (exit code,
+        duration, and output tails), or False if the build couldn't be run or validated. If
+        the fingerprint matches the last build's the existing AMI is kept and packer isn't
+        run (unless force is True). The AMI is then copied to any of regions it isn't in.
+    abuild(self, on_line=None, force=False, regions=None, rebuild_base=False)
+        asyncio version of build_ami, e.g. `await deployment.packer.abuild()`.
     """
 
-    def __init__(self, working_dir, packer_vars=[]):
+    PACKER_COMMAND = 'packer'
+    TEMPLATE = 'packer_build_drone_server_ami.json'
+    MANIFEST = 'manifest.json'
+
+    # the base AMI the server AMI is built on, and the days before it's rebuilt (to pick up
+    # OS updates) unless drone_base_ami_max_age is set
+    BASE_TEMPLATE = 'packer_build_drone_base_ami.json'
+    BASE_MANIFEST = 'base-manifest.json'
+    BASE_MAX_AGE = 30
+
+    # variables file passed to packer (with -var-file)
+    VAR_FILE = 'drone-deploy.vars.json'
+
+    # the timings of the last build (see packer_progress.BuildProgress), and its full output
+    TIMINGS = 'build-timings.json'
+    BASE_TIMINGS = 'base-build-timings.json'
+    BUILD_LOG = 'build.log'
+    BASE_BUILD_LOG = 'base-build.log'
+
+    # files in the packer dir that aren't build inputs (besides hidden files)
+    FINGERPRINT_EXCLUDE = (MANIFEST, BASE_MANIFEST, VAR_FILE, TIMINGS, BASE_TIMINGS, BUILD_LOG,
+                           BASE_BUILD_LOG)
+
+    # dirs of provisioning files uploaded to the builder's /tmp (as one archive). Each AMI
+    # only gets its own scripts (plus the shared build-scripts), so editing a server script
+    # doesn't change base_fingerprint and rebuild the base AMI.
+    PAYLOAD_DIRS = ('build-scripts', 'server-scripts', 'drone-server-configs')
+    BASE_PAYLOAD_DIRS = ('build-scripts', 'base-scripts', 'aws-cli')
+
+    def __init__(self, working_dir, packer_vars=[], env=None):
         self.working_dir = working_dir
         self.packer_vars = packer_vars
+        self.env = env
         self.load_artifacts()
+        self.load_base_artifacts()
 
     @property
     def packer_vars(self):
-        """Returns formatted vars ready for packer cmd ex. -var foo=bar -var biz=baz"""
-        output = ' '.join(["-var {0}={1}".format(k, v) for k, v in self.__packer_vars.items()])
-        return output
+        """Returns the packer vars as a dict (builds pass them in VAR_FILE, see write_var_file)"""
+        return dict(self.__packer_vars)
 
     @packer_vars.setter
     def packer_vars(self, packer_vars=[]):
         # unpacks packers vars (a list of tuples) into a dict
         self.__packer_vars = {k: v for k, v in packer_vars}
 
+    @property
+    def env(self):
+        return os.environ if self.__env is None else self.__env
+
+    @env.setter
+    def env(self, env):
+        self.__env = env
+
+    @property
+    def region(self):
+        return self.__packer_vars.get('drone_aws_region') or self.env.get('DRONE_AWS_REGION', '')
+
+    def declared_variables(self, template=None):
+        '''returns the names of the variables the packer template declares'''
+        try:
+            with open(self.working_dir.joinpath(template or self.TEMPLATE), "r") as read_file:
+                return set(json.load(read_file).get('variables', {}))
+        except (OSError, ValueError):
+            return set()
+
+    def variables(self, template=None):
+        '''returns the packer vars the template declares (what's written to VAR_FILE)'''
+        variables = {k: ','.join(v) if isinstance(v, (list, tuple)) else str(v)
+                     for k, v in self.__packer_vars.items() if v is not None}
+        if variables.get('drone_aws_region'):
+            variables.setdefault('aws_region', variables['drone_aws_region'])
+        if variables.get('drone_deployment_name'):
+            variables.setdefault('iam_instance_profile',
+                                 f"{variables['drone_deployment_name']}-builder")
+
+        declared = self.declared_variables(template)
+        return {k: v for k, v in variables.items() if k in declared}
+
+    def write_var_file(self):
+        '''
+        Writes the packer vars the template declares to VAR_FILE (only if they changed). Build
+        credentials and the deployment id are passed separately, see prepare_build.
+        '''
+        text = json.dumps(self.variables(), indent=2, sort_keys=True) + '\n'
+        return write_if_changed(self.working_dir.joinpath(self.VAR_FILE), text)
+
+    def fingerprint(self, base_ami=''):
+        '''
+        Returns a hash of the build inputs: the files in the packer dir (the template,
+        provisioning scripts, etc.), the packer vars, and the base AMI. Credentials and the
+        deployment id aren't included, they don't change what's built.
+        '''
+        key = hashlib.sha256(b'build-v1\0')
+        for file in sorted(self.working_dir.rglob('*')):
+            path = file.relative_to(self.working_dir)
+            if (any(part.startswith('.') for part in path.parts) or
+                    path.as_posix() in self.FINGERPRINT_EXCLUDE or not file.is_file()):
+                continue
+            key.update(f"{path.as_posix()}\0".encode())
+            key.update(hashlib.sha256(file.read_bytes()).digest())
+        for name, value in sorted(self.variables().items()):
+            key.update(f"-var {name}={value}\0".encode())
+        if base_ami:
+            key.update(f"base_ami={base_ami}\0".encode())
+        return key.hexdigest()
+
+    def base_fingerprint(self):
+        '''returns a hash of the base AMI's inputs: its template, payload, and packer vars'''
+        key = hashlib.sha256(b'base-v1\0')
+        key.update(self.working_dir.joinpath(self.BASE_TEMPLATE).read_bytes())
+        key.update(f"\0payload={self.base_payload.key()}\0".encode())
+        for name, value in sorted(self.variables(self.BASE_TEMPLATE).items()):
+            key.update(f"-var {name}={value}\0".encode())
+        return key.hexdigest()
+
+    def is_current(self, base_ami=''):
+        '''returns True if the last build's AMI was built from the current inputs'''
+        return bool(self.drone_server_ami and self.build_fingerprint and
+                    self.build_fingerprint == self.fingerprint(base_ami))
+
+    @property
+    def uses_base_ami(self):
+        '''True if the template builds on a base AMI (deployments made before don't)'''
+        return 'base_ami' in self.declared_variables()
+
+    @property
+    def base_max_age(self):
+        '''days before the base AMI is rebuilt'''
+        try:
+            return float(self.__packer_vars.get('drone_base_ami_max_age') or self.BASE_MAX_AGE)
+        except ValueError:
+            return self.BASE_MAX_AGE
+
+    def base_age(self):
+        '''days since the base AMI was built'''
+        return (time.time() - self.base_build_time) / 86400
+
+    def base_is_current(self):
+        '''returns True if the base AMI was built from the current inputs and isn't too old'''
+        return bool(self.base_ami and self.base_build_fingerprint and
+                    self.base_build_fingerprint == self.base_fingerprint() and
+                    self.base_age() < self.base_max_age)
+
+    def current_base_ami(self, rebuild=False):
+        '''
+        Returns the base AMI to build on: drone_server_base_ami if it's set, else the last
+        base build unless it's out of date (or rebuild is True). Returns '' if the base AMI
+        needs to be built.
+        '''
+        configured = self.__packer_vars.get('drone_server_base_ami')
+        if configured:
+            print(f"Building on drone_server_base_ami ({configured}).")
+            return configured
+        if rebuild or not self.base_is_current():
+            return ''
+        print(f"Building on base AMI {self.base_ami} (built {self.base_age():.1f} days ago, "
+              f"rebuilt when its files change or after {self.base_max_age:g} days).")
+        return self.base_ami
+
+    def reuse_ami(self):
+        '''prints that the existing AMI is being kept, returns an (empty) successful result'''
+        print(f"{self.drone_server_ami} was built from the current packer files and vars, so "
+              "it was not rebuilt (use --force to build anyway).")
+        return ProcessResult('build', 0, 0.0)
+
     def load_artifacts(self):
         '''loads build artifacts as attributes from manfiest.json file'''
         # try to load manifest file
         try:
-            manifest_file = self.working_dir.joinpath('manifest.json').resolve()
+            manifest_file = self.working_dir.joinpath(self.MANIFEST).resolve()
             with open(manifest_file, "r") as read_file:
                 self.manifest = json.load(read_file)
             self.new_build = False
             
-            # artifact_id = region:ami (us-east-1:ami-adfsdf23423443)
-            build = self.manifest["builds"][0]["artifact_id"].split(':')
-            self.drone_server_ami = build[1]
+            # packer appends each build to the manifest, the last one is the current build
+            # artifact_id = region:ami[,region:ami...] (us-east-1:ami-adfsdf23423443)
+            self.amis = parse_artifact_id(self.manifest["builds"][-1]["artifact_id"])
+            self.select_server_ami()
 
             # drone_deploy_id
-            deploy_id = self.manifest["builds"][0]["custom_data"]["drone_deployment_id"]
+            deploy_id = self.manifest["builds"][-1]["custom_data"]["drone_deployment_id"]
             self.drone_deployment_id = deploy_id
 
+            # fingerprint of the build inputs (missing for builds made before it was recorded)
+            custom_data = self.manifest["builds"][-1]["custom_data"]
+            self.build_fingerprint = custom_data.get("build_fingerprint", '')
+
         except FileNotFoundError:
             self.new_build = True
             self.drone_deployment_id = ''
             self.drone_server_ami = ''
+            self.amis = {}
+            self.build_fingerprint = ''
             pass
 
         except json.decoder.JSONDecodeError as e:
@@ -83,28 +300,279 @@ class Packer():
             print(e)
             return e
 
-    def build_ami(self):
-        '''Builds the ami for the deployment.'''
-        # Just run the build-drone-server-ami.sh script
-        # TODO: bring this all into python, or refactor build script to only accept
-        # command line args instead of env vars.
+    def select_server_ami(self):
+        '''sets drone_server_ami to the last build's AMI for the deployment's region'''
+        if self.amis:
+            self.drone_server_ami = self.amis.get(self.region) or next(iter(self.amis.values()))
 
-        # run the build script in the deployment directory
-        build_dir = Path(self.working_dir.parent.resolve())
-        command = "./build-drone-server-ami.sh -p"
+    def load_base_artifacts(self):
+        '''loads the last base AMI build from base-manifest.json (no base AMI if it's invalid)'''
+        self.base_ami = ''
+        self.base_build_time = 0
+        self.base_build_fingerprint = ''
         try:
-            p = subprocess.Popen(command, stderr=subprocess.PIPE, shell=True, text=True,
-                                 cwd=build_dir, env=os.environ)
-            while True:
-                out = p.stderr.read(1)
-                if out == '' and p.poll() is not None:
-                    break
-                if out != '':
-                    sys.stdout.write(out)
-                    sys.stdout.flush()
-
-            # update the manifest
-            self.load_artifacts()
+            with open(self.working_dir.joinpath(self.BASE_MANIFEST), "r") as read_file:
+                build = json.load(read_file)["builds"][-1]
+            amis = parse_artifact_id(build["artifact_id"])
+            self.base_ami = amis.get(self.region) or next(iter(amis.values()), '')
+            self.base_build_time = build.get("build_time", 0)
+            self.base_build_fingerprint = build.get("custom_data", {}).get("base_fingerprint", '')
+        except (OSError, ValueError, KeyError, IndexError, TypeError, AttributeError):
+            pass
+
+    def assume_builder_role(self, endpoint_url=None):
+        '''
+        Assumes the IAM role packer builds with and returns its temporary credentials as packer
+        vars. Uses AWS_PROFILE if set, else the access keys in the environment (or boto3's
+        default credential chain). endpoint_url sends the sts call somewhere else (e.g. a
+        local AWS stand-in).
+        '''
+        import boto3
+
+        env = self.env
+        role_arn = env.get('DRONE_BUILDER_ROLE_ARN')
+        if not role_arn:
+            raise BuildError("The builder role hasn't been created yet. "
+                             "Run 'drone-deploy prepare' first.")
+        if env.get('AWS_PROFILE'):
+            session = boto3.Session(profile_name=env['AWS_PROFILE'])
+        else:
+            session = boto3.Session(aws_access_key_id=env.get('AWS_ACCESS_KEY_ID') or None,
+                                    aws_secret_access_key=env.get('AWS_SECRET_ACCESS_KEY') or None)
+        sts = session.client('sts', region_name=self.region or None, endpoint_url=endpoint_url)
+        response = sts.assume_role(RoleArn=role_arn,
+                                   RoleSessionName=f"{env.get('DRONE_DEPLOYMENT_NAME')}-builder")
+        credentials = response['Credentials']
+        return {'aws_access_key': credentials['AccessKeyId'],
+                'aws_secret_key': credentials['SecretAccessKey'],
+                'aws_session_token': credentials['SessionToken']}
+
+    @property
+    def payload(self):
+        cache_dir = self.working_dir.parent.joinpath('.cache', 'packer-payload', 'server')
+        return Payload(self.working_dir, self.PAYLOAD_DIRS, cache_dir)
+
+    @property
+    def base_payload(self):
+        cache_dir = self.working_dir.parent.joinpath('.cache', 'packer-payload', 'base')
+        return Payload(self.working_dir, self.BASE_PAYLOAD_DIRS, cache_dir)
+
+    def builder_session(self, endpoint_url=None):
+        '''returns a boto3 session with the builder role's credentials (see assume_builder_role)'''
+        import boto3
+
+        credentials = self.assume_builder_role(endpoint_url=endpoint_url)
+        return boto3.Session(aws_access_key_id=credentials['aws_access_key'],
+                             aws_secret_access_key=credentials['aws_secret_key'],
+                             aws_session_token=credentials['aws_session_token'])
+
+    def deployment_id(self):
+        '''returns DRONE_DEPLOYMENT_ID, or a new 32 character id for a first build'''
+        deployment_id = self.env.get('DRONE_DEPLOYMENT_ID')
+        if deployment_id:
+            print(f"Using {deployment_id}.")
+        else:
+            deployment_id = secrets.token_hex(16)
+            print(f"Generating unique drone-deployment-id: {deployment_id}")
+        return deployment_id
+
+    def prepare_build(self, build_vars_dir, template=None, base_ami=''):
+        '''
+        Writes the var files for a build of template (the server AMI by default, or
+        BASE_TEMPLATE) and returns the packer command. The builder credentials and deployment
+        id go in a second var file in build_vars_dir (a private temporary dir) so they're
+        never on packer's command line.
+        '''
+        template = template or self.TEMPLATE
+        packer = shutil.which(self.PACKER_COMMAND, path=self.env.get('PATH'))
+        if packer is None:
+            raise BuildError(f"Couldn't find '{self.PACKER_COMMAND}'. "
+                             "Install packer (https://www.packer.io/downloads.html) and retry.")
+        declared = self.declared_variables(template)
+        build_vars = self.assume_builder_role()
+        if template == self.BASE_TEMPLATE:
+            # the base is the same for every deployment, it only gets the vars it declares
+            build_vars.update(self.variables(template))
+            build_vars['base_fingerprint'] = self.base_fingerprint()
+            build_vars['payload_archive'] = str(self.base_payload.archive())
+            var_files = []
+        else:
+            self.write_var_file()
+            build_vars['drone_deployment_uuid'] = self.deployment_id()
+            if 'build_fingerprint' in declared:
+                build_vars['build_fingerprint'] = self.fingerprint(base_ami)
+            if 'payload_archive' in declared:
+                build_vars['payload_archive'] = str(self.payload.archive())
+            if 'base_ami' in declared:
+                build_vars['base_ami'] = base_ami
+            var_files = [f"-var-file={self.VAR_FILE}"]
+
+        build_vars = {k: v for k, v in build_vars.items() if k in declared}
+        build_var_file = Path(build_vars_dir).joinpath('build.vars.json')
+        write_if_changed(build_var_file, json.dumps(build_vars))
+        return ([packer, 'build', '-machine-readable'] + var_files +
+                [f"-var-file={build_var_file}", template])
+
+    def validate_manifest(self, manifest=None):
+        '''
+        Returns the AMI id of the last build in manifest.json (or manifest), making sure the
+        manifest was written by that build (its last_run_uuid matches the build's
+        packer_run_uuid).
+        '''
+        manifest = manifest or self.MANIFEST
+        try:
+            with open(self.working_dir.joinpath(manifest), 'r') as read_file:
+                data = json.load(read_file)
+            build = data['builds'][-1]
+            if data.get('last_run_uuid') != build.get('packer_run_uuid'):
+                raise BuildError(f"packer/{manifest}'s last_run_uuid and packer_run_uuid "
+                                 "should match.")
+            amis = parse_artifact_id(build['artifact_id'])
+            return amis.get(self.region) or next(iter(amis.values()))
+        except (OSError, ValueError, KeyError, IndexError, AttributeError, StopIteration) as e:
+            raise BuildError(f"Couldn't read the AMI id from packer/{manifest} ({e}).")
+
+    def finish_build(self, result, template=None):
+        '''checks a packer build succeeded and produced a valid manifest, returns the AMI id'''
+        if not result.ok:
+            raise BuildError(f"packer build failed (exit code {result.returncode}).")
+        base = template == self.BASE_TEMPLATE
+        ami_id = self.validate_manifest(self.BASE_MANIFEST if base else self.MANIFEST)
+        print(f"Built {'base AMI ' if base else ''}{ami_id}.")
+        return ami_id
+
+    def build_progress(self, template=None, stream=None):
+        '''returns a BuildProgress for a build of template, logging to BUILD_LOG'''
+        base = template == self.BASE_TEMPLATE
+        log = self.working_dir.joinpath(self.BASE_BUILD_LOG if base else self.BUILD_LOG)
+        return BuildProgress(template or self.TEMPLATE, stream=stream, log=log)
+
+    def write_timings(self, progress, result, template=None, base_ami=''):
+        '''writes the timings of a build (failed ones too) to TIMINGS or BASE_TIMINGS'''
+        base = template == self.BASE_TEMPLATE
+        fingerprint = self.base_fingerprint() if base else self.fingerprint(base_ami)
+        return progress.write_report(self.working_dir.joinpath(self.BASE_TIMINGS if base
+                                                               else self.TIMINGS),
+                                     ok=result.ok, fingerprint=fingerprint)
+
+    def profiler_sinks(self):
+        '''a sink that splits the build's profiler span into its phases (when profiling)'''
+        phases = profiler.phase_sink(PHASES)
+        return [] if phases is None else [phases]
+
+    def run_build(self, template=None, base_ami=''):
+        '''runs packer build for template, returns (ProcessResult, AMI id)'''
+        if template == self.BASE_TEMPLATE:
+            print("Building the base AMI (OS updates, docker, compose, and the aws-cli image)...")
+        progress = self.build_progress(template)
+        with tempfile.TemporaryDirectory(prefix='drone-deploy-') as build_vars_dir:
+            argv = self.prepare_build(build_vars_dir, template, base_ami)
+            result = run_process(argv, cwd=self.working_dir, env=self.env, shell=False,
+                                 sinks=[LineSink(progress.feed)] + self.profiler_sinks())
+        self.write_timings(progress, result, template, base_ami)
+        return result, self.finish_build(result, template)
+
+    async def arun_build(self, template=None, base_ami='', on_line=None):
+        '''asyncio version of run_build'''
+        if template == self.BASE_TEMPLATE:
+            print("Building the base AMI (OS updates, docker, compose, and the aws-cli image)...")
+        # the progress view (rather than packer's raw output) goes to on_line
+        stream = _LineWriter(on_line) if on_line is not None else None
+        progress = self.build_progress(template, stream)
+        loop = asyncio.get_running_loop()
+        with tempfile.TemporaryDirectory(prefix='drone-deploy-') as build_vars_dir:
+            # assuming the role is a blocking boto3 call
+            argv = await loop.run_in_executor(None, self.prepare_build, build_vars_dir,
+                                              template, base_ami)
+            result = await arun_process(argv, cwd=self.working_dir, env=self.env,
+                                        sinks=self.profiler_sinks(), on_line=progress.feed)
+        self.write_timings(progress, result, template, base_ami)
+        return result, self.finish_build(result, template)
+
+    def save_amis(self, amis):
+        '''adds {region: AMI id} to the last build in manifest.json (as packer would)'''
+        manifest_file = self.working_dir.joinpath('manifest.json')
+        with open(manifest_file, 'r') as read_file:
+            manifest = json.load(read_file)
+        build = manifest['builds'][-1]
+        build['artifact_id'] = format_artifact_id({**parse_artifact_id(build['artifact_id']),
+                                                   **amis})
+        write_if_changed(manifest_file, json.dumps(manifest, indent=2) + '\n', mode=0o644)
+        self.load_artifacts()
+
+    def copy_to_regions(self, regions):
+        '''
+        Copies the last build's AMI to each of regions that doesn't have it yet, all at once,
+        and saves the copies in the manifest. Returns {region: AMI id} for the new copies.
+        '''
+        missing = [region for region in parse_regions(regions) if region not in self.amis]
+        if not missing:
+            return {}
+        if not self.amis:
+            raise BuildError("There's no AMI to copy yet, build one first.")
+        source_region = self.region if self.region in self.amis else next(iter(self.amis))
+        source_ami = self.amis[source_region]
+        print(f"Copying {source_ami} from {source_region} to {', '.join(missing)}...")
+        amis, errors = copy_to_regions(self.builder_session(), source_region, source_ami,
+                                       missing)
+        if amis:
+            self.save_amis(amis)
+        if errors:
+            raise BuildError("Couldn't copy the AMI to " +
+                             ', '.join(f"{region} ({error})" for region, error in errors.items()))
+        return amis
+
+    def history(self, in_use=()):
+        '''returns an AmiHistory of the server and base builds in the manifests'''
+        return AmiHistory(self.working_dir, {'server': self.MANIFEST, 'base': self.BASE_MANIFEST},
+                          in_use)
+
+    def gc_amis(self, keep, in_use=(), dry_run=False, session=None, endpoint_url=None):
+        '''
+        Deregisters the AMIs AmiHistory.garbage(keep) returns and deletes their snapshots,
+        then removes them from the manifests. session (the builder role's by default) and
+        endpoint_url can point the sts and ec2 calls somewhere else, e.g. a local AWS
+        stand-in.
+        Returns the AmiBuilds that were (or, with dry_run, would be) deleted.
+        '''
+        history = self.history(in_use)
+        garbage = history.garbage(keep)
+        if dry_run or not garbage:
+            return garbage
+        session = session or self.builder_session(endpoint_url=endpoint_url)
+        deleted, errors = delete_images(session, garbage, endpoint_url=endpoint_url)
+        history.remove(deleted)
+        self.load_artifacts()
+        self.load_base_artifacts()
+        if errors:
+            raise BuildError("Couldn't delete " +
+                             ', '.join(f"{ami} ({error})" for ami, error in errors.items()))
+        return [build for build in garbage if build.ami in deleted]
+
+    def build_ami(self, force=False, regions=None, rebuild_base=False):
+        '''
+        Builds the ami for the deployment (unless it's already built from the same inputs) and
+        copies it to regions. The base AMI is built first if it's out of date.
+        '''
+        try:
+            base_ami = ''
+            if self.uses_base_ami:
+                base_ami = self.current_base_ami(rebuild_base)
+                if not base_ami:
+                    try:
+                        _, base_ami = self.run_build(self.BASE_TEMPLATE)
+                    finally:
+                        self.load_base_artifacts()
+
+            if not force and self.is_current(base_ami):
+                result = self.reuse_ami()
+            else:
+                result, _ = self.run_build(self.TEMPLATE, base_ami)
+
+                # update the manifest
+                self.load_artifacts()
+            self.copy_to_regions(regions)
+            return result
 
         except Exception as e:
             self.load_artifacts()
@@ -112,3 +580,43 @@ class Packer():
             print(e.args)
             print(e)
             return False
+
+    async def abuild(self, on_line=None, force=False, regions=None, rebuild_base=False):
+        '''
+        Builds the ami for the deployment without blocking the event loop. on_line(name, line)
+        is called with each line of output. SIGINT/SIGTERM are forwarded to packer.
+        '''
+        base_ami = ''
+        if self.uses_base_ami:
+            base_ami = self.current_base_ami(rebuild_base)
+            if not base_ami:
+                try:
+                    _, base_ami = await self.arun_build(self.BASE_TEMPLATE, on_line=on_line)
+                finally:
+                    self.load_base_artifacts()
+
+        if not force and self.is_current(base_ami):
+            result = self.reuse_ami()
+        else:
+            try:
+                result, _ = await self.arun_build(self.TEMPLATE, base_ami, on_line)
+            finally:
+                self.load_artifacts()
+        # copies are boto3 calls and waits too
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.copy_to_regions, regions)
+        return result
+
+
+class _LineWriter():
+    '''a minimal stream that passes each line written to it to on_line('stdout', line)'''
+
+    def __init__(self, on_line):
+        self.on_line = on_line
+
+    def write(self, text):
+        for line in text.rstrip('\n').split('\n'):
+            self.on_line('stdout', line)
+
+    def flush(self):
+        pass
@@ -0,0 +1,170 @@
+import re
+import sys
+import json
+from pathlib import Path
+from drone_deploy.files import write_if_changed
+
+# (pattern, phase) for the packer amazon-ebs messages that start each phase of a build. The
+# first group of a pattern, if any, is added to the phase name.
+PHASES = [
+    (re.compile(r'Prevalidating'), 'prevalidate'),
+    (re.compile(r'Launching a source AWS instance'), 'launch instance'),
+    (re.compile(r'Waiting for SSH to become available'), 'wait for SSH'),
+    (re.compile(r'Uploading (\S+) =>'), 'upload'),
+    (re.compile(r'Provisioning with shell script'), 'shell provisioner'),
+    (re.compile(r'Stopping the source instance'), 'stop instance'),
+    (re.compile(r'Creating (?:the )?AMI'), 'create AMI'),
+    (re.compile(r'Copying AMI'), 'copy AMI'),
+    (re.compile(r'Terminating the source AWS instance'), 'terminate instance'),
+    (re.compile(r'Running post-processor: (\S+)'), 'post-processor'),
+]
+
+# the summary provision.sh prints when each of its steps finishes
+STEP_RESULT = re.compile(r'^\[(\w+)\] (ok|failed) in (\d+(?:\.\d+)?)s$')
+
+# the builder name packer puts in front of ui messages, e.g. '==> amazon-ebs: '
+BUILDER_PREFIX = re.compile(r'^(?:==> )?\s*[\w.-]+: ')
+
+
+def parse_machine_readable(line):
+    '''
+    Returns (timestamp, target, type, [data]) for a line of `packer -machine-readable`
+    output, or None if it isn't one. E.g.,
+        1571323872,amazon-ebs,ui,say,==> amazon-ebs: Launching a source AWS instance...
+    Packer escapes commas in the data as %!(PACKER_COMMA) and newlines as \\n.
+    '''
+    fields = line.rstrip('\r').split(',')
+    if len(fields) < 3 or not fields[0].isdigit():
+        return None
+    data = [field.replace('%!(PACKER_COMMA)', ',').replace('\\n', '\n').replace('\\r', '\r')
+            for field in fields[3:]]
+    return int(fields[0]), fields[1], fields[2], data
+
+
+class BuildProgress():
+    """
+    Turns `packer -machine-readable build` output into a compact progress view (one line per
+    phase of the build, and one per provision.sh step) and a timing report. Every ui message
+    is written to log, so the full output is still there when a build fails. E.g.,
+        progress = BuildProgress('packer_build_drone_server_ami.json', log='build.log')
+        run_process(argv, sinks=[LineSink(progress.feed)])
+        progress.write_report('build-timings.json', ok=result.ok)
+
+    prints
+        [  0:00] prevalidate
+        [  0:02] launch instance
+        [  0:31] wait for SSH
+        ...
+    """
+
+    def __init__(self, template, stream=None, log=None):
+        self.template = template
+        self.stream = sys.stdout if stream is None else stream
+        self.log = Path(log) if log else None
+        self.log_file = None
+        self.started = None
+        self.last = None
+        self.phases = []
+        self.steps = []
+        self.counts = {}
+
+    def write(self, text):
+        self.stream.write(text + '\n')
+        self.stream.flush()
+
+    def elapsed(self, timestamp):
+        minutes, seconds = divmod(timestamp - self.started, 60)
+        return f"[{minutes:>3}:{seconds:02}]"
+
+    def feed(self, name, line):
+        '''handles a line of packer output (name is 'stdout' or 'stderr'), e.g. from a LineSink'''
+        event = parse_machine_readable(line)
+        if event is None:
+            # packer's own errors (e.g. a bad template) aren't machine-readable
+            if line.strip():
+                self.write(line)
+            return
+        timestamp, _, kind, data = event
+        if self.started is None:
+            self.started = timestamp
+        self.last = timestamp
+        if kind == 'ui' and len(data) >= 2:
+            self.message(timestamp, data[0], data[1])
+
+    def message(self, timestamp, level, text):
+        if self.log is not None:
+            if self.log_file is None:
+                self.log_file = open(self.log, 'w')
+            self.log_file.write(text + '\n')
+
+        for line in text.split('\n'):
+            # output from the builder (e.g. apt warnings on stderr) is indented, packer's isn't
+            remote = line.startswith(' ')
+            line = BUILDER_PREFIX.sub('', line).strip()
+            if level == 'error' and not remote:
+                self.write(f"{self.elapsed(timestamp)} error: {line}")
+            elif level == 'say':
+                self.start_phase(timestamp, line)
+            elif remote:
+                step = STEP_RESULT.match(line)
+                if step:
+                    name, status, seconds = step.groups()
+                    self.steps.append({'name': name, 'status': status, 'duration': float(seconds)})
+                    self.write(f"{self.elapsed(timestamp)}   {name} {status} in {seconds}s")
+
+    def start_phase(self, timestamp, text):
+        for pattern, phase in PHASES:
+            match = pattern.search(text)
+            if match:
+                break
+        else:
+            return
+        # number the phases that can happen more than once, e.g. 'shell provisioner 2'
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+        if match.groups():
+            phase = f"{phase} {match.group(1)}"
+        elif phase in ('shell provisioner', 'copy AMI'):
+            phase = f"{phase} {self.counts[phase]}"
+        self.end_phase(timestamp)
+        self.phases.append({'name': phase, 'start': timestamp - self.started, 'duration': None})
+        self.write(f"{self.elapsed(timestamp)} {phase}")
+
+    def end_phase(self, timestamp):
+        if self.phases and self.phases[-1]['duration'] is None:
+            self.phases[-1]['duration'] = timestamp - self.started - self.phases[-1]['start']
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def slowest(self, count=3):
+        return sorted(self.phases, key=lambda phase: -(phase['duration'] or 0))[:count]
+
+    def report(self, ok=True, fingerprint=''):
+        '''returns the timings of the build (in seconds), with the 3 slowest phases in `slowest`'''
+        if self.last is not None:
+            self.end_phase(self.last)
+        duration = self.last - self.started if self.started is not None else 0
+        return {
+            'template': self.template,
+            'fingerprint': fingerprint,
+            'ok': ok,
+            'started': self.started,
+            'duration': duration,
+            'phases': self.phases,
+            'steps': self.steps,
+            'slowest': [phase['name'] for phase in self.slowest()],
+        }
+
+    def write_report(self, path, ok=True, fingerprint=''):
+        '''closes the log, writes the report to path (as json), and prints a summary'''
+        self.close()
+        report = self.report(ok, fingerprint)
+        write_if_changed(path, json.dumps(report, indent=2) + '\n', mode=0o644)
+        minutes, seconds = divmod(report['duration'], 60)
+        slowest = ', '.join(f"{phase['name']} {phase['duration']}s" for phase in self.slowest())
+        self.write(f"packer {'finished' if ok else 'failed'} in {minutes}m{seconds:02}s"
+                   f"{f' (slowest: {slowest})' if slowest else ''}. Timings are in {path}"
+                   f"{f', the full output is in {self.log}' if self.log else ''}.")
+        return report
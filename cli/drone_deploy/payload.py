@@ -0,0 +1,84 @@
+import io
+import gzip
+import hashlib
+import tarfile
+from pathlib import Path
+
+
+def payload_files(packer_dir, dirs):
+    '''
+    Returns [(name in the archive, path)] for every file in dirs (relative to packer_dir),
+    sorted. Files are flattened into the root of the archive, e.g. build-scripts/cleanup.sh
+    becomes cleanup.sh, as they were when uploaded one at a time to /tmp.
+    '''
+    files = {}
+    for directory in dirs:
+        for path in sorted(Path(packer_dir).joinpath(directory).rglob('*')):
+            if path.is_file() and not path.name.startswith('.'):
+                if path.name in files:
+                    raise ValueError(f"{path} and {files[path.name]} would both be unpacked "
+                                     f"to /tmp/{path.name}.")
+                files[path.name] = path
+    return sorted(files.items())
+
+
+def file_mode(name):
+    return 0o755 if name.endswith('.sh') else 0o644
+
+
+class Payload():
+    """
+    The provisioning files for a packer build, packed into a single .tar.gz so they're
+    uploaded to the builder in one transfer instead of one per file. The archive is stored
+    under a hash of its contents, so it's only rebuilt when a file changes. E.g.,
+        payload = Payload(packer_dir, ['build-scripts', 'base-scripts', 'aws-cli'], cache_dir)
+        archive = payload.archive()     # <cache_dir>/<hash>.tar.gz
+
+    Archives are reproducible (sorted entries, fixed owners, modes and times), so the same
+    files always give the same bytes.
+    """
+
+    def __init__(self, packer_dir, dirs, cache_dir):
+        self.packer_dir = Path(packer_dir)
+        self.dirs = dirs
+        self.cache_dir = Path(cache_dir)
+
+    def files(self):
+        return payload_files(self.packer_dir, self.dirs)
+
+    def key(self, files=None):
+        '''returns the hash of the names, modes, and contents of the payload files'''
+        key = hashlib.sha256(b'payload-v1\0')
+        for name, path in files or self.files():
+            key.update(f"{name}\0{file_mode(name):o}\0".encode())
+            key.update(hashlib.sha256(path.read_bytes()).digest())
+        return key.hexdigest()
+
+    def archive(self):
+        '''returns the path of the archive, building it if the payload files have changed'''
+        files = self.files()
+        archive = self.cache_dir.joinpath(f"{self.key(files)}.tar.gz")
+        if archive.is_file():
+            return archive
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        data = io.BytesIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=data, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode='w', format=tarfile.PAX_FORMAT) as tar:
+                for name, path in files:
+                    info = tarfile.TarInfo(name)
+                    info.size = path.stat().st_size
+                    info.mode = file_mode(name)
+                    info.uname = info.gname = 'root'
+                    with open(path, 'rb') as file:
+                        tar.addfile(info, file)
+
+        tmp_file = archive.with_suffix('.tmp')
+        tmp_file.write_bytes(data.getvalue())
+        tmp_file.replace(archive)
+
+        # only the current payload is kept
+        for old in self.cache_dir.glob('*.tar.gz'):
+            if old != archive:
+                old.unlink()
+        return archive
@@ -0,0 +1,91 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+# files in the terraform dir that change what terraform plans
+PLAN_INPUTS = ('*.tf', '*.tf.json', '*.tfvars', '*.tfvars.json')
+
+
+class PlanCache():
+    """
+    Content addressed store for terraform plans. Each plan (and its output) is saved under
+    a hash of everything that goes into it: the .tf files, the resolved variables (tfvars
+    and TF_VAR_* env vars), the state's serial and lineage, and any targets or args. E.g.,
+        plans = PlanCache(tf_dir, state, env)
+        key = plans.key(tf_targets)
+        if plans.has_plan(key):
+            print(plans.output(key))      # inputs haven't changed, no need to re-plan
+
+    Plans live in <terraform dir>/.plans/<key>/ (tfplan and plan.log). Only the latest plan
+    is kept, and it's discarded once applied (or destroyed) as the state will have changed.
+    Plan files can contain secrets so the directory is only readable by the current user.
+
+    Required Attributes
+    ----------
+    working_dir: directory
+        The full path to the directory with .tf resources.
+    state: TfState
+        The deployment's terraform state (for its serial and lineage).
+    env: dict
+        The environment terraform runs with.
+    tfvars: dict
+        The resolved variables (see Terraform.tfvars).
+    """
+    PLANS_DIR = '.plans'
+
+    def __init__(self, working_dir, state, env=None, tfvars=None):
+        self.working_dir = Path(working_dir)
+        self.plans_dir = self.working_dir.joinpath(self.PLANS_DIR)
+        self.state = state
+        self.env = env
+        self.tfvars = tfvars or {}
+
+    def key(self, tf_targets=None, tf_args=None):
+        '''returns the hash of the inputs of a plan'''
+        key = hashlib.sha256(b'plan-v1\0')
+        files = sorted({f for pattern in PLAN_INPUTS for f in self.working_dir.glob(pattern)})
+        for file in files:
+            key.update(f"{file.name}\0".encode())
+            key.update(hashlib.sha256(file.read_bytes()).digest())
+
+        env = os.environ if self.env is None else self.env
+        for name in sorted(n for n in env if n.startswith('TF_VAR_')):
+            key.update(f"{name}={env[name]}\0".encode())
+        key.update(json.dumps(self.tfvars, sort_keys=True, default=list).encode() + b'\0')
+
+        info = self.state.info if self.state.exists() else {}
+        key.update(f"serial={info.get('serial')}\0lineage={info.get('lineage')}\0".encode())
+        for name, words in (('targets', tf_targets), ('args', tf_args)):
+            key.update(f"{name}={' '.join(map(repr, words or []))}\0".encode())
+        return key.hexdigest()
+
+    def plan_dir(self, key):
+        return self.plans_dir.joinpath(key)
+
+    def plan_file(self, key):
+        '''the plan file, relative to the terraform dir (as passed to terraform)'''
+        return Path(self.PLANS_DIR, key, 'tfplan')
+
+    def log_file(self, key):
+        return self.plan_dir(key).joinpath('plan.log')
+
+    def has_plan(self, key):
+        return (self.working_dir.joinpath(self.plan_file(key)).is_file() and
+                self.log_file(key).is_file())
+
+    def output(self, key):
+        '''returns what terraform printed when the plan was made'''
+        return self.log_file(key).read_text()
+
+    def prepare(self, key):
+        '''creates an empty dir for a new plan and removes all others'''
+        self.discard()
+        self.plans_dir.mkdir(mode=0o700, exist_ok=True)
+        self.plan_dir(key).mkdir(mode=0o700)
+
+    def discard(self, key=None):
+        '''removes the plan for key (or all plans)'''
+        path = self.plans_dir if key is None else self.plan_dir(key)
+        shutil.rmtree(path, ignore_errors=True)
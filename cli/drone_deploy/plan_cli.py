@@ -2,23 +2,41 @@ import click
 from pathlib import Path
 from drone_deploy.deployment import Deployment
 from drone_deploy.filter import filter_deployments
+from drone_deploy.fleet import fleet_options, run_fleet_command
 
 
 # $> drone-deploy plan [deployment name]
-@click.group(invoke_without_command=True)
-@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
-def plan(deployment_name):
+@click.group(invoke_without_command=True, short_help="Runs 'terraform plan' on a deployment.")
+@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments,
+                required=False)
+@click.option('--no-cache', is_flag=True,
+              help='Always run terraform plan, even if nothing has changed since the last plan.')
+@fleet_options
+def plan(deployment_name, no_cache, all_deployments, match, jobs):
     """
     Runs 'terraform plan' on <deployment_name>.
 
     The <deployment-name> must exist in the ./deployments directory.
 
+    Plans are saved under a hash of the .tf files, variables, and terraform state. If
+    nothing has changed since the last plan it's shown again without running terraform,
+    and 'drone-deploy deploy' applies it. Otherwise deploy plans again before applying.
+
     Usage:
         drone-deploy plan drone.mydomain.com
+        drone-deploy plan drone.mydomain.com --no-cache
+
+        Plan every deployment (or those matching a glob), 4 at a time:
+        drone-deploy plan --all --jobs 4
+        drone-deploy plan --match 'prod-*'
 
     Related:
         drone-deploy [list, show, deploy]
     """
+    if all_deployments or match:
+        return run_fleet_command('plan', all_deployments, match, jobs)
+    if not deployment_name:
+        raise click.UsageError("Missing argument 'DEPLOYMENT_NAME' (or use --all/--match).")
 
     deployment_dir = Path.cwd().joinpath('deployments', deployment_name, 'config.yaml').resolve()
     if not deployment_dir.exists():
@@ -28,4 +46,4 @@ def plan(deployment_name):
 
     # load the deployment
     deployment = Deployment(deployment_dir)
-    deployment.plan()
+    deployment.plan(use_cache=not no_cache)
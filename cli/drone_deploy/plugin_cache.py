@@ -0,0 +1,314 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import platform
+import threading
+from pathlib import Path
+try:
+    import fcntl
+except ImportError:     # windows: the lock only serializes threads
+    fcntl = None
+
+# terraform-provider-aws_v2.70.0_x4 => ('aws', '2.70.0')
+PLUGIN_RE = re.compile(r'^terraform-provider-(?P<name>[\w-]+?)_v(?P<version>[\w.+-]+?)'
+                       r'(?:_x\d+)?(?:\.exe)?$')
+
+# providers used by .tf files, e.g. `provider "aws" {` and `resource "aws_s3_bucket" "foo" {`
+PROVIDER_RE = re.compile(r'^\s*provider\s+"?([a-z0-9]+)"?', re.M)
+RESOURCE_RE = re.compile(r'^\s*(?:resource|data)\s+"?([a-z0-9]+)_', re.M)
+PROVIDER_BLOCK_RE = re.compile(r'^\s*provider\s+"?([a-z0-9]+)"?\s*\{', re.M)
+VERSION_RE = re.compile(r'^\s*version\s*=\s*"([^"]*)"', re.M)
+
+# a version constraint, e.g. `~> 2.70`, `>= 2.0, < 3.0` (one comma separated part)
+CONSTRAINT_RE = re.compile(r'^\s*(=|!=|>=|<=|>|<|~>)?\s*v?([\w.+-]+)\s*$')
+
+
+def os_arch():
+    '''returns terraform's name for this platform, e.g. linux_amd64'''
+    system = {'win32': 'windows', 'cygwin': 'windows'}.get(sys.platform, sys.platform)
+    system = re.sub(r'\d+$', '', system)
+    machine = platform.machine().lower()
+    arch = {'x86_64': 'amd64', 'amd64': 'amd64', 'aarch64': 'arm64', 'arm64': 'arm64',
+            'i386': '386', 'i686': '386', 'x86': '386'}.get(machine, machine)
+    if arch.startswith('arm') and arch != 'arm64':
+        arch = 'arm'
+    return f"{system}_{arch}"
+
+
+def version_key(version):
+    '''sorts versions numerically, e.g. 2.10.0 after 2.9.1'''
+    return [int(part) if part.isdigit() else -1 for part in re.split(r'[.+-]', version)]
+
+
+def version_matches(version, constraints):
+    '''
+    True if version meets every terraform version constraint, e.g. ('~> 2.70', '>= 2.0, < 3.0').
+    Unparseable constraints never match (terraform would reject them).
+    '''
+    for constraint in constraints:
+        for part in constraint.split(','):
+            match = CONSTRAINT_RE.match(part)
+            if not match:
+                return False
+            op, wanted = match.group(1) or '=', match.group(2)
+            have, want = version_key(version), version_key(wanted)
+            width = max(len(have), len(want))
+            have, want = have + [0] * (width - len(have)), want + [0] * (width - len(want))
+            if op == '~>':
+                # ~> 2.7 allows 2.7 up to (not including) 3.0, ~> 2.7.1 up to 2.8
+                prefix = version_key(wanted)[:max(len(wanted.split('.')) - 1, 1)]
+                ok = have >= want and have[:len(prefix)] == prefix
+            else:
+                ok = {'=': have == want, '!=': have != want, '>': have > want,
+                      '>=': have >= want, '<': have < want, '<=': have <= want}[op]
+            if not ok:
+                return False
+    return True
+
+
+class FileLock():
+    """
+    An exclusive lock on a file, held across processes (flock) and threads. E.g.,
+        with FileLock(path):
+            ...
+    acquire() blocks, so async callers should run it in an executor.
+    """
+
+    _thread_locks = {}
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = None
+        with self._thread_locks_lock:
+            self.thread_lock = self._thread_locks.setdefault(str(self.path), threading.Lock())
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(self.path, 'a')
+            if fcntl is not None:
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()       # closing it releases the flock
+            self.file = None
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def link_or_copy(src, dst):
+    '''hardlinks src to dst, copying if the files are on different devices'''
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class PluginCache():
+    """
+    A terraform provider cache shared by every deployment in an initialized directory
+    (`drone-deploy init`). Providers are downloaded once, into
+    <root>/.cache/terraform-plugins/<os_arch>/ (the TF_PLUGIN_CACHE_DIR layout), and
+    hardlinked into each deployment's .terraform/plugins dir. E.g.,
+        cache = PluginCache(root)
+        with cache.lock():
+            linked = cache.link_into(tf_dir)
+        if linked:                      # all providers are cached
+            terraform init -get-plugins=false
+        with cache.lock():              # terraform's cache isn't safe for concurrent writers
+            terraform init
+            cache.collect(tf_dir)       # cache what was downloaded
+        cache.prune()
+
+    TF_PLUGIN_CACHE_DIR is used instead of the default location if it's set.
+
+    Required Attributes
+    ----------
+    root: directory
+        The initialized directory (the one with 'deployments' and 'templates').
+
+    Methods
+    -------
+    plugins
+        Returns the cached provider binaries.
+    lock
+        Returns a FileLock that serializes writes to the cache (e.g. prepare --all --jobs).
+    required_providers(tf_dir)
+        Returns the names of the providers a terraform dir uses.
+    version_constraints(tf_dir)
+        Returns the version constraints of the providers a terraform dir configures.
+    link_into(tf_dir)
+        Hardlinks the newest cached version of each provider that meets tf_dir's version
+        constraints into tf_dir. Returns True if every provider tf_dir needs was cached.
+    collect(tf_dir)
+        Adds providers terraform installed in tf_dir to the cache.
+    usage
+        Returns a list of (plugin, size, number of deployments linked to it).
+    prune
+        Removes cached providers no deployment uses. Returns (removed, bytes freed).
+    """
+
+    def __init__(self, root, cache_dir=None):
+        self.root = Path(root)
+        cache_dir = cache_dir or os.getenv('TF_PLUGIN_CACHE_DIR')
+        if not cache_dir:
+            cache_dir = self.root.joinpath('.cache', 'terraform-plugins')
+        self.cache_dir = Path(cache_dir)
+        self.os_arch = os_arch()
+        self.plugin_dir = self.cache_dir.joinpath(self.os_arch)
+
+    @classmethod
+    def for_working_dir(cls, tf_dir):
+        '''returns the cache for a deployment's terraform dir (deployments/<name>/terraform)'''
+        return cls(Path(tf_dir).resolve().parent.parent.parent)
+
+    def lock(self):
+        return FileLock(self.cache_dir.joinpath('.lock'))
+
+    @property
+    def plugins(self):
+        if not self.plugin_dir.is_dir():
+            return []
+        return sorted(p for p in self.plugin_dir.iterdir() if PLUGIN_RE.match(p.name))
+
+    def newest(self, constraints=None):
+        '''
+        returns {provider name: path of the newest cached version}, only considering versions
+        that meet constraints ({provider name: [constraint]}) if given
+        '''
+        constraints = constraints or {}
+        newest = {}
+        for plugin in self.plugins:
+            match = PLUGIN_RE.match(plugin.name)
+            name, version = match.group('name'), match.group('version')
+            if not version_matches(version, constraints.get(name, ())):
+                continue
+            current = newest.get(name)
+            if current is None or version_key(version) > version_key(current[0]):
+                newest[name] = (version, plugin)
+        return {name: plugin for name, (version, plugin) in newest.items()}
+
+    def required_providers(self, tf_dir):
+        names = set()
+        for tf_file in Path(tf_dir).glob('*.tf'):
+            text = tf_file.read_text()
+            names.update(PROVIDER_RE.findall(text))
+            names.update(RESOURCE_RE.findall(text))
+        # `terraform` (e.g. data "terraform_remote_state") is built in
+        names.discard('terraform')
+        return names
+
+    def version_constraints(self, tf_dir):
+        '''returns {provider name: [version constraint]} from the provider blocks in tf_dir'''
+        constraints = {}
+        for tf_file in Path(tf_dir).glob('*.tf'):
+            text = tf_file.read_text()
+            for match in PROVIDER_BLOCK_RE.finditer(text):
+                # the block's body, up to its closing brace
+                depth, end = 1, match.end()
+                while depth and end < len(text):
+                    depth += {'{': 1, '}': -1}.get(text[end], 0)
+                    end += 1
+                version = VERSION_RE.search(text, match.end(), end)
+                if version:
+                    constraints.setdefault(match.group(1), []).append(version.group(1))
+        return constraints
+
+    def deployment_plugin_dir(self, tf_dir):
+        return Path(tf_dir).joinpath('.terraform', 'plugins', self.os_arch)
+
+    def link_into(self, tf_dir):
+        '''
+        hardlinks cached providers that meet tf_dir's version constraints into tf_dir, returns
+        True if none are missing
+        '''
+        required = self.required_providers(tf_dir)
+        newest = self.newest(self.version_constraints(tf_dir))
+        if not required or not required <= set(newest):
+            return False
+
+        plugin_dir = self.deployment_plugin_dir(tf_dir)
+        plugin_dir.mkdir(parents=True, exist_ok=True)
+        installed = {p.name for p in plugin_dir.iterdir()}
+        for name in required:
+            plugin = newest[name]
+            if plugin.name not in installed:
+                link_or_copy(plugin, plugin_dir.joinpath(plugin.name))
+        return True
+
+    def collect(self, tf_dir):
+        '''
+        Hardlinks providers installed in tf_dir into the cache. Symlinks terraform made to
+        the cache are replaced with hardlinks so the cache can tell which plugins are used.
+        '''
+        plugin_dir = self.deployment_plugin_dir(tf_dir)
+        if not plugin_dir.is_dir():
+            return
+        self.plugin_dir.mkdir(parents=True, exist_ok=True)
+        for plugin in plugin_dir.iterdir():
+            if not PLUGIN_RE.match(plugin.name):
+                continue
+            cached = self.plugin_dir.joinpath(plugin.name)
+            if plugin.is_symlink():
+                target = plugin.resolve()
+                if not cached.exists():
+                    link_or_copy(target, cached)
+                plugin.unlink()
+                link_or_copy(cached, plugin)
+            elif not cached.exists():
+                link_or_copy(plugin, cached)
+
+    def referenced_hashes(self):
+        '''sha256 hashes of the providers in deployments' lock files (for copied plugins)'''
+        hashes = set()
+        pattern = f"*/terraform/.terraform/plugins/{self.os_arch}/lock.json"
+        for lock_file in self.root.joinpath('deployments').glob(pattern):
+            try:
+                hashes.update(json.loads(lock_file.read_text()).values())
+            except (OSError, ValueError, AttributeError):
+                pass
+        return hashes
+
+    def usage(self):
+        '''returns [(plugin, size in bytes, number of deployments hardlinked to it)]'''
+        return [(p, p.stat().st_size, p.stat().st_nlink - 1) for p in self.plugins]
+
+    def prune(self):
+        '''removes providers no deployment uses, returns (removed plugins, bytes freed)'''
+        removed = []
+        freed = 0
+        hashes = None
+        for plugin, size, links in self.usage():
+            if links > 0:
+                continue
+            if hashes is None:
+                hashes = self.referenced_hashes()
+            if hashes and hashlib.sha256(plugin.read_bytes()).hexdigest() in hashes:
+                continue
+            plugin.unlink()
+            removed.append(plugin)
+            freed += size
+        return removed, freed
+
+
+def format_size(size):
+    '''returns a human readable size, e.g. 120.5 MB'''
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
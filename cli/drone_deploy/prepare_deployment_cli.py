@@ -2,12 +2,18 @@ import click
 from pathlib import Path
 from drone_deploy.deployment import Deployment
 from drone_deploy.filter import filter_deployments
+from drone_deploy.fleet import fleet_options, run_fleet_command
 
 
 # $> drone-deploy prepare [deployment name]
-@click.group(invoke_without_command=True, name="prepare")
-@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
-def prepare_deployment(deployment_name):
+@click.group(invoke_without_command=True, name="prepare",
+             short_help="Runs 'terraform init' and creates the builder IAM roles.")
+@click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments,
+                required=False)
+@fleet_options
+@click.option('--yes', '-y', is_flag=True,
+              help="Don't ask before running unattended on many deployments.")
+def prepare_deployment(deployment_name, all_deployments, match, jobs, yes):
     """
     Sets up and prepares the deployment. Specifically, it runs 'terraform init'
     on <deployment_name> and bootstraps the needed IAM roles and policies for
@@ -23,9 +29,16 @@ def prepare_deployment(deployment_name):
         # edit deployments/drone.mydomain.com/config.yaml
         $> drone-deploy prepare drone.mydomain.com
 
+        Prepare every deployment (or those matching a glob) unattended, 4 at a time:
+        $> drone-deploy prepare --all --jobs 4
+
     Related:
         drone-deploy [list, show, deploy]
     """
+    if all_deployments or match:
+        return run_fleet_command('prepare', all_deployments, match, jobs, confirm=not yes)
+    if not deployment_name:
+        raise click.UsageError("Missing argument 'DEPLOYMENT_NAME' (or use --all/--match).")
 
     deployment_dir = Path.cwd().joinpath('deployments', deployment_name, 'config.yaml').resolve()
     if not deployment_dir.exists():
@@ -33,20 +46,7 @@ def prepare_deployment(deployment_name):
                    "Run 'drone-deploy list' to see available deployemnts.")
         return False
 
-    # load the deployment, run terraform init, and apply roles and policies
+    # load the deployment, run terraform init, and apply roles and policies needed for
+    # building/deploying the ami
     deployment = Deployment(deployment_dir)
-    try:
-        deployment.init()
-    except Exception:
-        pass
-
-    # Apply needed IAM roles and policies for building/deploying ami
-    targets = ' '.join("-target={}".format(t) for t in [
-        "aws_iam_policy.drone-builder-ec2",
-        "aws_iam_policy.drone-builder-s3",
-        "aws_iam_policy_attachment.ec2",
-        "aws_iam_policy_attachment.s3",
-        "aws_iam_instance_profile.drone-builder"
-    ])
-
-    deployment.deploy(targets)
+    deployment.prepare()
@@ -0,0 +1,306 @@
+import os
+import re
+import sys
+import time
+import codecs
+import signal
+import asyncio
+import selectors
+import subprocess
+from collections import deque
+from drone_deploy.profiler import span
+
+# bytes read from a pipe at a time
+CHUNK_SIZE = 64 * 1024
+
+# characters of stdout/stderr kept for the result (see ProcessResult)
+TAIL_SIZE = 16 * 1024
+
+
+class StreamSink():
+    """
+    Writes process output to file-like objects. stderr goes to the same stream as stdout
+    unless err_stream is given. E.g.,
+        run_process('terraform plan', sinks=[StreamSink(prefixed_writer)])
+    """
+
+    def __init__(self, stream, err_stream=None):
+        self.stream = stream
+        self.err_stream = err_stream
+
+    def streams(self):
+        '''returns the (stdout, stderr) streams to write to'''
+        return self.stream, self.err_stream or self.stream
+
+    def write(self, name, text):
+        stdout, stderr = self.streams()
+        stream = stderr if name == 'stderr' else stdout
+        stream.write(text)
+        stream.flush()
+
+    def close(self):
+        for stream in set(self.streams()):
+            stream.flush()
+
+
+class ConsoleSink(StreamSink):
+    '''Writes stdout to sys.stdout and stderr to sys.stderr (looked up on every write).'''
+
+    def __init__(self):
+        super().__init__(None)
+
+    def streams(self):
+        return sys.stdout, sys.stderr
+
+
+class FileSink():
+    '''Appends process output (stdout and stderr, in the order received) to a log file.'''
+
+    def __init__(self, path, mode='a'):
+        self.path = path
+        self.mode = mode
+        self.file = None
+
+    def write(self, name, text):
+        if self.file is None:
+            self.file = open(self.path, self.mode)
+        self.file.write(text)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RingBufferSink():
+    '''Keeps the last `size` characters of stdout and stderr in memory.'''
+
+    def __init__(self, size=TAIL_SIZE):
+        self.size = size
+        self.buffers = {'stdout': deque(), 'stderr': deque()}
+        self.lengths = {'stdout': 0, 'stderr': 0}
+
+    def write(self, name, text):
+        buffer = self.buffers[name]
+        buffer.append(text)
+        self.lengths[name] += len(text)
+        while self.lengths[name] - len(buffer[0]) >= self.size:
+            self.lengths[name] -= len(buffer.popleft())
+
+    def text(self, name):
+        '''returns the buffered output of stream `name` ('stdout' or 'stderr')'''
+        return ''.join(self.buffers[name])[-self.size:]
+
+    def close(self):
+        pass
+
+
+class LineSink():
+    '''Calls callback(name, line) for every complete line of stdout ('stdout') and stderr.'''
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.partial = {'stdout': '', 'stderr': ''}
+
+    def write(self, name, text):
+        lines = (self.partial[name] + text).split('\n')
+        self.partial[name] = lines.pop()
+        for line in lines:
+            self.callback(name, line)
+
+    def close(self):
+        for name, line in self.partial.items():
+            if line:
+                self.callback(name, line)
+        self.partial = {'stdout': '', 'stderr': ''}
+
+
+class ProcessResult():
+    '''The outcome of run_process(): exit code, wall time, and the tail of each stream.'''
+
+    def __init__(self, command, returncode, duration, stdout_tail='', stderr_tail=''):
+        self.command = command
+        self.returncode = returncode
+        self.duration = duration
+        self.stdout_tail = stdout_tail
+        self.stderr_tail = stderr_tail
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return (f"{type(self).__name__}(returncode={self.returncode}, "
+                f"duration={self.duration:.2f})")
+
+
+def span_name(command):
+    '''names a process's profiler span, e.g. 'terraform apply' for terraform apply -no-color'''
+    words = command.split() if isinstance(command, str) else [str(arg) for arg in command]
+    if not words:
+        return 'process'
+    name = os.path.basename(words[0])
+    if len(words) > 1 and re.match(r'^\w[\w.-]*$', words[1]):
+        name = f"{name} {words[1]}"
+    return name
+
+
+def pump(p, sinks, chunk_size=CHUNK_SIZE):
+    '''
+    Copies a process's stdout and stderr pipes to sinks until both are closed. Pipes are
+    read in chunks as data arrives (no busy loop), and partial lines (e.g. terraform's
+    'Enter a value:' prompt) are passed on right away.
+    '''
+    decoders = {}
+    with selectors.DefaultSelector() as selector:
+        for name, pipe in (('stdout', p.stdout), ('stderr', p.stderr)):
+            if pipe is not None:
+                selector.register(pipe.fileno(), selectors.EVENT_READ, name)
+                decoders[name] = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, chunk_size)
+                if not data:
+                    selector.unregister(key.fd)
+                text = decoders[key.data].decode(data, final=not data)
+                if text:
+                    for sink in sinks:
+                        sink.write(key.data, text)
+
+
+def run_process(command, cwd=None, env=None, sinks=None, stdin=None, shell=True,
+                tail_size=TAIL_SIZE):
+    '''
+    Runs command, streaming its stdout and stderr to sinks (defaults to the console), and
+    returns a ProcessResult. E.g.,
+        result = run_process('terraform plan', cwd=tf_dir, env=env)
+        if not result.ok:
+            print(result.stderr_tail)
+    '''
+    sinks = [ConsoleSink()] if sinks is None else list(sinks)
+    tails = RingBufferSink(tail_size)
+    start = time.monotonic()
+    with span(span_name(command), cwd=cwd):
+        p = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, shell=shell, cwd=cwd, env=env)
+        try:
+            pump(p, sinks + [tails])
+        finally:
+            for pipe in (p.stdout, p.stderr):
+                if pipe is not None:
+                    pipe.close()
+            returncode = p.wait()
+            for sink in sinks:
+                sink.close()
+
+    return ProcessResult(command, returncode, time.monotonic() - start,
+                         tails.text('stdout'), tails.text('stderr'))
+
+
+# running async children, and the signals (SIGINT/SIGTERM) forwarded to each of them
+_children = {}
+
+# signals forwarded to children that don't share our process group (see arun_process)
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+# seconds a cancelled child has to exit after SIGTERM before it's killed
+TERMINATE_TIMEOUT = 10
+
+
+def _forward_signal(signum):
+    for child, signums in list(_children.items()):
+        if child.returncode is None and signum in signums:
+            child.send_signal(signum)
+
+
+def _watch_child(child, signums=FORWARDED_SIGNALS):
+    '''
+    Tracks a child so the signums (SIGINT/SIGTERM) sent to us are forwarded to it. Terraform
+    and packer clean up (release state locks, delete temporary instances) when they get
+    SIGINT, but a second one makes them exit immediately, so each must only get one.
+    '''
+    if not _children:
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, _forward_signal, signum)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # not the main thread, or not supported on this platform
+                pass
+    _children[child] = signums
+
+
+def _unwatch_child(child):
+    _children.pop(child, None)
+    if not _children:
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.remove_signal_handler(signum)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass
+
+
+async def _terminate(child, timeout=TERMINATE_TIMEOUT):
+    '''sends SIGTERM to child and kills it if it hasn't exited after timeout seconds'''
+    if child.returncode is not None:
+        return
+    child.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(child.wait(), timeout)
+    except asyncio.TimeoutError:
+        child.kill()
+        await child.wait()
+
+
+async def _apump(stream, name, sinks, chunk_size=CHUNK_SIZE):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        data = await stream.read(chunk_size)
+        text = decoder.decode(data, final=not data)
+        if text:
+            for sink in sinks:
+                sink.write(name, text)
+        if not data:
+            break
+
+
+async def arun_process(argv, cwd=None, env=None, sinks=None, on_line=None, stdin=None,
+                       tail_size=TAIL_SIZE):
+    '''
+    The asyncio version of run_process(). Runs argv (a list, no shell) and streams its output
+    to sinks (defaults to the console) and, line by line, to on_line(name, line). E.g.,
+        result = await arun_process(['terraform', 'plan'], cwd=tf_dir, on_line=print_line)
+
+    SIGINT and SIGTERM received while the child is running are forwarded to it, once. A
+    child given its own stdin runs in a new session, so a Ctrl-C only reaches it through us.
+    One that reads our stdin (e.g. to prompt for approval) stays in our process group, where
+    the terminal already sends it Ctrl-C, so only SIGTERM is forwarded to it. If the task is
+    cancelled the child is sent SIGTERM (and killed if it doesn't exit).
+    '''
+    sinks = [ConsoleSink()] if sinks is None else list(sinks)
+    if on_line is not None:
+        sinks.append(LineSink(on_line))
+    tails = RingBufferSink(tail_size)
+    start = time.monotonic()
+    with span(span_name(argv), cwd=cwd):
+        own_session = stdin is not None
+        child = await asyncio.create_subprocess_exec(*argv, stdin=stdin, stdout=subprocess.PIPE,
+                                                     stderr=subprocess.PIPE, cwd=cwd, env=env,
+                                                     start_new_session=own_session)
+        _watch_child(child, FORWARDED_SIGNALS if own_session else (signal.SIGTERM,))
+        try:
+            await asyncio.gather(_apump(child.stdout, 'stdout', sinks + [tails]),
+                                 _apump(child.stderr, 'stderr', sinks + [tails]))
+            returncode = await child.wait()
+        except asyncio.CancelledError:
+            await _terminate(child)
+            raise
+        finally:
+            _unwatch_child(child)
+            for sink in sinks:
+                sink.close()
+
+    return ProcessResult(argv, returncode, time.monotonic() - start,
+                         tails.text('stdout'), tails.text('stderr'))
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+
+# the innermost open span (per thread and asyncio task)
+_current = contextvars.ContextVar('drone_deploy_span', default=None)
+
+# the active Profiler, or None when profiling is off (the default)
+_profiler = None
+
+# width of the bars in the summary (100%)
+BAR_WIDTH = 30
+
+
+class Span():
+    '''A named, timed section of a run. Spans nest; the root span is the whole command.'''
+    __slots__ = ('name', 'args', 'start', 'end', 'tid', 'children')
+
+    def __init__(self, name, parent=None, args=None):
+        self.name = name
+        self.args = args or {}
+        self.start = time.perf_counter()
+        self.end = None
+        self.tid = threading.get_ident()
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def seconds(self):
+        return (time.perf_counter() if self.end is None else self.end) - self.start
+
+    def close(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    def __repr__(self):
+        return f"Span({self.name!r}, {self.seconds:.3f}s)"
+
+
+class _OpenSpan():
+    '''the context manager span() returns while profiling'''
+    __slots__ = ('span', 'token')
+
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        self.span.close()
+        _current.reset(self.token)
+
+
+class _NullSpan():
+    '''what span() returns when profiling is off: does nothing, as cheaply as possible'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **args):
+    '''
+    Times the code in a with block as a span nested in the current one. E.g.,
+        with span('terraform init', cwd=tf_dir):
+            ...
+
+    When profiling is off this returns a shared no-op context manager, so spans can be
+    left in hot paths.
+    '''
+    if _profiler is None:
+        return _NULL_SPAN
+    return _OpenSpan(Span(name, _current.get() or _profiler.root, args))
+
+
+def enabled():
+    return _profiler is not None
+
+
+class PhaseSink():
+    """
+    A process sink that splits the current span (e.g. a terraform run) into phases, by
+    matching the process's output lines against (regex, phase name) pairs. A phase lasts
+    until the next one starts or the process exits. E.g.,
+        sinks.append(PhaseSink([(re.compile(r'Refreshing state'), 'refresh')]))
+    """
+
+    def __init__(self, phases):
+        self.phases = phases
+        self.parent = None
+        self.phase = None
+        self.partial = ''
+
+    def write(self, name, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            for regex, phase in self.phases:
+                if regex.search(line):
+                    self.start(phase)
+                    break
+
+    def start(self, phase):
+        if self.phase is not None and self.phase.name == phase:
+            return
+        if self.parent is None:
+            # the span of the process we're reading from (the sink is written to inside it)
+            self.parent = _current.get() or _profiler.root
+        if self.phase is not None:
+            self.phase.close()
+        self.phase = Span(phase, self.parent)
+
+    def close(self):
+        if self.phase is not None:
+            self.phase.close()
+            self.phase = None
+        self.partial = ''
+
+
+def phase_sink(phases):
+    '''returns a PhaseSink for phases, or None when profiling is off'''
+    if _profiler is None:
+        return None
+    return PhaseSink(phases)
+
+
+def merged(spans):
+    '''merges sibling spans with the same name: [(name, seconds, count, [children])]'''
+    groups = {}
+    for child in spans:
+        group = groups.setdefault(child.name, [0.0, 0, []])
+        group[0] += child.seconds
+        group[1] += 1
+        group[2].extend(child.children)
+    return [(name, seconds, count, children)
+            for name, (seconds, count, children) in groups.items()]
+
+
+class Profiler():
+    """
+    Records nested timing spans for one command and reports them when it finishes: a
+    flame-style tree of where the time went (siblings with the same name are merged), and
+    optionally a Chrome trace (output ending in .json, open it in chrome://tracing or
+    Perfetto) or a cProfile dump (any other output, e.g. `python -m pstats run.prof`).
+    Usually used through enable() and finish(). E.g.,
+        profiler.enable('drone-deploy prepare', output='prepare.json')
+        with profiler.span('terraform init'):
+            ...
+        profiler.finish()
+
+    Spans started in threads without a current span (e.g. fleet workers) are attached to
+    the root. cProfile only sees the thread that enabled it.
+    """
+
+    def __init__(self, name, output=None):
+        self.root = Span(name)
+        self.output = output
+        self.cprofile = None
+        if output and not str(output).endswith('.json'):
+            import cProfile
+
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.token = _current.set(self.root)
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        self.root.close()
+        try:
+            _current.reset(self.token)
+        except ValueError:
+            # finished from another context (e.g. click's close callbacks), just clear it
+            _current.set(None)
+
+    def summary(self, min_percent=0.1):
+        '''returns the span tree as lines of text, hiding spans under min_percent'''
+        total = self.root.seconds or 1e-9
+        lines = [f"{'TIME':>9}  {'%':>5}  SPAN"]
+
+        def add(name, seconds, count, children, depth):
+            percent = seconds / total * 100
+            if depth and percent < min_percent:
+                return
+            label = f"{'  ' * depth}{name}" + (f" (x{count})" if count > 1 else '')
+            bar = '#' * round(percent / 100 * BAR_WIDTH)
+            lines.append(f"{seconds:>8.3f}s  {percent:>4.0f}%  {label:<48} {bar}".rstrip())
+            for child in sorted(merged(children), key=lambda group: -group[1]):
+                add(*child, depth + 1)
+
+        add(self.root.name, self.root.seconds, 1, self.root.children, 0)
+        return lines
+
+    def trace_events(self):
+        '''the spans as Chrome trace 'complete' events'''
+        pid = os.getpid()
+        events = []
+        stack = [self.root]
+        while stack:
+            span = stack.pop()
+            events.append({'name': span.name, 'cat': 'drone-deploy', 'ph': 'X',
+                           'ts': round((span.start - self.root.start) * 1e6, 1),
+                           'dur': round(span.seconds * 1e6, 1), 'pid': pid, 'tid': span.tid,
+                           'args': {key: str(value) for key, value in span.args.items()}})
+            stack.extend(span.children)
+        return sorted(events, key=lambda event: event['ts'])
+
+    def write_output(self):
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(self.output)
+        elif self.output:
+            with open(self.output, 'w') as write_file:
+                json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'},
+                          write_file)
+
+
+def enable(name, output=None):
+    '''starts profiling (spans are recorded from now on), returns the Profiler'''
+    global _profiler
+    _profiler = Profiler(name, output)
+    return _profiler
+
+
+def finish(stream=None):
+    '''stops profiling, prints the summary (to stderr), and writes the output file'''
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    profiler.stop()
+    stream = sys.stderr if stream is None else stream
+    stream.write('\nprofile:\n' + '\n'.join(profiler.summary()) + '\n')
+    if profiler.output:
+        try:
+            profiler.write_output()
+            stream.write(f"profile written to {profiler.output}\n")
+        except OSError as e:
+            stream.write(f"couldn't write the profile to {profiler.output} ({e})\n")
+    stream.flush()
+    return profiler
@@ -0,0 +1,42 @@
+import click
+from pathlib import Path
+from drone_deploy.plugin_cache import PluginCache, format_size
+
+
+# $> drone-deploy provider-cache [--prune]
+@click.group(invoke_without_command=True, name="provider-cache",
+             short_help='Shows (or prunes) the shared terraform provider cache.')
+@click.option('--prune', is_flag=True,
+              help='Remove cached providers that no deployment uses anymore.')
+def provider_cache(prune):
+    """
+    Shows (or prunes) the terraform provider cache shared by all deployments.
+
+    Providers are downloaded once, into .cache/terraform-plugins, and hardlinked into each
+    deployment when it's initialized ('drone-deploy prepare'), so new deployments don't
+    download them again.
+
+    Usage:
+        drone-deploy provider-cache
+        drone-deploy provider-cache --prune
+    """
+    cache = PluginCache(Path.cwd())
+    if prune:
+        removed, freed = cache.prune()
+        for plugin in removed:
+            click.echo(f"removed {plugin.name}")
+        click.echo(f"Freed {format_size(freed)}.")
+
+    usage = cache.usage()
+    if not usage:
+        click.echo(f"The provider cache ({cache.plugin_dir}) is empty.")
+        return
+
+    width = max(len(plugin.name) for plugin, size, links in usage)
+    click.echo(f"{'PROVIDER':<{width}}  {'SIZE':>10}  DEPLOYMENTS")
+    for plugin, size, links in usage:
+        click.echo(f"{plugin.name:<{width}}  {format_size(size):>10}  {links}")
+    total = sum(size for plugin, size, links in usage)
+    saved = sum(size * links for plugin, size, links in usage)
+    click.echo(f"\nTotal: {format_size(total)} in {cache.plugin_dir} "
+               f"(hardlinks save {format_size(saved)})")
@@ -0,0 +1,211 @@
+import os
+import secrets
+from types import MappingProxyType
+from collections.abc import Mapping
+from drone_deploy.profiler import span
+
+# params loaded from config.yaml (or env vars)
+STAGE1_PARAMS = ("drone_deployment_name", "drone_aws_region", "drone_vpc_id",
+                 "drone_server_machine_name", "drone_server_hosted_zone",
+                 "drone_server_key_pair_name", "drone_server_instance_type",
+                 "drone_docker_compose_version", "drone_server_allow_http",
+                 "drone_server_allow_https", "drone_server_allow_ssh",
+                 "drone_open", "drone_admin", "drone_admin_email", "drone_user_filter",
+                 "drone_github_server", "drone_github_client_id", "drone_github_client_secret",
+                 "drone_agents_enabled", "drone_tls_autocert", "drone_server_proto",
+                 "drone_server_host", "drone_cli_version", "drone_server_docker_image",
+                 "drone_agent_docker_image", "drone_server_base_ami", "drone_base_ami_max_age",
+                 "aws_cli_base_image", "drone_rpc_secret", "drone_s3_bucket")
+
+# params that fall back to terraform state and packer build artifacts
+STAGE2_PARAMS = ("drone_builder_role_arn", "drone_deployment_id", "drone_server_ami")
+
+PARAMS = STAGE1_PARAMS + STAGE2_PARAMS
+
+# names of the env vars that can override config settings
+ENV_PARAMS = tuple(p.upper() for p in PARAMS)
+
+
+class ResolvedConfig(Mapping):
+    """
+    An immutable, fully resolved deployment configuration. Created by resolve_config(),
+    which never touches os.environ, so any number of deployments can be resolved in one
+    process (or thread pool) without picking up each other's settings. E.g.,
+        resolved = resolve_config(config, 'drone-foo')
+        resolved['drone_aws_region']        => 'us-east-1'
+        resolved.tfvars                     => {'drone_aws_region': 'us-east-1', ...}
+        env = resolved.environment()        # pass to terraform/packer subprocesses
+
+    Sequences (e.g. drone_server_allow_ssh) are stored as tuples.
+
+    Properties
+    ----------
+    tfvars: mapping
+        Values as written to drone-deploy.auto.tfvars.json (strings, and tuples for lists).
+    exports: mapping
+        Env vars (DRONE_*, read by the build script) to add to a subprocess environment.
+    generated: frozenset
+        The params that were set to a new random value (e.g. drone_rpc_secret), because
+        neither the env nor config.yaml had one.
+
+    Methods
+    -------
+    environment(self, base=None)
+        Returns a new env dict (base, or os.environ, plus exports) for a subprocess.
+    to_dict
+        Returns a json serializable dict (see ConfigCache).
+    from_dict(data)
+        Recreates a ResolvedConfig from to_dict() output.
+    """
+    __slots__ = ('_values', '_tfvars', '_exports', '_generated')
+
+    def __init__(self, values, tfvars, exports, generated=()):
+        object.__setattr__(self, '_values', MappingProxyType(dict(values)))
+        object.__setattr__(self, '_tfvars', MappingProxyType(
+            {k: tuple(v) if isinstance(v, list) else v for k, v in tfvars.items()}))
+        object.__setattr__(self, '_exports', MappingProxyType(dict(exports)))
+        object.__setattr__(self, '_generated', frozenset(generated))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.get('drone_deployment_name')!r})"
+
+    @property
+    def tfvars(self):
+        return self._tfvars
+
+    @property
+    def exports(self):
+        return self._exports
+
+    @property
+    def generated(self):
+        return self._generated
+
+    def environment(self, base=None):
+        '''returns a new env for subprocesses (base defaults to os.environ) plus our exports'''
+        env = dict(os.environ if base is None else base)
+        env.update(self._exports)
+        return env
+
+    def to_dict(self):
+        return {'values': {k: list(v) if isinstance(v, tuple) else v
+                           for k, v in self._values.items()},
+                'tfvars': {k: list(v) if isinstance(v, tuple) else v
+                           for k, v in self._tfvars.items()},
+                'exports': dict(self._exports),
+                'generated': sorted(self._generated)}
+
+    @classmethod
+    def from_dict(cls, data):
+        values = {k: tuple(v) if isinstance(v, list) else v for k, v in data['values'].items()}
+        return cls(values, data['tfvars'], data['exports'], data['generated'])
+
+
+def default_deployment_name(deployment_dir_name):
+    '''
+    The 'drone_deployment_name' is dynamically created from the name of the deployment
+    directory and is used for naming resources in AWS. In order to keep aws resources
+    clearly labeled we append 'drone' to the name if the user hasn't already. E.g.,
+    'drone-deploy new dev' creates dir '/deployments/dev' and 'drone-dev-foo' aws resource names
+    '''
+    if 'drone' in deployment_dir_name:
+        return deployment_dir_name
+    return f"drone-{deployment_dir_name}"
+
+
+def format_tf_value(name, value):
+    '''returns the value as passed to terraform (-var and DRONE_*), and whether it's a list'''
+    if value is None:
+        return '', False
+
+    # flatten user-filter for docker-compose (comma separated, no ticks or spaces)
+    if name == "drone_user_filter":
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(v) for v in value)
+        return str(value).replace("'", "").replace(" ", ""), False
+
+    # convert yaml arrays to something hashi compatible, e.g. ["0.0.0.0/0"]
+    if isinstance(value, (list, tuple)):
+        return str([str(v) for v in value]).replace("'", '"'), True
+
+    return str(value), False
+
+
+def resolve_config(config, deployment_dir_name, environ=None, builder_role_arn='',
+                   deployment_id='', server_ami='', server_amis=None):
+    '''
+    Resolves every deployment param from env vars, falling back to config.yaml (a mapping),
+    generated values, and terraform/packer artifacts. Returns a ResolvedConfig. Nothing
+    outside of the returned object is modified.
+
+    environ defaults to a snapshot of os.environ. The builder role arn comes from the
+    terraform state, and the deployment id and server ami from the packer manifest. Given
+    server_amis ({region: AMI id} from a multi region build), the AMI for the resolved
+    drone_aws_region is used, so an env var override of the region picks its AMI.
+    '''
+    env = dict(os.environ if environ is None else environ)
+    values = {}
+    tfvars = {}
+    exports = {}
+    generated = set()
+
+    for name in PARAMS:
+        # one span per param (the stages of loading it), when profiling
+        with span(name):
+            env_name = name.upper()
+            from_env = bool(env.get(env_name))
+            if from_env:
+                value = env[env_name]
+            else:
+                value = config.get(name, '')
+
+            if name == "drone_deployment_name" and not value:
+                value = default_deployment_name(deployment_dir_name)
+
+            # generate a random rpc_secret if not set
+            if name == "drone_rpc_secret" and not value:
+                value = secrets.token_hex(16)
+                generated.add(name)
+
+            # dynamically name the s3 bucket
+            if name == "drone_s3_bucket" and not value:
+                machine_name = values.get('drone_server_machine_name')
+                hosted_zone = values.get('drone_server_hosted_zone')
+                if machine_name and hosted_zone:
+                    value = f"drone-data.{machine_name}.{hosted_zone}"
+
+            # the builder role arn from terraform state wins over env/config
+            if name == "drone_builder_role_arn" and builder_role_arn:
+                value = builder_role_arn
+
+            # get the deployment id and ami from packer unless set
+            if name == "drone_deployment_id" and not value:
+                value = deployment_id
+            if name == "drone_server_ami" and not value:
+                value = (server_amis or {}).get(values.get('drone_aws_region')) or server_ami
+
+            values[name] = tuple(value) if isinstance(value, list) else value
+
+            # format for terraform (written to a tfvars file, see Terraform.write_var_file),
+            # and the build script, which reads the DRONE_* env vars.
+            tf_value, is_list = format_tf_value(name, value)
+            tfvars[name] = tuple(str(v) for v in value) if is_list else tf_value
+            if not from_env or name in STAGE2_PARAMS:
+                exports[env_name] = tf_value
+
+    return ResolvedConfig(values, tfvars, exports, generated)
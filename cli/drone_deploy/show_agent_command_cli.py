@@ -5,7 +5,8 @@ from drone_deploy.filter import filter_deployments
 
 
 # $> drone-deploy show-agent-command <deployment-name>
-@click.group(invoke_without_command=True)
+@click.group(invoke_without_command=True,
+             short_help='Shows the docker command used to launch agents.')
 @click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
 def show_agent_command(deployment_name):
     """
@@ -18,7 +19,7 @@ def show_agent_command(deployment_name):
         return False
 
     # display the docker command to run an agent
-    deployment = Deployment(deployment_dir)
+    deployment = Deployment(deployment_dir, use_cache=True)
     rpc_secret = deployment.config['drone_rpc_secret']
     agent_image = deployment.config['drone_agent_docker_image']
 
@@ -5,7 +5,7 @@ from drone_deploy.filter import filter_deployments
 
 
 # $> drone-deploy show <deployment-name>
-@click.group(invoke_without_command=True)
+@click.group(invoke_without_command=True, short_help="Shows a deployment's configuration.")
 @click.argument('deployment_name', type=click.STRING, autocompletion=filter_deployments)
 def show(deployment_name):
     """
@@ -18,6 +18,6 @@ def show(deployment_name):
         return False
 
     # load the deployment
-    deployment = Deployment(deployment_dir)
+    deployment = Deployment(deployment_dir, use_cache=True)
     click.echo(deployment)
     click.echo(deployment.deployment_status)
@@ -0,0 +1,208 @@
+import os
+import re
+import shutil
+import hashlib
+import zipfile
+from pathlib import Path
+
+# bytes read from the download (and from archive members) at a time
+CHUNK_SIZE = 64 * 1024
+
+# seconds to wait for the server to respond (not for the whole download)
+DOWNLOAD_TIMEOUT = 30
+
+DEFAULT_REPO = 'https://github.com/keithdadkins/drone-deploy'
+
+# the templates packed into the release binary at build time (see drone-deploy.spec)
+EMBEDDED_TEMPLATES = 'templates.zip'
+
+
+class TemplateError(Exception):
+    '''raised when the templates can't be downloaded or the archive is invalid'''
+
+
+def user_cache_dir():
+    '''~/.cache/drone-deploy (or $XDG_CACHE_HOME/drone-deploy)'''
+    base = os.getenv('XDG_CACHE_HOME') or Path.home().joinpath('.cache')
+    return Path(base).joinpath('drone-deploy')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def template_members(archive):
+    '''
+    Returns [(member, path relative to templates/)] for the files under the archive's
+    templates/ dir. GitHub archives put everything under '<repo>-<version>/', so the
+    first path component is skipped whatever it's called.
+    '''
+    members = []
+    for info in archive.infolist():
+        parts = info.filename.split('/')
+        if len(parts) < 3 or parts[1] != 'templates' or info.is_dir():
+            continue
+        relative = parts[2:]
+        if any(part in ('', '.', '..') for part in relative):
+            raise TemplateError(f"Unsafe path in the templates archive: {info.filename}")
+        members.append((info, Path(*relative)))
+    return members
+
+
+def extract_templates(archive_file, dest, select=None):
+    '''
+    Extracts only the templates/ members of a zip archive (a path or file object) straight
+    into dest, keeping their unix modes (e.g. executable build scripts). Each member's CRC
+    is checked as it's read. select(path relative to templates/) can return where (relative
+    to dest) a file goes, or None to skip it. Returns the number of files extracted.
+    '''
+    dest = Path(dest)
+    count = 0
+    try:
+        with zipfile.ZipFile(archive_file) as archive:
+            members = template_members(archive)
+            if not members:
+                raise TemplateError("The templates archive doesn't have a templates/ dir.")
+            for info, relative in members:
+                if select is not None:
+                    relative = select(relative)
+                    if relative is None:
+                        continue
+                count += 1
+                target = dest.joinpath(relative)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with archive.open(info) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                mode = (info.external_attr >> 16) & 0o777
+                if mode:
+                    target.chmod(mode)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+        raise TemplateError(f"The templates archive is corrupt ({e}).")
+    return count
+
+
+def pack_templates(templates_dir, archive_file, version):
+    '''
+    Packs templates_dir into a zip laid out like a release archive
+    (drone-deploy-<version>/templates/...), with sorted entries and fixed times so the same
+    templates give the same bytes. Used to embed the templates in the release binary.
+    '''
+    templates_dir = Path(templates_dir)
+    with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for path in sorted(templates_dir.rglob('*')):
+            if not path.is_file():
+                continue
+            info = zipfile.ZipInfo(f"drone-deploy-{version}/templates/"
+                                   f"{path.relative_to(templates_dir).as_posix()}",
+                                   date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = (path.stat().st_mode & 0o777) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, path.read_bytes())
+    return archive_file
+
+
+def embedded_templates():
+    '''
+    Returns the templates packed into the release binary (an open binary file), or None
+    when running from source or the binary was built without them.
+    '''
+    from importlib import resources
+
+    try:
+        return resources.open_binary('drone_deploy', EMBEDDED_TEMPLATES)
+    except (OSError, ImportError):
+        return None
+
+
+class TemplateCache():
+    """
+    Downloads the deployment templates (the templates/ dir of a drone-deploy release
+    archive) once per repo and version, into a cache shared by every `drone-deploy init`.
+    The archive is streamed to disk and its sha256 saved next to it, so a repeat (or
+    offline) init is served from the cache, and a damaged archive is downloaded again. E.g.,
+        cache = TemplateCache(version='0.1.21')
+        cache.extract(Path('templates'))
+
+    The archive is <repo>/archive/<version>.zip, from DRONE_DEPLOY_TEMPLATES_REPO if it's
+    set (e.g. a fork), and is cached in ~/.cache/drone-deploy/templates/<repo hash>/.
+
+    Required Attributes
+    ----------
+    version: str
+        The release (git tag) to get the templates from.
+
+    Methods
+    -------
+    archive
+        Returns the path of the cached archive, downloading it if needed.
+    extract(dest)
+        Extracts the templates from the (cached) archive into dest.
+    """
+
+    def __init__(self, version, repo=None, cache_dir=None):
+        self.version = version
+        self.repo = (repo or os.getenv('DRONE_DEPLOY_TEMPLATES_REPO') or DEFAULT_REPO).rstrip('/')
+        if cache_dir is None:
+            cache_dir = user_cache_dir().joinpath('templates')
+        # one dir per repo, e.g. drone-deploy-3f2a9c1b0d4e
+        name = re.sub(r'[^\w.-]', '_', self.repo.rsplit('/', 1)[-1])[:40]
+        repo_hash = hashlib.sha256(self.repo.encode()).hexdigest()[:12]
+        self.cache_dir = Path(cache_dir).joinpath(f"{name}-{repo_hash}")
+        self.archive_file = self.cache_dir.joinpath(f"{version}.zip")
+        self.checksum_file = self.cache_dir.joinpath(f"{version}.zip.sha256")
+
+    @property
+    def url(self):
+        return f"{self.repo}/archive/{self.version}.zip"
+
+    def is_cached(self):
+        '''True if the archive is cached and still matches the checksum saved with it'''
+        try:
+            checksum = self.checksum_file.read_text().split()[0]
+            return file_sha256(self.archive_file) == checksum
+        except (OSError, IndexError):
+            return False
+
+    def download(self):
+        '''streams the archive into the cache (via a temporary file), returns its sha256'''
+        import requests
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.archive_file.with_name(f".{self.archive_file.name}.{os.getpid()}.tmp")
+        digest = hashlib.sha256()
+        try:
+            with requests.get(self.url, stream=True, allow_redirects=True,
+                              timeout=DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                with open(tmp_file, 'wb') as file:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        digest.update(chunk)
+                        file.write(chunk)
+            if not zipfile.is_zipfile(tmp_file):
+                raise TemplateError(f"{self.url} is not a zip archive.")
+            os.replace(tmp_file, self.archive_file)
+        except requests.RequestException as e:
+            raise TemplateError(f"Couldn't download {self.url} ({e}).")
+        finally:
+            if tmp_file.exists():
+                tmp_file.unlink()
+        checksum = digest.hexdigest()
+        self.checksum_file.write_text(f"{checksum}  {self.archive_file.name}\n")
+        return checksum
+
+    def archive(self):
+        if not self.is_cached():
+            self.download()
+        return self.archive_file
+
+    def extract(self, dest):
+        '''extracts the templates into dest, returns True if they came from the cache'''
+        cached = self.is_cached()
+        if not cached:
+            self.download()
+        extract_templates(self.archive_file, dest)
+        return cached
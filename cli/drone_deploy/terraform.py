@@ -1,8 +1,17 @@
 import os
+import re
 import sys
 import json
+import asyncio
 import subprocess
 from pathlib import Path
+from drone_deploy import profiler
+from drone_deploy.files import write_if_changed
+from drone_deploy.tfstate import TfState
+from drone_deploy.plan_cache import PlanCache
+from drone_deploy.plugin_cache import PluginCache
+from drone_deploy.process import run_process, arun_process, ProcessResult
+from drone_deploy.process import StreamSink, ConsoleSink, FileSink
 
 
 class Terraform():
@@ -19,10 +28,33 @@ class Terraform():
 
     Properties
     ----------
-    tf_vars: list
-        A list of terraform variables (tuples) to run with each terraform command.
+    tfvars: dict
+        The resolved variables, written to VAR_FILE (drone-deploy.auto.tfvars.json) before
+        each command. Lists are written as json lists.
+    env: dict
+        The environment terraform runs with (defaults to os.environ). Deployments pass their
+        own env (see ResolvedConfig.environment) so they never share os.environ.
     drone_builder_role_arn: string
-        Automatically set if an ARN is found in the deployments tfstate file.
+        Automatically set if an ARN is found in the deployments tfstate outputs.
+    state: TfState
+        Lazy reader for the deployment's terraform.tfstate (see drone_deploy.tfstate).
+    has_tf_state: bool
+        True if the deployment has a state file (a cheap check, the state isn't parsed).
+    output: file
+        Where terraform's output is written. Defaults to None, which streams terraform's
+        stdout and stderr to the console. When set (e.g. to a prefixed writer for fleet
+        runs), both are written to it.
+    automation: bool
+        Run unattended (no input, auto approve). Used when running many deployments at once.
+    last_result: ProcessResult
+        The exit code, duration, and output tails of the last terraform command.
+    plugin_cache: PluginCache
+        Terraform providers shared by every deployment (None outside of a deployments dir).
+        `init` uses cached providers when it can, and anything terraform downloads is cached.
+    plans: PlanCache
+        Plans saved under a hash of their inputs. `plan` prints the saved plan instead of
+        re-running terraform when nothing has changed (unless use_plan_cache is False), and
+        `apply` only applies a saved plan whose inputs still match.
 
     Methods
     -------
@@ -32,7 +64,7 @@ class Terraform():
         Only locally is supported for now as mounting .gitconfig, deployment dirs, etc is not
         ideal.
     load_tf_state
-        Loads terraform state file if present.
+        Sets up the (lazy) state reader.
     init
         Runs `terraform init` in the deployment dir.
     plan
@@ -41,6 +73,12 @@ class Terraform():
         Runs `terraform apply` in the deployment dir.
     destroy
         Runs `terraform destroy` in the deployment dir.
+    write_var_file
+        Writes the variables the .tf files declare to VAR_FILE (only if they changed).
+    ainit, aplan, aapply, adestroy
+        asyncio versions of the above, e.g. `await deployment.terraform.aplan()`. They take
+        an optional on_line(name, line) callback that gets each line of output as it
+        arrives, and forward SIGINT/SIGTERM to terraform.
     """
     SUPPORTED_TF_VERSION = 'Terraform v0.11.14'
     TERRAFORM_VERSION_MSG = f"""
@@ -52,93 +90,214 @@ class Terraform():
 
     """
 
-    def __init__(self, working_dir, tf_vars=[]):
-        # tfvars should be a list of tuples (key,value)
+    # value of TF_IN_AUTOMATION passed to terraform
+    TF_IN_AUTOMATION = False
+
+    # extra args for unattended runs (see `automation`)
+    AUTOMATION_ARGS = {
+        'init': ['-input=false'],
+        'plan': ['-input=false'],
+        'apply': ['-input=false', '-auto-approve'],
+        'destroy': ['-input=false', '-force'],
+    }
+
+    # init with providers from the plugin cache only (see PluginCache)
+    OFFLINE_INIT_ARGS = ['-get-plugins=false']
+
+    # `variable "name" {` in .tf files
+    VARIABLE_RE = re.compile(r'^\s*variable\s+"?([\w-]+)"?\s*\{', re.M)
+
+    # variables file written from the resolved config (terraform loads *.auto.tfvars.json)
+    VAR_FILE = 'drone-deploy.auto.tfvars.json'
+
+    # output that starts each phase of a run, for the profiler (see profiler.PhaseSink)
+    PHASES = [
+        (re.compile(r'Initializing the backend'), 'init backend'),
+        (re.compile(r'Initializing provider plugins'), 'init providers'),
+        (re.compile(r'Refreshing state\.\.\.'), 'refresh'),
+        (re.compile(r'An execution plan has been generated|Terraform will perform|No changes\.'),
+         'plan'),
+        (re.compile(r': (?:Creating|Modifying|Destroying)\.\.\.'), 'apply'),
+    ]
+
+    def __init__(self, working_dir, env=None, tfvars=None):
         self.working_dir = working_dir
-        self.tf_vars = tf_vars
+        self.tfvars = tfvars or {}
+        self.env = env
+        self.output = None
+        self.automation = False
+        self.last_result = None
+        self.use_plan_cache = True
+        self.plugin_cache = None
+        if Path(working_dir).resolve().parent.parent.name == 'deployments':
+            self.plugin_cache = PluginCache.for_working_dir(working_dir)
         self.__use_local_cmd()
 
-        # try to load tf state file if present
+        # the state is read lazily, when its outputs are first needed
         self.load_tf_state()
 
     def __use_local_cmd(self):
         '''
-        Define a class method to proxy terraform.
+        Define class methods to proxy terraform (`terraform` and its asyncio version
+        `aterraform`).
         '''
-        def terraform(command, tf_targets=None, tf_args=None):
+        def command_args(command, tf_targets=None, tf_args=None):
+            '''
+            returns the terraform args (argv words, after the command), a message to print
+            afterwards, and the key of the plan being written (plan) or applied (apply), see
+            PlanCache. tf_targets and tf_args are lists of args, e.g. ['-target=aws_instance.foo'].
+            '''
             # set flags and base command
-            tfverbose = False
-            tfout = False
-            tfplan = False
-            tfplanfile = Path(self.working_dir).joinpath('tfplan')
+            self.write_var_file()
+            plans = self.plans
+            plan_key = None
             tfpostmsg = ""
+            if command in ['plan', 'apply']:
+                plan_key = plans.key(tf_targets, tf_args)
             if command == 'plan':
-                tfout = True
                 tfpostmsg = "To apply these exact changes, run `drone-deploy deploy`."
-            if command in ['apply']:
-                if tfplanfile.exists():
-                    tfplan = True
-            command = f"TF_IN_AUTOMATION={tfverbose} terraform {command}"
+            automation_args = self.AUTOMATION_ARGS.get(command) if self.automation else None
+            args = [command]
+
+            # don't prompt for input when running unattended
+            if automation_args:
+                args.extend(automation_args)
 
-            # append -out=file if set
-            if tfout:
-                command = f"{command} -out=tfplan"
+            # save the plan under the hash of its inputs
+            if command == 'plan':
+                args.append(f"-out={plans.plan_file(plan_key)}")
 
             # append targets if present
             if tf_targets:
-                command = f"{command} {tf_targets}"
+                args.extend(tf_targets)
 
             # append args if present
             if tf_args:
-                command = f"{command} {tf_args}"
-
-            # use plan file if present
-            if tfplan:
-                command = f"{command} tfplan"
-
-            # pass our env vars along to the sub process when executed
-            env = os.environ
-            p = subprocess.Popen(command, stderr=subprocess.PIPE, shell=True, text=True,
-                                 cwd=self.working_dir, env=env)
-            while True:
-                out = p.stderr.read(1)
-                if out == '' and p.poll() is not None:
-                    break
-                if out != '':
-                    sys.stdout.write(out)
-                    sys.stdout.flush()
+                args.extend(tf_args)
+
+            # apply the saved plan only if nothing has changed since it was made, otherwise
+            # terraform re-plans (and asks for approval unless running unattended)
+            if command == 'apply':
+                if plans.has_plan(plan_key):
+                    args.append(str(plans.plan_file(plan_key)))
+                else:
+                    plan_key = None
+            return args, tfpostmsg, plan_key
+
+        def cached_plan(command, plan_key):
+            '''prints the output of an identical plan made earlier, returns True if found'''
+            if command != 'plan' or not self.use_plan_cache:
+                return False
+            plans = self.plans
+            if not plans.has_plan(plan_key):
+                return False
+            output = sys.stdout if self.output is None else self.output
+            print(plans.output(plan_key), end='', file=output)
+            print("\nNothing has changed since this plan was made, so it was not re-run "
+                  "(use --no-cache to force a new plan).", file=output)
+            print("\nTo apply these exact changes, run `drone-deploy deploy`.\n", file=output)
+            self.last_result = ProcessResult(command, 0, 0.0)
+            return True
+
+        def output_sinks(command, plan_key):
+            '''returns the sinks for terraform's output (None for the console)'''
+            sinks = None if self.output is None else [StreamSink(self.output)]
+            if command == 'plan':
+                self.plans.prepare(plan_key)
+                sinks = (sinks or [ConsoleSink()]) + [FileSink(self.plans.log_file(plan_key))]
+            phases = profiler.phase_sink(self.PHASES)
+            if phases is not None:
+                sinks = (sinks or [ConsoleSink()]) + [phases]
+            return sinks
+
+        def report(result, tfpostmsg, command, plan_key):
+            '''prints the post message, updates the plan cache, and checks for errors'''
+            self.last_result = result
+            self.state.reset()
+
+            # failed plans aren't reused, and applied plans (or destroyed resources) change
+            # the state, so any saved plan is stale
+            if command == 'plan' and result.returncode != 0:
+                self.plans.discard(plan_key)
+            elif command in ['apply', 'destroy']:
+                self.plans.discard()
+
+            output = sys.stdout if self.output is None else self.output
             if tfpostmsg:
-                print(f"\n{tfpostmsg}\n")
+                print(f"\n{tfpostmsg}\n", file=output)
 
             # check for errors
-            if p.returncode != 0:
+            if result.returncode != 0:
                 # check for valid terraform version
-                print("Something went wrong running terraform commands... ")
+                print("Something went wrong running terraform commands... ", file=output)
                 current_ver = subprocess.call(["terraform", "version"])
                 if current_ver != self.SUPPORTED_TF_VERSION:
-                    print(self.TERRAFORM_VERSION_MSG)
+                    print(self.TERRAFORM_VERSION_MSG, file=output)
+            return result.returncode
+
+        def command_env():
+            '''returns the env terraform runs with (ours, or os.environ)'''
+            env = dict(os.environ if self.env is None else self.env)
+            env['TF_IN_AUTOMATION'] = str(self.TF_IN_AUTOMATION)
+
+            # download providers once, into the cache shared by all deployments
+            if self.plugin_cache is not None:
+                self.plugin_cache.plugin_dir.mkdir(parents=True, exist_ok=True)
+                env.setdefault('TF_PLUGIN_CACHE_DIR', str(self.plugin_cache.cache_dir))
+            return env
+
+        def terraform(command, tf_targets=None, tf_args=None):
+            args, tfpostmsg, plan_key = command_args(command, tf_targets, tf_args)
+            if cached_plan(command, plan_key):
+                return 0
+
+            # run terraform directly (no shell), and stream its output to the console (or
+            # our output, e.g. prefixed fleet output)
+            argv = ['terraform'] + args
+            stdin = subprocess.DEVNULL if self.automation else None
+            result = run_process(argv, cwd=self.working_dir, env=command_env(), shell=False,
+                                 sinks=output_sinks(command, plan_key), stdin=stdin)
+            return report(result, tfpostmsg, command, plan_key)
+
+        async def aterraform(command, tf_targets=None, tf_args=None, on_line=None):
+            args, tfpostmsg, plan_key = command_args(command, tf_targets, tf_args)
+            if cached_plan(command, plan_key):
+                return 0
+            argv = ['terraform'] + args
+            env = command_env()
+            stdin = subprocess.DEVNULL if self.automation else None
+            result = await arun_process(argv, cwd=self.working_dir, env=env,
+                                        sinks=output_sinks(command, plan_key),
+                                        on_line=on_line, stdin=stdin)
+            return report(result, tfpostmsg, command, plan_key)
 
         self.terraform = terraform
+        self.aterraform = aterraform
 
-    @property
-    def tf_vars(self):
-        """Returns formatted vars ready for terraform cmd ex. -var='foo=bar' -var='biz=baz'"""
-        output = ' '.join(["-var '{0}={1}'".format(k, v) for k, v in self.__tf_vars.items()])
-        return output
+    def declared_variables(self):
+        '''returns the names of the variables declared in the .tf files'''
+        names = set()
+        for tf_file in Path(self.working_dir).glob('*.tf'):
+            names.update(self.VARIABLE_RE.findall(tf_file.read_text()))
+        return names
 
-    @tf_vars.setter
-    def tf_vars(self, tf_vars):
-        # unpacks tf vars
-        self.__tf_vars = {k: v for k, v in tf_vars}
+    def write_var_file(self):
+        '''
+        Writes the resolved variables that the .tf files declare to VAR_FILE, which terraform
+        loads automatically. The file is only rewritten when its content changes. It holds
+        secrets (e.g. the github client secret) so it's only readable by the current user.
+        '''
+        declared = self.declared_variables()
+        variables = {k: list(v) if isinstance(v, (list, tuple)) else v
+                     for k, v in self.tfvars.items() if k in declared}
+        text = json.dumps(variables, indent=2, sort_keys=True) + '\n'
+        return write_if_changed(Path(self.working_dir).joinpath(self.VAR_FILE), text)
 
     @property
     def drone_builder_role_arn(self):
-        '''Checks tfstate for arn if it exists'''
+        '''Checks tfstate outputs for the arn if it exists'''
         try:
-            dbra = self.tf_state["modules"][0]["outputs"]
-            arn = dbra["DRONE_BUILDER_ROLE_ARN"]["value"]
-            os.environ['DRONE_BUILDER_ROLE_ARN'] = arn
-            return arn
+            return self.state.outputs.get("DRONE_BUILDER_ROLE_ARN") or ''
         except Exception:
             return ''
 
@@ -148,27 +307,90 @@ class Terraform():
         self.drone_builder_role_arn = arn
 
     def load_tf_state(self):
-        '''Loads terraform state file if present.'''
-        try:
-            state_file = self.working_dir.joinpath('terraform.tfstate').resolve()
-            with open(state_file, "r") as read_file:
-                self.tf_state = json.load(read_file)
-            self.has_tf_state = True
-        except Exception:
-            self.has_tf_state = False
+        '''Points at the terraform state file (nothing is read until it's needed).'''
+        self.state = TfState(Path(self.working_dir).joinpath('terraform.tfstate'))
+
+    @property
+    def plans(self):
+        '''The saved plans for this deployment (see PlanCache).'''
+        return PlanCache(self.working_dir, self.state, self.env, self.tfvars)
+
+    @property
+    def has_tf_state(self):
+        '''True if there is a (json) state file. Doesn't parse the state.'''
+        return self.state.exists()
+
+    @property
+    def tf_state(self):
+        '''The whole state, parsed on every access. Prefer `state.outputs`.'''
+        return self.state.load()
 
     def init(self):
-        '''Runs 'terraform init' in the working directory.'''
-        self.terraform("init")
+        '''
+        Runs 'terraform init' in the working directory. If every provider (in a version the
+        .tf files allow) is in the shared plugin cache, they're hardlinked in and terraform
+        doesn't download any. Otherwise terraform downloads them into the cache, one init at
+        a time; terraform's plugin cache isn't safe for concurrent writers.
+        '''
+        cache = self.plugin_cache
+        if cache is None:
+            return self.terraform("init")
+        with cache.lock():
+            linked = cache.link_into(self.working_dir)
+        if linked and self.terraform("init", tf_args=self.OFFLINE_INIT_ARGS) == 0:
+            return 0
+        with cache.lock():
+            returncode = self.terraform("init")
+            if returncode == 0:
+                cache.collect(self.working_dir)
+        return returncode
 
     def plan(self, tf_targets=[]):
         '''Runs 'terraform plan' in the working directory.'''
-        self.terraform("plan", tf_targets)
+        return self.terraform("plan", tf_targets)
 
     def apply(self, tf_targets=[]):
         '''Runs 'terraform apply' in the working directory.'''
-        self.terraform("apply", tf_targets)
+        return self.terraform("apply", tf_targets)
 
     def destroy(self, tf_targets=[]):
         '''Runs 'terraform destroy' in the working directory.'''
-        self.terraform("destroy", tf_targets)
+        return self.terraform("destroy", tf_targets)
+
+    async def ainit(self, on_line=None):
+        '''Runs 'terraform init' (see init) without blocking the event loop.'''
+        cache = self.plugin_cache
+        if cache is None:
+            return await self.aterraform("init", on_line=on_line)
+        loop = asyncio.get_running_loop()
+        lock = cache.lock()
+        await loop.run_in_executor(None, lock.acquire)
+        try:
+            linked = cache.link_into(self.working_dir)
+        finally:
+            lock.release()
+        if linked:
+            args = self.OFFLINE_INIT_ARGS
+            if await self.aterraform("init", tf_args=args, on_line=on_line) == 0:
+                return 0
+        lock = cache.lock()
+        await loop.run_in_executor(None, lock.acquire)
+        try:
+            returncode = await self.aterraform("init", on_line=on_line)
+            if returncode == 0:
+                cache.collect(self.working_dir)
+        finally:
+            lock.release()
+        return returncode
+
+    async def aplan(self, tf_targets=[], on_line=None):
+        '''Runs 'terraform plan' without blocking the event loop.'''
+        return await self.aterraform("plan", tf_targets, on_line=on_line)
+
+    async def aapply(self, tf_targets=[], on_line=None):
+        '''Runs 'terraform apply' without blocking the event loop.'''
+        return await self.aterraform("apply", tf_targets, on_line=on_line)
+
+    async def adestroy(self, tf_targets=[], on_line=None):
+        '''Runs 'terraform destroy' without blocking the event loop.'''
+        return await self.aterraform("destroy", tf_targets, on_line=on_line)
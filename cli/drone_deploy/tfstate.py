@@ -0,0 +1,321 @@
+import os
+import re
+import json
+import codecs
+from pathlib import Path
+from drone_deploy.profiler import span
+
+# bytes read from the state file at a time (doubled until the outputs have been found)
+READ_SIZE = 64 * 1024
+
+# top level state values we keep along with the outputs
+STATE_INFO = ('version', 'terraform_version', 'serial', 'lineage')
+
+_WHITESPACE = re.compile(r'\s*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+_SCALAR = re.compile(r'[^,:{}\[\]\s]+')
+# strings (skipped whole), a string with no end yet, and brackets
+_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\]]', re.S)
+_decoder = json.JSONDecoder()
+# an AMI a resource uses, e.g. "ami": "ami-0edf58c4682eddea0" (terraform 0.11 and 0.12 states)
+_AMI = re.compile(r'"ami"\s*:\s*"(ami-[0-9a-f]+)"')
+
+
+class _Incomplete(Exception):
+    '''raised when the scanner runs off the end of the text read so far'''
+
+
+class _Scanner():
+    """
+    Walks a json document without building objects for the parts we skip. Used to pull the
+    outputs out of a terraform state without parsing its (much larger) resources.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def peek(self):
+        self.pos = _WHITESPACE.match(self.text, self.pos).end()
+        if self.pos >= len(self.text):
+            raise _Incomplete()
+        return self.text[self.pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at position {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        '''decodes and returns the next value'''
+        self.peek()
+        try:
+            value, self.pos = _decoder.raw_decode(self.text, self.pos)
+        except ValueError:
+            # could just be cut off, the caller decides once the whole file has been read
+            raise _Incomplete()
+        return value
+
+    def skip(self):
+        '''moves past the next value'''
+        char = self.peek()
+        if char == '"':
+            match = _STRING.match(self.text, self.pos)
+            if not match:
+                raise _Incomplete()
+            self.pos = match.end()
+        elif char in '{[':
+            depth = 0
+            for match in _TOKENS.finditer(self.text, self.pos):
+                token = match.group()
+                if token == '"':
+                    break
+                if token in '{[':
+                    depth += 1
+                elif token in '}]':
+                    depth -= 1
+                    if depth == 0:
+                        self.pos = match.end()
+                        return
+            raise _Incomplete()
+        else:
+            match = _SCALAR.match(self.text, self.pos)
+            if not match or match.end() >= len(self.text):
+                raise _Incomplete()
+            self.pos = match.end()
+
+    def next_item(self, close):
+        '''moves past a ',' and returns True, or past the closing char and returns False'''
+        char = self.peek()
+        self.pos += 1
+        if char == close:
+            return False
+        if char != ',':
+            raise ValueError(f"Expected ',' or '{close}' at position {self.pos - 1}")
+        return True
+
+    def keys(self):
+        '''yields each key of the next object, the caller must consume (or skip) its value'''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise ValueError(f"Expected a key at position {self.pos}")
+            key = self.value()
+            self.expect(':')
+            yield key
+            if not self.next_item('}'):
+                return
+
+    def items(self):
+        '''yields for each item of the next array, the caller must consume (or skip) it'''
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if not self.next_item(']'):
+                return
+
+
+def _output_values(outputs):
+    return {name: output.get('value') if isinstance(output, dict) else output
+            for name, output in outputs.items()}
+
+
+def scan_outputs(text):
+    '''
+    Returns the root module outputs ({name: value}) and the top level state info (serial,
+    lineage, etc.) from the beginning of a terraform state. Stops as soon as the outputs have
+    been found, which terraform writes before the resources. Raises _Incomplete if text ends
+    before then.
+    '''
+    scanner = _Scanner(text)
+    info = {'outputs': None}
+    for key in scanner.keys():
+        if key in STATE_INFO:
+            info[key] = scanner.value()
+
+        # terraform >= 0.12
+        elif key == 'outputs':
+            info['outputs'] = _output_values(scanner.value())
+
+        # terraform 0.11: modules[].outputs where the module path is ['root']
+        elif key == 'modules':
+            for _ in scanner.items():
+                path = outputs = None
+                for module_key in scanner.keys():
+                    if module_key == 'path':
+                        path = scanner.value()
+                    elif module_key == 'outputs':
+                        outputs = scanner.value()
+                    else:
+                        scanner.skip()
+                    if path == ['root'] and outputs is not None:
+                        info['outputs'] = _output_values(outputs)
+                        return info
+        else:
+            scanner.skip()
+
+        if info['outputs'] is not None:
+            return info
+
+    info['outputs'] = {}
+    return info
+
+
+class TfState():
+    """
+    Lazy, output only reader for a terraform.tfstate file. Nothing is read until it's
+    needed, and then only the beginning of the state (up to and including the outputs) is
+    parsed. The outputs (and amis) are memoized in <deployment>/.cache/tfstate-outputs.json,
+    keyed on the state's mtime, size, and inode. E.g.,
+        state = TfState(tf_dir.joinpath('terraform.tfstate'))
+        state.exists()                          # cheap, no parsing
+        state.outputs['DRONE_BUILDER_ROLE_ARN'] => 'arn:aws:iam::...'
+
+    Required Attributes
+    ----------
+    state_file: file
+        The full path to a terraform.tfstate file.
+
+    Properties
+    ----------
+    outputs: dict
+        The root module outputs, {name: value}. Empty if the state is missing or invalid.
+    info: dict
+        The state's serial, lineage, version, and terraform_version (plus outputs).
+
+    Methods
+    -------
+    exists
+        Returns True if the state file exists and looks like json.
+    load
+        Parses and returns the whole state (only use this if you need the resources).
+    amis
+        Returns the AMI ids the state's resources use (e.g. the drone server instance's).
+    reset
+        Forgets anything read so far (e.g. after terraform has updated the state).
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, state_file, cache_file=None):
+        self.state_file = Path(state_file)
+        if cache_file is None:
+            cache_file = self.state_file.parent.parent.joinpath('.cache', 'tfstate-outputs.json')
+        self.cache_file = Path(cache_file)
+        self.reset()
+
+    def reset(self):
+        self.__stat = None
+        self.__exists = None
+        self.__info = None
+
+    def __stat_key(self):
+        if self.__stat is None:
+            try:
+                stat = self.state_file.stat()
+                self.__stat = [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+            except OSError:
+                self.__stat = []
+        return self.__stat
+
+    def exists(self):
+        '''returns True if the state file is present and starts like a json object'''
+        if self.__exists is None:
+            self.__exists = False
+            if self.__stat_key() and self.__stat_key()[1] > 0:
+                try:
+                    with open(self.state_file, 'rb') as file:
+                        head = file.read(4096).lstrip()
+                    self.__exists = head.startswith(b'{')
+                except OSError:
+                    pass
+        return self.__exists
+
+    @property
+    def info(self):
+        if self.__info is None:
+            with span('tfstate outputs'):
+                cache = self.__load_cache() or {}
+                self.__info = cache.get('info') or self.__scan() or {'outputs': {}}
+        return self.__info
+
+    @property
+    def outputs(self):
+        return self.info['outputs']
+
+    def load(self):
+        '''parses the whole state file'''
+        with open(self.state_file, 'r') as read_file:
+            return json.load(read_file)
+
+    def amis(self):
+        '''
+        returns the set of AMI ids in the state's resources (scanned, not parsed, and
+        memoized with the outputs)
+        '''
+        if not self.exists():
+            return set()
+        cache = self.__load_cache()
+        if cache is not None and 'amis' in cache:
+            return set(cache['amis'])
+        try:
+            with span('tfstate amis'), open(self.state_file, 'r', errors='replace') as read_file:
+                amis = set(_AMI.findall(read_file.read()))
+        except OSError:
+            return set()
+        self.__save_cache(amis=sorted(amis))
+        return amis
+
+    def __scan(self):
+        '''reads the state a chunk at a time until the outputs have been found'''
+        if not self.exists():
+            return None
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        text = ''
+        read_size = READ_SIZE
+        try:
+            with open(self.state_file, 'rb') as file:
+                while True:
+                    data = file.read(read_size)
+                    text += decoder.decode(data, final=not data)
+                    try:
+                        info = scan_outputs(text)
+                        break
+                    except _Incomplete:
+                        if not data:
+                            return None
+                    read_size *= 2
+        except (OSError, ValueError):
+            return None
+
+        self.__save_cache(info=info)
+        return info
+
+    def __load_cache(self):
+        try:
+            with open(self.cache_file, 'r') as read_file:
+                cache = json.load(read_file)
+        except (OSError, ValueError):
+            return None
+        if cache.get('version') != self.CACHE_VERSION or cache.get('key') != self.__stat_key():
+            return None
+        return cache
+
+    def __save_cache(self, **values):
+        '''memoizes the outputs and/or amis (failing to cache is never fatal)'''
+        cache = self.__load_cache() or {}
+        cache.update(values)
+        try:
+            self.cache_file.parent.mkdir(exist_ok=True)
+            tmp_file = self.cache_file.with_suffix('.tmp')
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                json.dump(dict(cache, version=self.CACHE_VERSION, key=self.__stat_key()), file)
+            os.replace(tmp_file, self.cache_file)
+        except (OSError, TypeError, ValueError):
+            pass
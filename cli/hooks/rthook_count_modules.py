@@ -0,0 +1,20 @@
+# PyInstaller runtime hook (see drone-deploy.spec), also run before the cli from source by
+# benchmarks/bench_startup.py: with DRONE_DEPLOY_COUNT_MODULES set, prints the number of
+# imported modules to stderr when the process exits. Shell completion exits with os._exit,
+# which skips atexit, so that's wrapped too.
+import os
+
+if os.environ.get('DRONE_DEPLOY_COUNT_MODULES'):
+    import sys
+    import atexit
+
+    def _report_modules():
+        sys.stderr.write(f"modules: {len(sys.modules)}\n")
+        sys.stderr.flush()
+
+    def _exit_reporting_modules(code, _exit=os._exit):
+        _report_modules()
+        _exit(code)
+
+    atexit.register(_report_modules)
+    os._exit = _exit_reporting_modules
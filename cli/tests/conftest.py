@@ -6,6 +6,7 @@ import subprocess
 from cli import cli
 from pathlib import Path
 from click.testing import CliRunner
+from benchmarks.stubs import write_executable
 
 
 @pytest.fixture()
@@ -46,6 +47,17 @@ def terraform_cmd():
     return terraform
 
 
+@pytest.fixture()
+def stub_executable(tmp_path, monkeypatch):
+    '''
+    Returns a function that writes a fake executable first in the PATH (for this test only).
+    E.g., stub_executable('terraform', "#!/bin/sh\necho terraform $1\n")
+    '''
+    bin_dir = tmp_path.joinpath('bin')
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+    return lambda name, script: write_executable(bin_dir, name, script)
+
+
 def setup_test_dir():
     # setup the test deployment directory (recreate if present)
     test_dir = Path.cwd().joinpath('cli', 'tests', 'test-deployments')
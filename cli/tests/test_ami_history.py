@@ -0,0 +1,168 @@
+import io
+import json
+import threading
+import pytest
+from pathlib import Path
+from botocore.exceptions import NoCredentialsError
+from cli import cli
+from drone_deploy.deployment import Deployment
+from drone_deploy.ami_history import AmiHistory, delete_images
+from drone_deploy.tfstate import TfState
+
+
+class StandInEC2():
+    '''a local stand-in for the ec2 image and snapshot calls gc makes'''
+
+    def __init__(self, images):
+        # {AMI id: [snapshot ids]}
+        self.images = dict(images)
+        self.snapshots = {snapshot for snapshots in images.values() for snapshot in snapshots}
+        self.describe_calls = 0
+        self.lock = threading.Lock()
+
+    def describe_images(self, Owners, Filters):
+        self.describe_calls += 1
+        ids = Filters[0]['Values']
+        return {'Images': [{'ImageId': ami,
+                            'BlockDeviceMappings': [{'DeviceName': '/dev/sda1',
+                                                     'Ebs': {'SnapshotId': snapshot}}
+                                                    for snapshot in self.images[ami]]}
+                           for ami in ids if ami in self.images]}
+
+    def deregister_image(self, ImageId):
+        with self.lock:
+            del self.images[ImageId]
+
+    def delete_snapshot(self, SnapshotId):
+        with self.lock:
+            if any(SnapshotId in snapshots for snapshots in self.images.values()):
+                raise Exception(f"{SnapshotId} is in use by an AMI")
+            self.snapshots.remove(SnapshotId)
+
+
+class StandInSession():
+
+    def __init__(self, images):
+        self.ec2 = StandInEC2(images)
+        self.endpoint_urls = set()
+
+    def client(self, name, region_name=None, endpoint_url=None):
+        self.endpoint_urls.add(endpoint_url)
+        return self.ec2
+
+
+def manifest(builds):
+    return {'builds': [{'artifact_id': artifact_id, 'build_time': build_time,
+                        'packer_run_uuid': f"run-{build_time}",
+                        'custom_data': {'build_fingerprint': f"fp{build_time}",
+                                        'drone_deployment_id': 'fb8b32847f4f9569d9094d966af7a0cb'}}
+                       for artifact_id, build_time in builds],
+            'last_run_uuid': f"run-{builds[-1][1]}"}
+
+
+@pytest.fixture()
+def manifests(new_deployment):
+    packer_dir = Path.cwd().joinpath('deployments', 'foo', 'packer')
+    files = {'manifest.json': manifest([('us-east-1:ami-01,us-west-2:ami-w1', 100),
+                                        ('us-east-1:ami-02', 200),
+                                        ('us-east-1:ami-03', 300),
+                                        ('us-east-1:ami-04', 400)]),
+             'base-manifest.json': manifest([('us-east-1:ami-b1', 50), ('us-east-1:ami-b2', 150)])}
+    for name, data in files.items():
+        packer_dir.joinpath(name).write_text(json.dumps(data))
+    packer_dir.parent.joinpath('terraform', 'terraform.tfstate').write_text(json.dumps(
+        {'version': 4, 'outputs': {}, 'resources': [
+            {'type': 'aws_instance', 'instances': [{'attributes': {'ami': 'ami-02'}}]}]}))
+    yield packer_dir
+    for name in files:
+        packer_dir.joinpath(name).unlink()
+    packer_dir.parent.joinpath('terraform', 'terraform.tfstate').unlink()
+
+
+def test_tfstate_amis(manifests):
+    state = TfState(manifests.parent.joinpath('terraform', 'terraform.tfstate'))
+    assert state.amis() == {'ami-02'}
+    assert TfState(manifests.joinpath('missing.tfstate')).amis() == set()
+
+
+def test_ami_history_index_and_garbage(manifests):
+    history = AmiHistory(manifests, {'server': 'manifest.json', 'base': 'base-manifest.json'},
+                         in_use={'ami-02'})
+    assert [build.ami for build in history] == ['ami-04', 'ami-03', 'ami-02', 'ami-b2', 'ami-01',
+                                                'ami-w1', 'ami-b1']
+    assert history['ami-w1'].region == 'us-west-2' and history['ami-w1'].fingerprint == 'fp100'
+    assert history['ami-04'].current and history['ami-b2'].current
+    assert history['ami-02'].in_use and not history['ami-03'].in_use
+
+    assert {build.ami for build in history.garbage(keep=1)} == {'ami-03', 'ami-01', 'ami-b1'}, \
+        'The current and in use AMIs should be kept, along with the newest per kind and region.'
+    assert {build.ami for build in history.garbage(keep=2)} == {'ami-01'}
+
+
+def test_delete_images_batches_and_deletes_snapshots_after_deregistering(manifests):
+    history = AmiHistory(manifests, {'server': 'manifest.json'})
+    session = StandInSession({'ami-01': ['snap-1a', 'snap-1b'], 'ami-w1': ['snap-w1'],
+                              'ami-02': ['snap-2'], 'ami-04': ['snap-4']})
+    garbage = [history['ami-01'], history['ami-w1'], history['ami-02'], history['ami-03']]
+    deleted, errors = delete_images(session, garbage, stream=io.StringIO(),
+                                    endpoint_url='http://localhost:5000')
+    assert errors == {}
+    assert deleted == ['ami-01', 'ami-w1', 'ami-02', 'ami-03'], 'AMIs that are already gone count as deleted.'
+    assert session.ec2.images == {'ami-04': ['snap-4']}
+    assert session.ec2.snapshots == {'snap-4'}
+    assert session.ec2.describe_calls == 2, 'Images should be described in one call per region.'
+    assert session.endpoint_urls == {'http://localhost:5000'}
+
+    history.remove(deleted)
+    assert [build.ami for build in history] == ['ami-04']
+    saved = json.loads(manifests.joinpath('manifest.json').read_text())
+    assert [build['artifact_id'] for build in saved['builds']] == ['us-east-1:ami-04']
+
+
+def test_packer_gc_amis(manifests):
+    deployment = Deployment(manifests.parent.joinpath('config.yaml').resolve())
+    session = StandInSession({'ami-01': ['snap-1'], 'ami-03': ['snap-3'], 'ami-b1': ['snap-b1']})
+    dry_run = deployment.packer.gc_amis(1, {'ami-02'}, dry_run=True, session=session)
+    assert {build.ami for build in dry_run} == {'ami-01', 'ami-03', 'ami-b1'}
+    assert len(session.ec2.images) == 3, 'A dry run should not delete anything.'
+
+    deleted = deployment.packer.gc_amis(1, {'ami-02'}, session=session)
+    assert {build.ami for build in deleted} == {'ami-01', 'ami-03', 'ami-b1'}
+    assert session.ec2.images == {} and session.ec2.snapshots == set()
+    assert {build.ami for build in deployment.packer.history()} == {'ami-w1', 'ami-02', 'ami-04', 'ami-b2'}
+    assert deployment.packer.drone_server_ami == 'ami-04'
+
+
+def test_cli_ami_list_and_gc_dry_run(runner, manifests):
+    result = runner.invoke(cli, ['ami', 'list', 'foo'])
+    assert result.exit_code == 0
+    lines = result.output.strip().split('\n')
+    assert lines[0].split()[:3] == ['AMI', 'REGION', 'KIND']
+    assert len(lines) == 8
+    assert [line for line in lines if line.startswith('ami-02 ')][0].endswith('in use')
+
+    result = runner.invoke(cli, ['ami', 'gc', 'foo', '--keep', '1', '--dry-run'])
+    assert result.exit_code == 0
+    assert 'Would delete:' in result.output
+    assert {line.split()[0] for line in result.output.strip().split('\n')[2:]} == {'ami-01', 'ami-03', 'ami-b1'}
+
+
+def test_cli_ami_gc_confirms_and_reports_aws_errors(runner, manifests, mocker):
+    session = StandInSession({'ami-01': ['snap-1'], 'ami-03': ['snap-3'], 'ami-b1': ['snap-b1']})
+    builder_session = mocker.patch('drone_deploy.packer.Packer.builder_session', return_value=session)
+    result = runner.invoke(cli, ['ami', 'gc', 'foo', '--keep', '1'], input='n\n')
+    assert result.exit_code == 1 and 'Aborted' in result.output
+    assert len(session.ec2.images) == 3, 'Nothing should be deleted without confirmation.'
+
+    builder_session.side_effect = NoCredentialsError()
+    result = runner.invoke(cli, ['ami', 'gc', 'foo', '--keep', '1', '--yes'])
+    assert result.exit_code == 1 and 'Error: Unable to locate credentials' in result.output
+    assert result.exception is None or isinstance(result.exception, SystemExit), \
+        'AWS errors should be reported, not raised.'
+
+    builder_session.side_effect = None
+    result = runner.invoke(cli, ['ami', 'gc', 'foo', '--keep', '1', '--yes',
+                                 '--endpoint-url', 'http://localhost:5000'])
+    assert result.exit_code == 0 and 'Deleted 3 AMI(s)' in result.output
+    builder_session.assert_called_with(endpoint_url='http://localhost:5000')
+    assert session.endpoint_urls == {'http://localhost:5000'}
@@ -0,0 +1,112 @@
+import io
+import json
+import pytest
+from pathlib import Path
+from drone_deploy.deployment import Deployment
+from drone_deploy.new_deployment_cli import set_config_values
+from drone_deploy.ami_regions import (parse_artifact_id, format_artifact_id, parse_regions,
+                                      copy_to_regions)
+
+
+class FakeEC2():
+    '''just enough of a boto3 ec2 client to copy images'''
+
+    def __init__(self, region, fail=False):
+        self.region = region
+        self.fail = fail
+        self.tags = {}
+        self.copies = set()
+
+    def describe_images(self, ImageIds):
+        ami = ImageIds[0]
+        if ami not in self.copies:
+            return {'Images': [{'Name': 'drone-server-ami', 'Description': 'drone',
+                                'Tags': [{'Key': 'drone_deployment_id', 'Value': 'abc'}],
+                                'State': 'available'}]}
+        return {'Images': [{'State': 'failed' if self.fail else 'available'}]}
+
+    def copy_image(self, SourceRegion, SourceImageId, Name, Description):
+        self.copies.add(f"ami-{self.region}")
+        return {'ImageId': f"ami-{self.region}"}
+
+    def create_tags(self, Resources, Tags):
+        self.tags[Resources[0]] = Tags
+
+
+class FakeSession():
+
+    def __init__(self, fail_regions=()):
+        self.fail_regions = fail_regions
+        self.clients = {}
+
+    def client(self, name, region_name=None):
+        return self.clients.setdefault(region_name,
+                                       FakeEC2(region_name, region_name in self.fail_regions))
+
+
+def test_parse_and_format_artifact_id():
+    amis = parse_artifact_id('us-east-1:ami-0edf58c4682eddea0,us-west-2:ami-0a1b2c3d4e5f67890')
+    assert amis == {'us-east-1': 'ami-0edf58c4682eddea0', 'us-west-2': 'ami-0a1b2c3d4e5f67890'}
+    assert format_artifact_id(amis) == 'us-east-1:ami-0edf58c4682eddea0,us-west-2:ami-0a1b2c3d4e5f67890'
+    assert parse_artifact_id('') == {}
+
+
+def test_parse_regions():
+    assert parse_regions(' us-west-2,eu-west-1,,us-west-2') == ['us-west-2', 'eu-west-1']
+    assert parse_regions(None) == []
+
+
+def test_copy_to_regions_copies_in_parallel_and_reports_progress():
+    stream = io.StringIO()
+    session = FakeSession(fail_regions=['eu-west-1'])
+    amis, errors = copy_to_regions(session, 'us-east-1', 'ami-src', ['us-west-2', 'eu-west-1'],
+                                   stream=stream, poll_interval=0)
+    assert amis == {'us-west-2': 'ami-us-west-2'}
+    assert list(errors) == ['eu-west-1']
+    assert session.clients['us-west-2'].tags['ami-us-west-2'][0]['Key'] == 'drone_deployment_id', \
+        'Tags should be copied with the image.'
+    output = stream.getvalue()
+    assert '[us-west-2] available ami-us-west-2' in output
+    assert '[eu-west-1] failed' in output
+    assert output.strip().split('\n')[-3].split() == ['REGION', 'AMI', 'STATUS', 'TIME']
+
+
+@pytest.fixture()
+def multi_region_manifest_file():
+    manifest_file = Path.cwd().joinpath('deployments', 'foo', 'packer', 'manifest.json')
+    manifest = {'builds': [{'artifact_id': 'us-west-2:ami-0a1b2c3d4e5f67890,us-east-1:ami-0edf58c4682eddea0',
+                            'packer_run_uuid': 'run-1',
+                            'custom_data': {'drone_deployment_id': 'fb8b32847f4f9569d9094d966af7a0cb'}}],
+                'last_run_uuid': 'run-1'}
+    manifest_file.write_text(json.dumps(manifest))
+    yield manifest_file
+    manifest_file.unlink()
+
+
+def test_region_env_override_picks_its_ami(new_deployment, multi_region_manifest_file, monkeypatch):
+    config_file = Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve()
+    original = config_file.read_text()
+    try:
+        set_config_values(config_file.parent, {'drone_aws_region': 'us-east-1'})
+        monkeypatch.setenv('DRONE_AWS_REGION', 'us-west-2')
+        deployment = Deployment(config_file)
+        assert deployment.packer.region == 'us-west-2'
+        assert deployment.packer.drone_server_ami == 'ami-0a1b2c3d4e5f67890', \
+            "The AMI for the overridden region should be used, not config.yaml's."
+        assert deployment.resolved['drone_server_ami'] == 'ami-0a1b2c3d4e5f67890'
+    finally:
+        config_file.write_text(original)
+
+
+def test_packer_picks_the_ami_for_its_region(new_deployment, multi_region_manifest_file, mocker):
+    deployment = Deployment(Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve())
+    packer = deployment.packer
+    packer.packer_vars = [('drone_aws_region', 'us-east-1')]
+    packer.load_artifacts()
+    assert packer.drone_server_ami == 'ami-0edf58c4682eddea0', "The AMI for the deployment's region should be used."
+
+    mocker.patch.object(packer, 'builder_session', return_value=FakeSession())
+    assert packer.copy_to_regions('us-east-1,eu-west-1') == {'eu-west-1': 'ami-eu-west-1'}, \
+        'Only regions without the AMI should be copied to.'
+    assert packer.amis['eu-west-1'] == 'ami-eu-west-1', 'Copies should be saved in the manifest.'
+    assert packer.copy_to_regions(['eu-west-1']) == {}
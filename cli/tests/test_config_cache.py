@@ -0,0 +1,79 @@
+import os
+import time
+from pathlib import Path
+from drone_deploy.deployment import Deployment
+from drone_deploy import config_cache
+from drone_deploy.config_cache import ConfigCache
+
+
+def load_cached_foo():
+    config_file = Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve()
+    return Deployment(config_file, use_cache=True)
+
+
+def test_config_cache_is_reused_when_nothing_changed(new_deployment):
+    # the first load resolves the config and caches it
+    load_cached_foo()
+    first = load_cached_foo()
+    second = load_cached_foo()
+    assert second.from_cache is True, 'Deployment should have been loaded from the cache.'
+    assert second.config['drone_deployment_name'] == first.config['drone_deployment_name']
+    assert 'DEPLOYMENT CONFIG FILE' in str(second), 'Cached deployment should render its config.'
+    assert 'has not been deployed' in second.deployment_status
+
+
+def test_config_cache_file_is_private(new_deployment):
+    load_cached_foo()
+    cache_file = Path.cwd().joinpath('deployments', 'foo', '.cache', 'resolved-config.json')
+    assert cache_file.exists(), 'The resolved config was not cached.'
+    assert oct(cache_file.stat().st_mode & 0o777) == oct(0o600), 'Cache file should be 0600.'
+
+
+def test_config_cache_invalidated_by_config_changes(new_deployment):
+    load_cached_foo()
+    load_cached_foo()
+    config_file = Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve()
+    original = config_file.read_text()
+    try:
+        time.sleep(0.01)
+        config_file.write_text(original + '# changed\n')
+        assert load_cached_foo().from_cache is False, 'Changing config.yaml should invalidate the cache.'
+    finally:
+        config_file.write_text(original)
+
+
+def test_config_cache_only_hashes_files_whose_metadata_changed(new_deployment, mocker):
+    load_cached_foo()
+    load_cached_foo()
+    file_hash = mocker.patch('drone_deploy.config_cache.file_hash', side_effect=config_cache.file_hash)
+    assert load_cached_foo().from_cache is True
+    assert file_hash.call_count == 0, 'An unchanged deployment should be checked with stat calls only.'
+
+    # touched, but the same contents: only config.yaml is hashed, and the cache is still good
+    config_file = Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve()
+    time.sleep(0.01)
+    config_file.touch()
+    assert load_cached_foo().from_cache is True, 'Touching config.yaml should not invalidate the cache.'
+    assert [call[0][0] for call in file_hash.call_args_list] == [config_file]
+
+    # and the cache's key was updated, so the next load doesn't hash anything
+    file_hash.reset_mock()
+    assert load_cached_foo().from_cache is True
+    assert file_hash.call_count == 0
+
+
+def test_config_cache_key_includes_env_vars(new_deployment):
+    config_file = Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve()
+    names = ['DRONE_AWS_REGION']
+    key = ConfigCache(config_file, env_names=names, environ={}).key
+    assert ConfigCache(config_file, env_names=names, environ={}).key == key
+    other = ConfigCache(config_file, env_names=names, environ={'DRONE_AWS_REGION': 'us-west-2'})
+    assert other.key != key, 'Changing an env var should change the cache key.'
+
+
+def test_config_cache_ignores_corrupt_cache_file(new_deployment):
+    config_file = Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve()
+    cache = ConfigCache(config_file, environ=os.environ)
+    cache.cache_file.parent.mkdir(exist_ok=True)
+    cache.cache_file.write_text('}garbilygook}')
+    assert cache.load() is None, 'A corrupt cache file should be treated as a miss.'
@@ -1,6 +1,10 @@
 import os
+import importlib
+import sys
+import subprocess
+from pathlib import Path
 from packaging import version
-from cli import cli
+from cli import cli, SUB_COMMANDS
 
 def test_cli_smoke_test(runner):
     '''smoke test'''
@@ -12,3 +16,42 @@ def test_cli_smoke_test(runner):
 def test_cli_version(runner):
     result = runner.invoke(cli, ["version"])
     assert version.parse(result.output) > version.parse("0.0.1"), 'drone-deploy version should return a valid version greater than 0.0.1'
+
+
+def test_cli_help_lists_lazy_sub_commands(runner):
+    result = runner.invoke(cli, ["--help"])
+    for command in ["ami", "build-ami", "deploy", "destroy", "edit", "init", "list", "new", "plan",
+                    "prepare", "show", "show-agent-command", "version"]:
+        assert command in result.output, f"'drone-deploy --help' did not list '{command}'."
+
+
+def test_cli_version_does_not_import_sub_commands():
+    '''sub command modules (and their dependencies) should only be imported when run'''
+    cli_dir = Path(__file__).parent.parent
+    code = ("import sys; from cli import cli; cli(['version'], standalone_mode=False); "
+            "print(','.join(sys.modules))")
+    p = subprocess.run([sys.executable, '-c', code], cwd=cli_dir, stdout=subprocess.PIPE,
+                       text=True)
+    modules = p.stdout.strip().split('\n')[-1].split(',')
+    for module in ['ruamel.yaml', 'requests', 'drone_deploy.deployment', 'drone_deploy.init_cli']:
+        assert module not in modules, f"'drone-deploy version' imported {module}."
+
+
+def test_cli_sub_commands_short_help():
+    '''the static short help listed by `drone-deploy --help` matches each command's own'''
+    for name, (module, attribute, short_help) in SUB_COMMANDS.items():
+        command = getattr(importlib.import_module(module), attribute)
+        assert command.get_short_help_str() == short_help, \
+            f"SUB_COMMANDS['{name}'] is out of date with {module}.{attribute}.short_help"
+
+
+def test_count_modules_runtime_hook():
+    '''the binary's runtime hook reports the imported modules, even on os._exit'''
+    hook = Path(__file__).parent.parent.joinpath('hooks', 'rthook_count_modules.py')
+    code = f"exec(open({str(hook)!r}).read()); import os; os._exit(0)"
+    env = dict(os.environ, DRONE_DEPLOY_COUNT_MODULES='1')
+    p = subprocess.run([sys.executable, '-c', code], env=env, stderr=subprocess.PIPE, text=True)
+    assert p.stderr.startswith('modules: ')
+    p = subprocess.run([sys.executable, '-c', code], stderr=subprocess.PIPE, text=True,
+                       env={k: v for k, v in os.environ.items() if k != 'DRONE_DEPLOY_COUNT_MODULES'})
+    assert p.stderr == '', 'Nothing should be reported unless asked for.'
@@ -1,6 +1,9 @@
+import os
 import sys
+import subprocess
+from pathlib import Path
 import drone_deploy.deploy_cli
-from io import StringIO
+from drone_deploy.filter import deployment_names
 
 
 def test_cli_autocompletion(runner, new_deployment, new_deployment2):
@@ -20,19 +23,50 @@ def test_cli_autocompletion(runner, new_deployment, new_deployment2):
 
         filters = ["", "f", "ba"]
         for filter in filters:
-            # capture stdout
-            old_stdout = sys.stdout
-            sys.stdout = result = StringIO()
-            dc.filter_deployments(ctx=[], args=[], incomplete=filter)
-            deploys = result.getvalue().split("\n")
-            sys.stdout = old_stdout
-
-            # account for an extra blank new line in result count
+            # click prints the names the callback returns
+            deploys = dc.filter_deployments(ctx=[], args=[], incomplete=filter)
+
             if filter == '':
-                assert len(deploys) >= 3, 'Should be at least two deployment in autocomplete list.'
+                assert len(deploys) >= 2, 'Should be at least two deployment in autocomplete list.'
             elif filter == 'f':
-                assert len(deploys) == 2, 'Should only be one deployment in autocomplete list.'
+                assert len(deploys) == 1, 'Should only be one deployment in autocomplete list.'
                 assert 'foo' in deploys, 'Expected `foo` to be in autocomplete list when filtering for `f`'
             elif filter == 'ba':
-                assert len(deploys) == 2, 'Should only be one deployment in autocomplete list.'
+                assert len(deploys) == 1, 'Should only be one deployment in autocomplete list.'
                 assert 'bar' in deploys, 'Expected `bar` to be in autocomplete list when filtering for `ba`'
+
+
+def test_deployment_index_is_rebuilt_when_deployments_change(tmp_path):
+    deployments = tmp_path.joinpath('deployments')
+    for name in ('b.acme.com', 'a.acme.com', '.hidden'):
+        deployments.joinpath(name).mkdir(parents=True)
+    assert deployment_names(tmp_path) == ['a.acme.com', 'b.acme.com']
+    index_file = tmp_path.joinpath('.cache', 'deployments-index')
+    assert index_file.read_text().splitlines()[1:] == ['a.acme.com', 'b.acme.com']
+
+    # answered from the index while the deployments dir is unchanged
+    index_file.write_text(index_file.read_text() + 'only-in-index\n')
+    assert deployment_names(tmp_path)[-1] == 'only-in-index'
+
+    deployments.joinpath('c.acme.com').mkdir()
+    assert deployment_names(tmp_path) == ['a.acme.com', 'b.acme.com', 'c.acme.com']
+    assert deployment_names(tmp_path.joinpath('missing')) == []
+
+
+def test_shell_completion_does_not_import_commands(runner, new_deployment, new_deployment2):
+    cli_dir = Path(__file__).resolve().parent.parent
+    # click ends completion with os._exit, so report the imported modules from there
+    code = ("import os, sys; sys.path.insert(0, sys.argv[1]); _exit = os._exit; "
+            "os._exit = lambda code: (sys.stderr.write(' '.join(sorted("
+            "m for m in sys.modules if m.startswith('drone_deploy')))), _exit(code)); "
+            "from cli import cli; cli(prog_name='drone-deploy')")
+    for words, expected in (('drone-deploy deploy f', ['foo']),
+                            ('drone-deploy ami list ba', ['bar'])):
+        env = dict(os.environ, _DRONE_DEPLOY_COMPLETE='complete', COMP_WORDS=words,
+                   COMP_CWORD=str(len(words.split()) - 1))
+        p = subprocess.run([sys.executable, '-c', code, str(cli_dir)], env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        assert p.stdout.split() == expected
+        assert p.stderr.split() == ['drone_deploy', 'drone_deploy.filter',
+                                    'drone_deploy.lazy_group'], \
+            'Completion should only import click and the completion helpers.'
@@ -1,12 +1,19 @@
 import subprocess
 from cli import cli
+from pathlib import Path
 
 
-def test_cli_build_ami(runner, new_deployment, mocker):
+def test_cli_build_ami(runner, new_deployment, mocker, monkeypatch):
     '''drone-deploy build-ami'''
+    # build on an existing base AMI (otherwise the base would be built first)
+    monkeypatch.setenv('DRONE_SERVER_BASE_AMI', 'ami-0123456789abcdef0')
     mocker.patch('subprocess.Popen')
+    mocker.patch('shutil.which', return_value='/usr/local/bin/packer')
+    mocker.patch('drone_deploy.packer.Packer.assume_builder_role', return_value={})
     runner.invoke(cli, ["build-ami", "foo"])
     call_list = f'{subprocess.Popen.call_args}'    # noqa
-    assert './build-drone-server-ami.sh' in call_list, "'drone-deploy build-ami' did not call ./build-drone-server-ami.sh as expected."
-    assert 'TF_VAR_drone_github_server' in call_list, 'Did not find an expected TF_VAR_ env var in a call to ./build-drone-server-ami.sh'
-    assert subprocess.Popen.call_count == 1, "'drone-deploy build-ami' should only call build script once."    # noqa
\ No newline at end of file
+    assert "'/usr/local/bin/packer', 'build'" in call_list, "'drone-deploy build-ami' did not call packer build as expected."
+    assert 'DRONE_GITHUB_SERVER' in call_list, 'Did not find an expected DRONE_ env var in a call to packer'
+    var_file = Path.cwd().joinpath('deployments', 'foo', 'packer', 'drone-deploy.vars.json')
+    assert 'drone_aws_region' in var_file.read_text(), 'Did not find an expected variable in the packer var file.'
+    assert subprocess.Popen.call_count == 1, "'drone-deploy build-ami' should only call packer once."    # noqa
\ No newline at end of file
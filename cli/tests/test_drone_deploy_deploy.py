@@ -1,4 +1,5 @@
 from cli import cli
+from pathlib import Path
 import subprocess
 
 
@@ -7,6 +8,7 @@ def test_cli_deploy(runner, new_deployment, mocker):
     mocker.patch('subprocess.Popen')
     runner.invoke(cli, ["deploy", "foo"])
     call_list = f'{subprocess.Popen.call_args}'    # noqa
-    assert 'terraform apply' in call_list, "'drone-deploy deploy' did not call 'terraform apply' as expected."
-    assert 'TF_VAR_drone_github_server' in call_list, "Did not find an expected TF_VAR_ env var in a call to 'terraform apply'"
+    assert "'terraform', 'apply'" in call_list, "'drone-deploy deploy' did not call 'terraform apply' as expected."
+    var_file = Path.cwd().joinpath('deployments', 'foo', 'terraform', 'drone-deploy.auto.tfvars.json')
+    assert 'drone_github_server' in var_file.read_text(), 'Did not find an expected variable in the tfvars file.'
     assert subprocess.Popen.call_count == 1, "'drone-deploy deploy' should only call 'terraform apply' once."    # noqa
@@ -13,8 +13,9 @@ def test_cli_destroy_deployment(runner, terraform_cmd, mocker):
     mocker.patch('subprocess.Popen')
     runner.invoke(cli, ["destroy", "foobar"])
     call_list = f'{subprocess.Popen.call_args}'    # noqa
-    assert 'terraform destroy' in call_list, "'drone-deploy destroy' did not call 'terraform destroy' as expected."
-    assert 'TF_VAR_drone_github_server' in call_list, "Did not find an expected TF_VAR_ env var in a call to 'terraform destroy'"
+    assert "'terraform', 'destroy'" in call_list, "'drone-deploy destroy' did not call 'terraform destroy' as expected."
+    var_file = Path.cwd().joinpath('deployments', 'foobar', 'terraform', 'drone-deploy.auto.tfvars.json')
+    assert 'drone_github_server' in var_file.read_text(), 'Did not find an expected variable in the tfvars file.'
     assert subprocess.Popen.call_count == 1, "'drone-deploy destroy' should only call 'terraform destroy' once."    # noqa
 
 
@@ -31,7 +32,7 @@ def test_cli_destroy_deployment_with_rm(runner, terraform_cmd, mocker):
     # mocker.patch('subprocess.Popen')
     # runner.invoke(cli, ["destroy", "foobar"])
     # call_list = f'{subprocess.Popen.call_args}'    # noqa
-    # assert 'terraform destroy' in call_list, "'drone-deploy destroy' did not call 'terraform destroy' as expected."
+    # assert "'terraform', 'destroy'" in call_list, "'drone-deploy destroy' did not call 'terraform destroy' as expected."
     # assert 'TF_VAR_drone_github_server' in call_list, "Did not find an expected TF_VAR_ env var in a call to 'terraform destroy'"
     # assert subprocess.Popen.call_count == 1, "'drone-deploy destroy' should only call 'terraform destroy' once."    # noqa
 
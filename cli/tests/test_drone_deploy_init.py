@@ -1,11 +1,16 @@
+import io
 import os
 import shutil
+import hashlib
+import zipfile
 import pytest
+import requests
 import drone_deploy
 from cli import cli
 from pathlib import Path, PosixPath
 from click.testing import CliRunner
-from drone_deploy.init_cli import setup_templates as cli_setup_templates
+from drone_deploy.init_cli import setup_templates as cli_setup_templates, copy_templates_from_repo
+from drone_deploy.template_cache import TemplateCache, TemplateError, pack_templates
 
 
 @pytest.fixture()
@@ -140,6 +145,84 @@ def test_setup_templates_from_src(mocker):
     assert drone_deploy.init_cli.copy_templates_from_repo.called is False, 'setup_templates tried to copy from repo'
 
 
-def test_setup_templates_from_repo(mocker):
-    # TODO
-    pass
+def templates_zip(base='drone-deploy-0.1.21'):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        archive.writestr(f'{base}/README.md', 'not a template')
+        archive.writestr(f'{base}/templates/config.yaml', 'drone_deployment_name: foo')
+        script = zipfile.ZipInfo(f'{base}/templates/packer/build-scripts/cleanup.sh')
+        script.external_attr = 0o755 << 16
+        archive.writestr(script, '#!/usr/bin/env bash')
+    return data.getvalue()
+
+
+class FakeResponse():
+
+    def __init__(self, content):
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+def test_setup_templates_from_repo(mocker, tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path.joinpath('cache')))
+    monkeypatch.setenv('DRONE_DEPLOY_TEMPLATES_REPO', 'https://example.com/me/drone-fork')
+    get = mocker.patch('requests.get', return_value=FakeResponse(templates_zip('drone-fork-0.1.21')))
+    mocker.patch('version.__version__', '0.1.21')
+
+    templates = tmp_path.joinpath('templates')
+    copy_templates_from_repo(templates)
+    assert get.call_args[0][0] == 'https://example.com/me/drone-fork/archive/0.1.21.zip'
+    assert get.call_args[1]['stream'] is True, 'The archive should be streamed to disk.'
+    assert templates.joinpath('config.yaml').read_text() == 'drone_deployment_name: foo'
+    assert os.access(templates.joinpath('packer', 'build-scripts', 'cleanup.sh'), os.X_OK)
+    assert not templates.joinpath('README.md').exists(), 'Only templates/ should be extracted.'
+
+    # a repeat (or offline) init uses the cached archive
+    get.side_effect = requests.ConnectionError('offline')
+    copy_templates_from_repo(tmp_path.joinpath('templates2'))
+    assert get.call_count == 1
+    assert tmp_path.joinpath('templates2', 'config.yaml').exists()
+
+
+def test_template_cache_downloads_again_when_the_archive_is_damaged(mocker, tmp_path):
+    get = mocker.patch('requests.get', return_value=FakeResponse(templates_zip()))
+    cache = TemplateCache('0.1.21', cache_dir=tmp_path)
+    assert cache.extract(tmp_path.joinpath('a')) is False
+    assert cache.checksum_file.read_text().split()[0] == hashlib.sha256(templates_zip()).hexdigest()
+    assert cache.extract(tmp_path.joinpath('b')) is True
+
+    cache.archive_file.write_bytes(b'damaged')
+    assert cache.extract(tmp_path.joinpath('c')) is False
+    assert get.call_count == 2
+
+    get.return_value = FakeResponse(b'<html>not found</html>')
+    with pytest.raises(TemplateError):
+        TemplateCache('0.0.0', cache_dir=tmp_path).archive()
+    assert not list(tmp_path.rglob('0.0.0.zip*')), "A bad download shouldn't be cached."
+
+
+def test_setup_templates_from_release(mocker, tmp_path):
+    '''the release exe extracts its embedded templates instead of downloading them'''
+    templates_dir = Path(__file__).parent.parent.parent.joinpath('templates')
+    archive = pack_templates(templates_dir, tmp_path.joinpath('templates.zip'), '0.1.21')
+    mocker.patch('drone_deploy.init_cli.source_templates_dir', return_value=None)
+    mocker.patch('drone_deploy.init_cli.embedded_templates', return_value=open(archive, 'rb'))
+    get = mocker.patch('requests.get')
+
+    cli_setup_templates(tmp_path.joinpath('templates'))
+    assert get.called is False, 'The templates should not be downloaded.'
+    assert sorted(path.relative_to(tmp_path.joinpath('templates')) for path in
+                  tmp_path.joinpath('templates').rglob('*') if path.is_file()) == \
+        sorted(path.relative_to(templates_dir) for path in templates_dir.rglob('*') if path.is_file())
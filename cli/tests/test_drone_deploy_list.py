@@ -1,4 +1,9 @@
+import os
+import json
+from pathlib import Path
 from cli import cli
+from drone_deploy.filter import filter_deployments
+from drone_deploy.deployment_summary import summarize, summarize_all
 
 
 def test_cli_list(runner, new_deployment):
@@ -6,3 +11,73 @@ def test_cli_list(runner, new_deployment):
     result = runner.invoke(cli, ["list"])
     assert result.exit_code == 0, "Error running 'drone-deploy list'"
     assert 'foo' in new_deployment.output, "'drone-deploy list' did not contain the expected new_deployment."
+
+
+def write_state(deployment_dir, resources, outputs=None, serial=5):
+    state_file = deployment_dir.joinpath('terraform', 'terraform.tfstate')
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    state_file.write_text(json.dumps({"version": 4, "serial": serial, "outputs": outputs or {},
+                                      "resources": resources}))
+    return state_file
+
+
+def test_summarize_deployments(tmp_path):
+    deployments = tmp_path.joinpath('deployments')
+    instance = [{"type": "aws_instance", "instances": [{"attributes": {"ami": "ami-0abc"}}]}]
+
+    deployed = deployments.joinpath('deployed')
+    deployed.mkdir(parents=True)
+    deployed.joinpath('config.yaml').write_text('drone_aws_region: us-east-1\n')
+    state_file = write_state(deployed, instance)
+    os.utime(deployed.joinpath('config.yaml'), (1000, 1000))
+    os.utime(state_file, (2000, 2000))
+
+    destroyed = deployments.joinpath('destroyed')
+    write_state(destroyed, [], serial=9)
+    deployments.joinpath('new', 'terraform').mkdir(parents=True)
+
+    summary = summarize(deployed)
+    assert (summary.deployed, summary.ami, summary.serial, summary.applied_at) == \
+        (True, 'ami-0abc', 5, 2000)
+    assert not summary.config_changed
+    os.utime(deployed.joinpath('config.yaml'), (3000, 3000))
+    assert summarize(deployed).config_changed, 'config.yaml changed after the last apply.'
+
+    summaries = summarize_all(deployments, ['destroyed', 'new'])
+    assert [s.name for s in summaries] == ['destroyed', 'new']
+    assert (summaries[0].deployed, summaries[0].serial) == (False, 9)
+    assert summaries[1].as_dict() == {'name': 'new', 'deployed': False, 'ami': None,
+                                      'serial': None, 'applied_at': None,
+                                      'config_changed': False}
+
+
+def test_cli_list_long_and_json(runner, new_deployment):
+    instance = [{"type": "aws_instance", "instances": [{"attributes": {"ami": "ami-0f1e2d3c"}}]}]
+    deployment_dir = Path.cwd().joinpath('deployments', 'list-long.acme.com')
+    deployment_dir.mkdir(parents=True)
+    write_state(deployment_dir, instance, serial=3)
+
+    result = runner.invoke(cli, ["list", "--long"])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert lines[0].split() == ['NAME', 'STATUS', 'AMI', 'SERIAL', 'APPLIED', 'CONFIG']
+    row = [line for line in lines if line.startswith('list-long.acme.com')][0]
+    assert row.split()[1:4] == ['deployed', 'ami-0f1e2d3c', '3']
+    assert [line for line in lines if line.startswith('foo ')][0].split()[1:3] == \
+        ['not', 'deployed']
+
+    result = runner.invoke(cli, ["list", "--format", "json"])
+    summaries = {summary['name']: summary for summary in json.loads(result.output)}
+    assert summaries['list-long.acme.com']['ami'] == 'ami-0f1e2d3c'
+    assert summaries['list-long.acme.com']['applied_at'].endswith('Z')
+    assert summaries['foo']['deployed'] is False
+
+
+def test_list_and_completion_do_not_resolve_deployments(runner, new_deployment, mocker):
+    # both work from file metadata (the name index, TfState's stat keyed memo), never by
+    # loading a deployment
+    load = mocker.patch('drone_deploy.deployment.Deployment.__init__', side_effect=AssertionError)
+    resolve = mocker.patch('drone_deploy.resolved_config.resolve_config', side_effect=AssertionError)
+    assert runner.invoke(cli, ["list", "--long"]).exit_code == 0
+    assert 'foo' in filter_deployments(None, [], 'fo')
+    assert load.call_count == 0 and resolve.call_count == 0
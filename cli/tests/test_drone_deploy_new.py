@@ -1,4 +1,7 @@
+import os
+from pathlib import Path
 from cli import cli
+from drone_deploy.template_cache import pack_templates
 
 
 def test_cli_new_deployment(runner):
@@ -12,3 +15,45 @@ def test_cli_duplicate_deployments_not_allowed(runner):
     runner.invoke(cli, ["new", "foobar.acme.com"])
     result = runner.invoke(cli, ["new", "foobar.acme.com"])
     assert 'Deployment with that name already exists.' in result.output, "Allowed duplicate deployment."
+
+
+def test_cli_new_deployment_from_release_templates(runner, tmp_path, monkeypatch, mocker):
+    '''without a templates dir, new uses the templates embedded in the release exe'''
+    runner.invoke(cli, ["new", "release.acme.com"])
+    expected_dir = Path.cwd().joinpath('deployments', 'release.acme.com')
+    archive = pack_templates(Path.cwd().joinpath('templates'), tmp_path.joinpath('templates.zip'), '0.1.21')
+    mocker.patch('drone_deploy.new_deployment_cli.embedded_templates', side_effect=lambda: open(archive, 'rb'))
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('deployments').mkdir()
+
+    result = runner.invoke(cli, ["new", "release.acme.com"])
+    assert 'Deployment created:' in result.output
+
+    def files(path):
+        return sorted(str(file.relative_to(path)) for file in path.rglob('*')
+                      if file.is_file() and '.terraform' not in file.parts)
+    assert files(tmp_path.joinpath('deployments', 'release.acme.com')) == files(expected_dir), \
+        'A deployment from the release templates should have the same files.'
+    assert os.access(tmp_path.joinpath('deployments', 'release.acme.com', 'build-drone-server-ami.sh'), os.X_OK)
+
+
+def test_cli_new_deployments_in_batch(runner, tmp_path):
+    batch_file = tmp_path.joinpath('deployments.yaml')
+    batch_file.write_text("deployments:\n"
+                          "  - batch-a.acme.com\n"
+                          "  - name: batch-b.acme.com\n"
+                          "    config:\n"
+                          "      drone_aws_region: us-west-2\n")
+    result = runner.invoke(cli, ["new", "--batch", str(batch_file)])
+    assert result.output.count('Deployment created:') == 2
+    config = Path.cwd().joinpath('deployments', 'batch-b.acme.com', 'config.yaml').read_text()
+    assert 'drone_aws_region: us-west-2' in config
+
+    a_template = Path.cwd().joinpath('deployments', 'batch-a.acme.com', 'packer', 'packer_build_drone_server_ami.json')
+    b_template = Path.cwd().joinpath('deployments', 'batch-b.acme.com', 'packer', 'packer_build_drone_server_ami.json')
+    assert a_template.read_bytes() == b_template.read_bytes()
+    assert Path.cwd().joinpath('deployments', 'batch-a.acme.com', 'config.yaml').stat().st_nlink == 1, \
+        'config.yaml should always be a copy.'
+
+    result = runner.invoke(cli, ["new", "--batch", str(batch_file)])
+    assert 'Skipped batch-a.acme.com' in result.output
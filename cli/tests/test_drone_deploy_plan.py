@@ -1,5 +1,6 @@
 import subprocess
 from cli import cli
+from pathlib import Path
 
 
 def test_cli_plan(runner, new_deployment, mocker):
@@ -7,6 +8,7 @@ def test_cli_plan(runner, new_deployment, mocker):
     mocker.patch('subprocess.Popen')
     runner.invoke(cli, ["plan", "foo"])
     call_list = f'{subprocess.Popen.call_args}'    # noqa
-    assert 'terraform plan' in call_list, "'drone-deploy plan' did not call 'terraform plan' as expected."
-    assert 'TF_VAR_drone_github_server' in call_list, 'Did not find an expected TF_VAR_ env var in a call to terraform plan.'
+    assert "'terraform', 'plan'" in call_list, "'drone-deploy plan' did not call 'terraform plan' as expected."
+    var_file = Path.cwd().joinpath('deployments', 'foo', 'terraform', 'drone-deploy.auto.tfvars.json')
+    assert 'drone_github_server' in var_file.read_text(), 'Did not find an expected variable in the tfvars file.'
     assert subprocess.Popen.call_count == 1, "'drone-deploy plan' should only call 'terraform plan' once."    # noqa
@@ -1,5 +1,6 @@
 import subprocess
 from cli import cli
+from pathlib import Path
 
 
 def test_cli_prepare(runner, new_deployment, mocker):
@@ -14,5 +15,5 @@ def test_cli_prepare(runner, new_deployment, mocker):
                    "-target=aws_iam_instance_profile.drone-builder"]
     for t in iam_targets:
         assert t in call_list, f"'drone-deploy prepare' did not apply {t} as expected."
-    assert 'terraform apply' in call_list and 'foo/terraform' in call_list, "'drone-deploy prepare' did not call 'terraform apply' as expected."
+    assert "'terraform', 'apply'" in call_list and 'foo/terraform' in call_list, "'drone-deploy prepare' did not call 'terraform apply' as expected."
     assert subprocess.Popen.call_count == 2, "'drone-deploy prepare' should call 'terraform init' and 'terraform apply' once each."    # noqa
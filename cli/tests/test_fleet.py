@@ -0,0 +1,98 @@
+import io
+import pytest
+import threading
+from cli import cli
+from pathlib import Path
+from drone_deploy.fleet import Fleet, AdaptiveLimiter, PrefixedWriter, select_deployments
+
+STUB_TERRAFORM = r"""#!/bin/sh
+# fake terraform: fails with a throttling error the first time if THROTTLE_ONCE is set
+if [ -n "$THROTTLE_ONCE" ] && [ ! -f .throttled ]; then
+    touch .throttled
+    echo "Error: Throttling: Rate exceeded" >&2
+    exit 1
+fi
+name=$(sed -n 's/.*"drone_deployment_name": "\(.*\)".*/\1/p' drone-deploy.auto.tfvars.json)
+echo "terraform $1 for $name"
+"""
+
+
+@pytest.fixture()
+def stub_terraform(stub_executable):
+    '''puts a fake terraform executable first in the PATH'''
+    yield stub_executable('terraform', STUB_TERRAFORM)
+    for name in ['foo', 'bar']:
+        marker = Path.cwd().joinpath('deployments', name, 'terraform', '.throttled')
+        if marker.exists():
+            marker.unlink()
+
+
+def test_select_deployments(new_deployment, new_deployment2):
+    deployments_dir = Path.cwd().joinpath('deployments')
+    assert {'foo', 'bar'} <= set(select_deployments(deployments_dir, all_deployments=True))
+    assert select_deployments(deployments_dir, match='fo?') == ['foo']
+    assert select_deployments(deployments_dir) == [], 'Nothing should be selected by default.'
+
+
+def test_fleet_runs_deployments_with_isolated_env(new_deployment, new_deployment2, stub_terraform):
+    stream = io.StringIO()
+    fleet = Fleet(Path.cwd().joinpath('deployments'), ['foo', 'bar'], jobs=2, stream=stream)
+    results = fleet.run('plan')
+    assert [r.status for r in results] == ['ok', 'ok'], stream.getvalue()
+    output = stream.getvalue()
+    assert '[foo] terraform plan for drone-foo' in output, 'Output should be prefixed per deployment.'
+    assert '[bar] terraform plan for drone-bar' in output, 'Deployments should not share env vars.'
+
+
+def test_fleet_retries_when_throttled(new_deployment, stub_terraform, monkeypatch):
+    monkeypatch.setenv('THROTTLE_ONCE', '1')
+    stream = io.StringIO()
+    fleet = Fleet(Path.cwd().joinpath('deployments'), ['foo'], jobs=2, backoff=0, stream=stream)
+    results = fleet.run('plan')
+    assert results[0].status == 'ok', stream.getvalue()
+    assert results[0].attempts == 2, 'A throttled run should have been retried.'
+    assert 'throttled by AWS' in stream.getvalue()
+
+
+def test_fleet_summary(new_deployment, stub_terraform):
+    stream = io.StringIO()
+    fleet = Fleet(Path.cwd().joinpath('deployments'), ['foo'], stream=stream)
+    fleet.print_summary(fleet.run('plan'))
+    summary = stream.getvalue().strip().split('\n')[-2:]
+    assert summary[0].split()[:3] == ['DEPLOYMENT', 'STATUS', 'TIME']
+    assert summary[1].split()[:2] == ['foo', 'ok']
+
+
+def test_adaptive_limiter_backs_off_and_recovers():
+    limiter = AdaptiveLimiter(8)
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.limit == 2
+    limiter.succeeded()
+    assert limiter.limit == 3
+    for _ in range(10):
+        limiter.succeeded()
+    assert limiter.limit == 8, 'The limit should never grow past max_jobs.'
+
+
+def test_prefixed_writer_buffers_partial_lines():
+    stream = io.StringIO()
+    writer = PrefixedWriter('[foo]', stream, threading.Lock())
+    writer.write('hello ')
+    assert stream.getvalue() == ''
+    writer.write('world\nbye')
+    writer.flush()
+    assert stream.getvalue() == '[foo] hello world\n[foo] bye\n'
+
+
+def test_cli_plan_match(runner, new_deployment, stub_terraform):
+    result = runner.invoke(cli, ["plan", "--match", "fo?", "--jobs", "2"])
+    assert result.exit_code == 0, result.output
+    assert 'Running plan on 1 deployment(s): foo' in result.output
+    assert '[foo] terraform plan' in result.output
+
+
+def test_cli_plan_requires_a_deployment(runner):
+    result = runner.invoke(cli, ["plan"])
+    assert result.exit_code != 0
+    assert '--all/--match' in result.output
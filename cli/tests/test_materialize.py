@@ -0,0 +1,56 @@
+import os
+from drone_deploy.materialize import Materializer
+
+
+def make_templates(tmp_path):
+    templates = tmp_path.joinpath('templates')
+    templates.joinpath('build-scripts').mkdir(parents=True)
+    templates.joinpath('Caddyfile').write_text('caddy')
+    templates.joinpath('caddy.tar.gz').write_bytes(b'caddy binary')
+    templates.joinpath('build-scripts', 'cleanup.sh').write_text('#!/bin/sh')
+    templates.joinpath('build-scripts', 'cleanup.sh').chmod(0o755)
+    return templates
+
+
+def test_materializer_hardlinks_only_archives(tmp_path, mocker):
+    templates = make_templates(tmp_path)
+    modes = {path: path.stat().st_mode for path in templates.rglob('*')}
+    # no reflinks, so the hardlink path is tested whatever the filesystem
+    mocker.patch('drone_deploy.materialize.reflink', side_effect=OSError('not supported'))
+    materializer = Materializer()
+    materializer.tree(templates, tmp_path.joinpath('a'))
+    materializer.tree(templates, tmp_path.joinpath('b'))
+    assert materializer.counts == {'reflink': 0, 'hardlink': 2, 'copy': 4}
+    assert materializer.summary() == '2 hardlinked, 4 copied'
+    assert {path: path.stat().st_mode for path in templates.rglob('*')} == modes, \
+        "The templates' modes should not be changed."
+
+    archive = tmp_path.joinpath('a', 'caddy.tar.gz')
+    assert archive.stat().st_ino == templates.joinpath('caddy.tar.gz').stat().st_ino
+    caddyfile = tmp_path.joinpath('a', 'Caddyfile')
+    assert caddyfile.stat().st_nlink == 1, 'Files a deployment may edit should not be shared.'
+    caddyfile.write_text('edited')
+    assert templates.joinpath('Caddyfile').read_text() == 'caddy'
+    assert os.access(tmp_path.joinpath('b', 'build-scripts', 'cleanup.sh'), os.X_OK)
+
+    assert Materializer.unshare(archive) is True
+    archive.write_bytes(b'edited')
+    assert templates.joinpath('caddy.tar.gz').read_bytes() == b'caddy binary', \
+        'Editing a deployment should not change the template.'
+    assert tmp_path.joinpath('b', 'caddy.tar.gz').read_bytes() == b'caddy binary'
+    assert Materializer.unshare(archive) is False
+
+
+def test_materializer_falls_back_to_copying(tmp_path, mocker):
+    templates = make_templates(tmp_path)
+    reflink = mocker.patch('drone_deploy.materialize.reflink', side_effect=OSError('not supported'))
+    mocker.patch('os.link', side_effect=OSError('cross-device link'))
+    materializer = Materializer()
+    materializer.tree(templates, tmp_path.joinpath('a'))
+    assert materializer.counts['copy'] == 3
+    assert reflink.call_count == 1, 'A method that failed should not be retried on the same devices.'
+    assert os.access(tmp_path.joinpath('a', 'build-scripts', 'cleanup.sh'), os.X_OK)
+
+    materializer = Materializer(copy=True)
+    materializer.tree(templates, tmp_path.joinpath('b'))
+    assert materializer.summary() == '3 copied'
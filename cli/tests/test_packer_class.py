@@ -1,9 +1,45 @@
 import os
 import json
 import pytest
+import tarfile
 import subprocess
 from pathlib import Path, PosixPath, WindowsPath
 from drone_deploy.deployment import Deployment
+from drone_deploy import packer as packer_module
+from drone_deploy.packer import BuildError
+
+STUB_PACKER = r"""#!/bin/sh
+# fake packer: writes a manifest for the template with the ids and fingerprints in the build vars
+for arg in "$@"; do
+    case $arg in -var-file=*build.vars.json) vars="${arg#-var-file=}" ;; esac
+    template=$arg
+done
+value() {
+    sed -n "s/.*\"$1\": \"\([0-9a-f]*\)\".*/\1/p" "$vars"
+}
+if [ "$template" = packer_build_drone_base_ami.json ]; then
+    cat > base-manifest.json <<EOF
+{"builds": [{"artifact_id": "us-east-1:ami-0base${BASE_AMI_SUFFIX:-}", "packer_run_uuid": "base-1",
+             "build_time": $(date +%s), "custom_data": {"base_fingerprint": "$(value base_fingerprint)"}}],
+ "last_run_uuid": "base-1"}
+EOF
+else
+    cat > manifest.json <<EOF
+{"builds": [{"artifact_id": "us-east-1:ami-0123456789abcdef0", "packer_run_uuid": "run-1",
+             "custom_data": {"drone_deployment_id": "$(value drone_deployment_uuid)",
+                             "build_fingerprint": "$(value build_fingerprint)"}}],
+ "last_run_uuid": "${LAST_RUN_UUID:-run-1}"}
+EOF
+fi
+now=$(date +%s)
+echo "$now,amazon-ebs,ui,say,==> amazon-ebs: Launching a source AWS instance..."
+echo "$now,amazon-ebs,ui,say,==> amazon-ebs: Provisioning with shell script: /tmp/packer-shell1"
+echo "$now,amazon-ebs,ui,message,    amazon-ebs: [server_image] ok in 12.5s"
+echo "$now,amazon-ebs,ui,say,==> amazon-ebs: Creating AMI from instance i-0123%!(PACKER_COMMA) $template"
+echo "packer $1 $template"
+"""
+
+BUILD_VARS = {'aws_access_key': 'AKIA', 'aws_secret_key': 'secret', 'aws_session_token': 'token'}
 
 
 @pytest.fixture()
@@ -55,7 +91,7 @@ def invalid_manifest_file():
 def test_packer_vars(deployment, new_deployment):
     packer = deployment.packer
     assert len(packer.packer_vars) > 0, "packer_vars failed to populate as expected."
-    assert '-var drone_server_instance_type=t2.micro' in packer.packer_vars, 'packer vars failed to populate as expected.'
+    assert packer.packer_vars['drone_server_instance_type'] == 't2.micro', 'packer vars failed to populate as expected.'
 
 
 def test_packer_working_dir(deployment, new_deployment):
@@ -96,8 +132,162 @@ def test_packer_build_ami_command_should_load_artifacts(deployment, new_deployme
         packer = deployment.packer
         assert packer.drone_server_ami == '', 'Error setting up test case. packer.drone_server_ami should be empty string.'
         mocker.patch('subprocess.Popen')
+        mocker.patch('shutil.which', return_value='/usr/local/bin/packer')
+        mocker.patch.object(packer, 'assume_builder_role', return_value=dict(BUILD_VARS))
+        mocker.patch.object(packer, 'current_base_ami', return_value='ami-0base')
         packer.build_ami()
         call_list = f'{subprocess.Popen.call_args}'    # noqa
-        assert subprocess.Popen.call_count == 1, "packer.build_ami() should call build script once."
-        assert './build-drone-server-ami.sh' in call_list, "packer.build_ami() did not call ./build-drone-server-ami.sh as expected."
+        assert subprocess.Popen.call_count == 1, "packer.build_ami() should call packer once."
+        assert "'build'" in call_list and packer.TEMPLATE in call_list, "packer.build_ami() did not call packer build as expected."
         assert packer.drone_deployment_id == "fb8b32847f4f9569d9094d966af7a0cb", "packer did not load artifacts from manifest file after build as expected."
+
+
+def test_packer_write_var_file(deployment, new_deployment):
+    '''packer vars declared in the template are written to a var file'''
+    packer = deployment.packer
+    packer.write_var_file()
+    variables = json.loads(packer.working_dir.joinpath(packer.VAR_FILE).read_text())
+    assert variables['iam_instance_profile'] == 'drone-foo-builder'
+    assert variables['aws_region'] == variables['drone_aws_region']
+    assert 'drone_github_client_secret' not in variables, 'Only template variables should be written.'
+    assert packer.write_var_file() is False, 'An unchanged var file should not be rewritten.'
+
+
+@pytest.fixture()
+def stub_packer(stub_executable):
+    '''puts a fake packer executable first in the PATH'''
+    yield stub_executable('packer', STUB_PACKER)
+    for name in ['manifest.json', 'base-manifest.json', 'build-timings.json', 'base-build-timings.json',
+                 'build.log', 'base-build.log']:
+        manifest_file = Path.cwd().joinpath('deployments', 'foo', 'packer', name)
+        if manifest_file.exists():
+            manifest_file.unlink()
+
+
+def test_packer_build_ami_runs_packer_natively(deployment, new_deployment, stub_packer, mocker):
+    '''build_ami assumes the builder role, generates an id, and validates the manifest'''
+    packer = deployment.packer
+    packer.env = dict(os.environ, DRONE_DEPLOYMENT_ID='')
+    mocker.patch.object(packer, 'assume_builder_role', return_value=dict(BUILD_VARS))
+    result = packer.build_ami()
+    assert result and result.ok, 'The build should have succeeded.'
+    assert 'packer build packer_build_drone_server_ami.json' in result.stdout_tail
+    assert 'AKIA' not in ' '.join(result.command), 'Credentials should not be on the command line.'
+    assert packer.drone_server_ami == 'ami-0123456789abcdef0'
+    assert packer.base_ami == 'ami-0base', 'The base AMI should have been built first.'
+    assert len(packer.drone_deployment_id) == 32, 'A new 32 character deployment id should be generated.'
+
+    timings = json.loads(packer.working_dir.joinpath('build-timings.json').read_text())
+    assert timings['ok'] and timings['fingerprint'] == packer.fingerprint('ami-0base')
+    assert [phase['name'] for phase in timings['phases']] == ['launch instance', 'shell provisioner 1',
+                                                              'create AMI']
+    assert timings['steps'] == [{'name': 'server_image', 'status': 'ok', 'duration': 12.5}]
+    assert 'i-0123, packer_build_drone_server_ami.json' in packer.working_dir.joinpath('build.log').read_text()
+    assert packer.working_dir.joinpath('base-build-timings.json').exists()
+
+
+def test_packer_build_ami_rejects_stale_manifest(deployment, new_deployment, stub_packer, mocker, monkeypatch):
+    monkeypatch.setenv('LAST_RUN_UUID', 'run-0')
+    packer = deployment.packer
+    packer.env = dict(os.environ)
+    mocker.patch.object(packer, 'assume_builder_role', return_value=dict(BUILD_VARS))
+    assert packer.build_ami() is False, 'A manifest from another packer run should fail the build.'
+    with pytest.raises(BuildError):
+        packer.validate_manifest()
+
+
+def test_packer_assume_builder_role(deployment, new_deployment, mocker):
+    packer = deployment.packer
+    session = mocker.patch('boto3.Session')
+    sts = session.return_value.client.return_value
+    sts.assume_role.return_value = {'Credentials': {'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret',
+                                                    'SessionToken': 'token'}}
+    packer.env = {'DRONE_BUILDER_ROLE_ARN': 'arn:aws:iam::123456789012:role/drone-foo-builder',
+                  'DRONE_DEPLOYMENT_NAME': 'drone-foo', 'AWS_PROFILE': 'prod'}
+    assert packer.assume_builder_role() == BUILD_VARS
+    session.assert_called_once_with(profile_name='prod')
+    sts.assume_role.assert_called_once_with(RoleArn='arn:aws:iam::123456789012:role/drone-foo-builder',
+                                            RoleSessionName='drone-foo-builder')
+    packer.assume_builder_role(endpoint_url='http://localhost:5000')
+    assert session.return_value.client.call_args[1]['endpoint_url'] == 'http://localhost:5000'
+
+    packer.env = {}
+    with pytest.raises(BuildError):
+        packer.assume_builder_role()
+
+
+def test_packer_build_ami_skips_unchanged_builds(deployment, new_deployment, stub_packer, mocker):
+    '''a build with the same packer files and vars as the last one reuses its AMI'''
+    packer = deployment.packer
+    packer.env = dict(os.environ, DRONE_DEPLOYMENT_ID='')
+    mocker.patch.object(packer, 'assume_builder_role', return_value=dict(BUILD_VARS))
+    assert packer.build_ami().ok
+    assert packer.build_fingerprint == packer.fingerprint(packer.base_ami), 'The fingerprint should be saved in the manifest.'
+
+    run_process = mocker.spy(packer_module, 'run_process')
+    assert packer.build_ami().ok
+    assert run_process.call_count == 0, 'An unchanged build should not run packer.'
+    assert packer.build_ami(force=True).ok
+    assert run_process.call_count == 1, '--force should always build (but not the base AMI).'
+
+    fingerprint = packer.fingerprint(packer.base_ami)
+    packer.packer_vars = [('drone_cli_version', '9.9.9')]
+    assert packer.fingerprint(packer.base_ami) != fingerprint, 'Changing a packer var should change the fingerprint.'
+    assert not packer.is_current(packer.base_ami)
+
+
+def test_packer_payload_archive(deployment, new_deployment):
+    '''the provisioning files are packed into one archive, cached by content hash'''
+    packer = deployment.packer
+    archive = packer.payload.archive()
+    with tarfile.open(archive) as tar:
+        names = tar.getnames()
+        assert tar.getmember('cleanup.sh').mode == 0o755
+    assert {'bootstrap_drone.sh', 'drone-config.sh', 'Caddyfile'} <= set(names)
+    assert 'bootstrap_docker.sh' not in names, 'The server payload should only have server files.'
+    with tarfile.open(packer.base_payload.archive()) as tar:
+        base_names = tar.getnames()
+    assert {'provision.sh', 'bootstrap_docker.sh', 'aws-cli.Dockerfile'} <= set(base_names)
+    assert 'bootstrap_drone.sh' not in base_names, 'The base payload should only have base files.'
+    assert names == sorted(names), 'Archives should be reproducible.'
+    mtime = archive.stat().st_mtime_ns
+    assert packer.payload.archive() == archive and archive.stat().st_mtime_ns == mtime, \
+        'An unchanged payload should not be rebuilt.'
+
+    template = json.loads(packer.working_dir.joinpath(packer.TEMPLATE).read_text())
+    uploads = [p for p in template['provisioners'] if p['type'] == 'file']
+    assert len(uploads) == 1, 'The template should upload only the payload archive.'
+
+
+def test_packer_server_scripts_dont_change_base_fingerprint(deployment, new_deployment):
+    '''editing a server-only script changes the server build, but not the base AMI's'''
+    packer = deployment.packer
+    script = packer.working_dir.joinpath('server-scripts', 'bootstrap_drone.sh')
+    original = script.read_text()
+    base_fingerprint, fingerprint = packer.base_fingerprint(), packer.fingerprint()
+    try:
+        script.write_text(original + '\n# edited\n')
+        assert packer.base_fingerprint() == base_fingerprint
+        assert packer.fingerprint() != fingerprint
+    finally:
+        script.write_text(original)
+
+
+def test_packer_base_ami_is_rebuilt_when_out_of_date(deployment, new_deployment, stub_packer, mocker):
+    '''the base AMI is only rebuilt when its inputs change, it's too old, or rebuild_base'''
+    packer = deployment.packer
+    packer.env = dict(os.environ, DRONE_DEPLOYMENT_ID='')
+    mocker.patch.object(packer, 'assume_builder_role', return_value=dict(BUILD_VARS))
+    assert packer.build_ami().ok
+    assert packer.base_is_current()
+    assert packer.current_base_ami() == 'ami-0base'
+
+    packer.base_build_time -= (packer.base_max_age + 1) * 86400
+    assert not packer.base_is_current(), 'A base AMI older than the max age should be rebuilt.'
+    packer.load_base_artifacts()
+
+    run_process = mocker.spy(packer_module, 'run_process')
+    packer.env['BASE_AMI_SUFFIX'] = '2'
+    assert packer.build_ami(rebuild_base=True).ok
+    assert run_process.call_count == 2, 'A new base AMI should rebuild the server AMI on top of it.'
+    assert packer.base_ami == 'ami-0base2'
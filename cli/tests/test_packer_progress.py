@@ -0,0 +1,48 @@
+import io
+import json
+from drone_deploy.packer_progress import parse_machine_readable, BuildProgress
+
+BUILD_OUTPUT = """\
+1571323800,,ui,say,==> amazon-ebs: Prevalidating AMI Name: drone-server-ami 1571323800
+1571323802,,ui,say,==> amazon-ebs: Launching a source AWS instance...
+1571323831,,ui,say,==> amazon-ebs: Waiting for SSH to become available...
+1571323870,,ui,say,==> amazon-ebs: Uploading /tmp/abc.tar.gz => /tmp/payload.tar.gz
+1571323871,,ui,say,==> amazon-ebs: Provisioning with shell script: /tmp/packer-shell1
+1571323872,,ui,error,    amazon-ebs: debconf: delaying package configuration
+1571323900,,ui,message,    amazon-ebs: [server_image] ok in 28.4s\\n    amazon-ebs: [drone_cli] failed in 3.0s
+1571323901,,ui,error,==> amazon-ebs: Script exited with non-zero exit status: 1
+1571323905,,ui,say,==> amazon-ebs: Terminating the source AWS instance...
+1571323935,,ui,error,Build 'amazon-ebs' errored: Script exited with non-zero exit status: 1
+1571323935,,error-count,1
+"""
+
+
+def test_parse_machine_readable():
+    assert parse_machine_readable('1571323935,amazon-ebs,artifact,0,id,us-east-1:ami-1%!(PACKER_COMMA)us-west-2:ami-2') == \
+        (1571323935, 'amazon-ebs', 'artifact', ['0', 'id', 'us-east-1:ami-1,us-west-2:ami-2'])
+    assert parse_machine_readable("Error: Failed to parse template") is None
+
+
+def test_build_progress_shows_phases_and_writes_timings(tmp_path):
+    stream = io.StringIO()
+    progress = BuildProgress('packer_build_drone_server_ami.json', stream=stream,
+                             log=tmp_path.joinpath('build.log'))
+    for line in BUILD_OUTPUT.split('\n'):
+        progress.feed('stdout', line)
+    report = progress.write_report(tmp_path.joinpath('build-timings.json'), ok=False, fingerprint='abc')
+
+    output = stream.getvalue().split('\n')
+    assert output[:3] == ['[  0:00] prevalidate', '[  0:02] launch instance', '[  0:31] wait for SSH']
+    assert '[  1:40]   server_image ok in 28.4s' in output
+    assert '[  1:41] error: Script exited with non-zero exit status: 1' in output
+    assert not [line for line in output if 'debconf' in line], "The builder's stderr should only be logged."
+    assert 'debconf' in tmp_path.joinpath('build.log').read_text()
+
+    assert report == json.loads(tmp_path.joinpath('build-timings.json').read_text())
+    assert report['duration'] == 135 and report['ok'] is False
+    assert [(phase['name'], phase['duration']) for phase in report['phases']] == [
+        ('prevalidate', 2), ('launch instance', 29), ('wait for SSH', 39),
+        ('upload /tmp/abc.tar.gz', 1), ('shell provisioner 1', 34), ('terminate instance', 30)]
+    assert report['slowest'] == ['wait for SSH', 'shell provisioner 1', 'terminate instance']
+    assert report['steps'] == [{'name': 'server_image', 'status': 'ok', 'duration': 28.4},
+                               {'name': 'drone_cli', 'status': 'failed', 'duration': 3.0}]
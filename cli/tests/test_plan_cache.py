@@ -0,0 +1,97 @@
+import pytest
+from pathlib import Path
+from drone_deploy.deployment import Deployment
+
+STUB_TERRAFORM = """\
+#!/bin/sh
+# fake terraform: records its args and writes the plan file
+echo "$@" >> "$TF_CALLS"
+for arg in "$@"; do
+    case "$arg" in -out=*) echo plan > "${arg#-out=}";; esac
+done
+echo "Plan: 1 to add, 0 to change, 0 to destroy."
+"""
+
+
+@pytest.fixture()
+def terraform_calls(tmp_path, monkeypatch, stub_executable):
+    '''puts a fake terraform first in the PATH and returns a function listing its calls'''
+    stub_executable('terraform', STUB_TERRAFORM)
+    calls = tmp_path.joinpath('calls')
+    monkeypatch.setenv('TF_CALLS', str(calls))
+    yield lambda: calls.read_text().splitlines() if calls.exists() else []
+    Deployment(Path.cwd().joinpath('deployments', 'foo', 'config.yaml')).terraform.plans.discard()
+
+
+@pytest.fixture()
+def deployment(new_deployment, terraform_calls):
+    return Deployment(Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve())
+
+
+def test_unchanged_plan_is_not_rerun(deployment, terraform_calls, capsys):
+    assert deployment.plan() == 0
+    assert deployment.plan() == 0
+    assert len(terraform_calls()) == 1, 'An identical plan should not have re-run terraform.'
+    output = capsys.readouterr().out
+    assert output.count('Plan: 1 to add') == 2, 'The cached plan should have been printed.'
+    assert 'Nothing has changed since this plan was made' in output
+
+    assert deployment.plan(use_cache=False) == 0
+    assert len(terraform_calls()) == 2, 'use_cache=False should always run terraform plan.'
+
+
+def test_changed_inputs_replan(deployment, terraform_calls, monkeypatch):
+    deployment.plan()
+    tf_file = deployment.terraform.working_dir.joinpath('variables.tf')
+    original = tf_file.read_text()
+    try:
+        tf_file.write_text(original + '\n# changed\n')
+        deployment.plan()
+        assert len(terraform_calls()) == 2, 'Changing a .tf file should invalidate the plan.'
+    finally:
+        tf_file.write_text(original)
+
+    deployment.terraform.env = dict(deployment.terraform.env, TF_VAR_drone_open='true')
+    deployment.plan()
+    assert len(terraform_calls()) == 3, 'Changing a variable should invalidate the plan.'
+
+
+def test_deploy_applies_matching_plan_only(deployment, terraform_calls):
+    deployment.plan()
+    plan_file = terraform_calls()[0].split('-out=')[1].split()[0]
+    deployment.deploy()
+    assert terraform_calls()[1].split()[-1] == plan_file, 'deploy should apply the saved plan.'
+    assert not deployment.terraform.plans.plans_dir.exists(), 'Applied plans should be discarded.'
+
+    deployment.deploy()
+    assert plan_file not in terraform_calls()[2], 'Without a matching plan deploy should re-plan.'
+
+
+def test_plan_matches_in_a_new_process(deployment, terraform_calls, monkeypatch):
+    '''plan and deploy are separate runs, each loading the deployment from config.yaml'''
+    config_file = Path(deployment.config_file)
+    assert Deployment(config_file).config['drone_rpc_secret'], '`new` should set an rpc secret.'
+    assert Deployment(config_file).terraform.plans.key() == \
+        Deployment(config_file).terraform.plans.key(), 'Loading twice should give the same key.'
+
+    # a deployment created without a secret gets one saved when it's first planned
+    original = config_file.read_text()
+    try:
+        config_file.write_text(original.replace(deployment.config['drone_rpc_secret'], ''))
+        without_secret = config_file.read_text()
+        Deployment(config_file)
+        assert config_file.read_text() == without_secret, 'Loading should not write config.yaml.'
+
+        monkeypatch.setenv('DRONE_RPC_SECRET', 'from-env')
+        assert Deployment(config_file).pin_rpc_secret() is False, 'An env secret is not saved.'
+        monkeypatch.delenv('DRONE_RPC_SECRET')
+
+        Deployment(config_file).plan()
+        assert Deployment(config_file).config['drone_rpc_secret'], \
+            'The generated rpc secret should have been saved to config.yaml.'
+        plan_file = terraform_calls()[0].split('-out=')[1].split()[0]
+        Deployment(config_file).deploy()
+        assert terraform_calls()[1].split()[-1] == plan_file, \
+            'deploy should apply the plan saved by an earlier run.'
+    finally:
+        config_file.write_text(original)
@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+import pytest
+import subprocess
+from cli import cli
+from pathlib import Path
+from drone_deploy.terraform import Terraform
+from drone_deploy.plugin_cache import PluginCache, version_key, version_matches
+
+AWS_PLUGIN = 'terraform-provider-aws_v2.70.0_x4'
+
+
+@pytest.fixture()
+def plugin_cache(new_deployment):
+    '''a shared cache with a (fake) aws provider in it'''
+    cache = PluginCache(Path.cwd())
+    cache.plugin_dir.mkdir(parents=True, exist_ok=True)
+    cache.plugin_dir.joinpath(AWS_PLUGIN).write_bytes(b'aws' * 1000)
+    cache.plugin_dir.joinpath('terraform-provider-aws_v2.9.0_x4').write_bytes(b'old')
+    yield cache
+    for name in ['foo', 'bar']:
+        plugin = cache.deployment_plugin_dir(Path.cwd().joinpath('deployments', name, 'terraform'))
+        if plugin.exists():
+            for p in plugin.iterdir():
+                p.unlink()
+    for p in cache.plugin_dir.iterdir():
+        p.unlink()
+
+
+def test_version_key():
+    assert version_key('2.10.0') > version_key('2.9.1')
+
+
+def test_link_into_new_deployment(plugin_cache, runner):
+    tf_dir = Path.cwd().joinpath('deployments', 'foo', 'terraform')
+    assert plugin_cache.required_providers(tf_dir) == {'aws'}
+    assert plugin_cache.link_into(tf_dir) is True
+    linked = plugin_cache.deployment_plugin_dir(tf_dir).joinpath(AWS_PLUGIN)
+    assert linked.exists(), 'The newest cached aws provider should have been linked in.'
+    assert os.path.samefile(linked, plugin_cache.plugin_dir.joinpath(AWS_PLUGIN)), 'Expected a hardlink.'
+
+
+def test_init_uses_cache_without_downloading(plugin_cache, mocker):
+    tf_dir = Path.cwd().joinpath('deployments', 'foo', 'terraform')
+    mocker.patch('subprocess.Popen')
+    terraform = Terraform(tf_dir.resolve())
+    assert terraform.plugin_cache is not None
+    try:
+        terraform.init()
+    except Exception:
+        pass
+    argv = subprocess.Popen.call_args[0][0]
+    assert argv[:2] == ['terraform', 'init'] and '-get-plugins=false' in argv
+    env = subprocess.Popen.call_args[1]['env']
+    assert env['TF_PLUGIN_CACHE_DIR'] == str(plugin_cache.cache_dir)
+
+
+def test_collect_and_prune(plugin_cache, new_deployment2):
+    tf_dir = Path.cwd().joinpath('deployments', 'bar', 'terraform')
+    plugin_dir = plugin_cache.deployment_plugin_dir(tf_dir)
+    plugin_dir.mkdir(parents=True, exist_ok=True)
+    plugin_dir.joinpath('terraform-provider-null_v2.1.2_x4').write_bytes(b'null')
+    plugin_cache.collect(tf_dir)
+    assert plugin_cache.plugin_dir.joinpath('terraform-provider-null_v2.1.2_x4').exists()
+
+    plugin_cache.link_into(Path.cwd().joinpath('deployments', 'foo', 'terraform'))
+    removed, freed = plugin_cache.prune()
+    assert [p.name for p in removed] == ['terraform-provider-aws_v2.9.0_x4'], 'Only unused providers should be pruned.'
+    assert freed == 3
+
+
+def test_cli_provider_cache(plugin_cache, runner):
+    result = runner.invoke(cli, ["provider-cache"])
+    assert result.exit_code == 0, result.output
+    assert AWS_PLUGIN in result.output and 'Total:' in result.output
+    result = runner.invoke(cli, ["provider-cache", "--prune"])
+    assert 'removed terraform-provider-aws_v2.9.0_x4' in result.output
+
+
+def test_version_matches():
+    assert version_matches('2.70.0', ['~> 2.7'])
+    assert not version_matches('3.0.0', ['~> 2.7'])
+    assert version_matches('2.7.5', ['~> 2.7.1']) and not version_matches('2.8.0', ['~> 2.7.1'])
+    assert version_matches('2.9.0', ['>= 2.0, < 2.10']) and not version_matches('2.70.0', ['>= 2.0, < 2.10'])
+    assert version_matches('2.70.0', ['2.70']) and not version_matches('2.70.0', ['!= 2.70.0'])
+
+
+def test_link_into_respects_version_constraints(plugin_cache, mocker):
+    tf_dir = Path.cwd().joinpath('deployments', 'foo', 'terraform')
+    main_tf = tf_dir.joinpath('main.tf')
+    original = main_tf.read_text()
+    try:
+        main_tf.write_text(original.replace('provider "aws" {', 'provider "aws" {\n  version = "< 2.10"', 1))
+        assert plugin_cache.version_constraints(tf_dir) == {'aws': ['< 2.10']}
+        assert plugin_cache.link_into(tf_dir) is True
+        assert [p.name for p in plugin_cache.deployment_plugin_dir(tf_dir).iterdir()] == ['terraform-provider-aws_v2.9.0_x4']
+
+        # nothing cached meets the constraint: init downloads it (without -get-plugins=false)
+        main_tf.write_text(original.replace('provider "aws" {', 'provider "aws" {\n  version = "~> 3.0"', 1))
+        assert plugin_cache.link_into(tf_dir) is False
+        mocker.patch('subprocess.Popen')
+        try:
+            Terraform(tf_dir.resolve()).init()
+        except Exception:
+            pass
+        argv = subprocess.Popen.call_args[0][0]
+        assert argv[:2] == ['terraform', 'init'] and '-get-plugins=false' not in argv
+    finally:
+        main_tf.write_text(original)
+
+
+def test_cache_populating_inits_are_serialized(plugin_cache, mocker):
+    tf_dir = Path.cwd().joinpath('deployments', 'foo', 'terraform')
+    mocker.patch.object(PluginCache, 'link_into', return_value=False)
+    running = []
+    overlapped = []
+
+    def fake_init(command, tf_targets=None, tf_args=None):
+        overlapped.append(bool(running))
+        running.append(command)
+        time.sleep(0.05)
+        running.remove(command)
+        return 1
+
+    def init():
+        terraform = Terraform(tf_dir.resolve())
+        terraform.terraform = fake_init
+        terraform.init()
+
+    threads = [threading.Thread(target=init) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlapped == [False] * 4, 'Inits that write to the shared plugin cache should not overlap.'
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import pytest
+import signal
+import asyncio
+import subprocess
+from drone_deploy import process
+from drone_deploy.process import arun_process, run_process, StreamSink, FileSink, RingBufferSink
+
+
+class RecordingSink():
+    def __init__(self):
+        self.writes = []
+
+    def write(self, name, text):
+        self.writes.append((name, text))
+
+    def close(self):
+        pass
+
+
+def test_run_process_captures_both_streams():
+    sink = RecordingSink()
+    result = run_process("echo out; echo err >&2; exit 3", sinks=[sink])
+    assert result.returncode == 3 and not result.ok
+    assert result.stdout_tail == 'out\n'
+    assert result.stderr_tail == 'err\n'
+    assert ('stdout', 'out\n') in sink.writes and ('stderr', 'err\n') in sink.writes
+    assert result.duration >= 0
+
+
+def test_run_process_reads_in_chunks():
+    # 200k of output should arrive in a handful of writes, not one per character
+    sink = RecordingSink()
+    command = f"{sys.executable} -c \"import sys; sys.stdout.write('x' * 200000)\""
+    result = run_process(command, sinks=[sink])
+    assert result.ok
+    assert sum(len(text) for _, text in sink.writes) == 200000
+    assert len(sink.writes) < 100, 'Output should be read in chunks.'
+    assert len(result.stdout_tail) == 16 * 1024, 'Only the tail of the output should be kept.'
+
+
+def test_run_process_passes_partial_lines(tmp_path):
+    log = tmp_path.joinpath('run.log')
+    stream = tmp_path.joinpath('stream.txt').open('w')
+    result = run_process("printf 'Enter a value: '", sinks=[StreamSink(stream), FileSink(log)])
+    stream.close()
+    assert result.stdout_tail == 'Enter a value: '
+    assert log.read_text() == 'Enter a value: '
+    assert tmp_path.joinpath('stream.txt').read_text() == 'Enter a value: '
+
+
+def test_run_process_env_and_cwd(tmp_path):
+    result = run_process("echo $FOO; pwd", cwd=tmp_path, env={'FOO': 'bar', 'PATH': '/bin:/usr/bin'},
+                         sinks=[])
+    assert result.stdout_tail.split() == ['bar', str(tmp_path)]
+
+
+def test_ring_buffer_sink_keeps_tail():
+    sink = RingBufferSink(size=5)
+    for text in ['abc', 'def', 'ghi']:
+        sink.write('stdout', text)
+    assert sink.text('stdout') == 'efghi'
+    assert sink.text('stderr') == ''
+
+
+def test_arun_process_streams_lines():
+    lines = []
+    result = asyncio.run(arun_process(['sh', '-c', 'echo one; echo two >&2; printf three'],
+                                      sinks=[], on_line=lambda name, line: lines.append((name, line))))
+    assert result.ok
+    assert sorted(lines) == [('stderr', 'two'), ('stdout', 'one'), ('stdout', 'three')]
+
+
+def test_arun_process_runs_concurrently():
+    async def run_both():
+        return await asyncio.gather(arun_process(['sleep', '0.5'], sinks=[]),
+                                    arun_process(['sleep', '0.5'], sinks=[]))
+    start = time.monotonic()
+    results = asyncio.run(run_both())
+    assert all(r.ok for r in results)
+    assert time.monotonic() - start < 0.9, 'Processes should run at the same time.'
+
+
+def test_arun_process_cancel_terminates_child():
+    async def cancel():
+        task = asyncio.ensure_future(arun_process(['sleep', '30'], sinks=[]))
+        await asyncio.sleep(0.2)
+        child = next(iter(process._children))
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return child
+    child = asyncio.run(cancel())
+    assert child.returncode == -signal.SIGTERM, 'The child should have been sent SIGTERM.'
+    assert not process._children
+
+
+def test_arun_process_forwards_signals():
+    script = ("import time\n"
+              "try:\n    time.sleep(30)\n"
+              "except KeyboardInterrupt:\n    print('interrupted')\n    raise SystemExit(130)")
+
+    async def interrupt():
+        task = asyncio.ensure_future(arun_process([sys.executable, '-c', script], sinks=[],
+                                                  stdin=subprocess.DEVNULL))
+        await asyncio.sleep(0.5)
+        os.kill(os.getpid(), signal.SIGINT)
+        return await task
+    result = asyncio.run(interrupt())
+    assert result.returncode == 130
+    assert result.stdout_tail == 'interrupted\n'
+
+
+
+# counts the SIGINTs it gets, for a second after the first one
+COUNT_SIGINTS = """\
+import sys, time, signal, pathlib
+count = []
+signal.signal(signal.SIGINT, lambda signum, frame: count.append(signum))
+pathlib.Path(sys.argv[1]).touch()
+while not count:
+    time.sleep(0.01)
+time.sleep(1)
+print(len(count))
+"""
+
+
+@pytest.mark.parametrize('stdin', ['subprocess.DEVNULL', 'None'])
+def test_arun_process_child_gets_one_sigint(tmp_path, stdin):
+    '''a Ctrl-C (SIGINT to the whole process group) reaches the child exactly once'''
+    ready = tmp_path.joinpath('ready')
+    code = ("import sys, asyncio, subprocess\n"
+            "from drone_deploy.process import arun_process\n"
+            f"argv = [sys.executable, '-c', {COUNT_SIGINTS!r}, {str(ready)!r}]\n"
+            f"result = asyncio.run(arun_process(argv, sinks=[], stdin={stdin}))\n"
+            "print(result.stdout_tail, end='')\n")
+    cli_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # in its own session, like a command started from a terminal
+    parent = subprocess.Popen([sys.executable, '-c', code], cwd=cli_dir, stdout=subprocess.PIPE,
+                              stdin=subprocess.DEVNULL, text=True, start_new_session=True)
+    deadline = time.monotonic() + 10
+    while not ready.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    os.killpg(parent.pid, signal.SIGINT)
+    stdout, _ = parent.communicate(timeout=10)
+    assert stdout == '1\n', 'The child should get exactly one SIGINT.'
@@ -0,0 +1,84 @@
+import io
+import re
+import json
+import pstats
+import threading
+from cli import cli
+from drone_deploy import profiler
+from drone_deploy.process import run_process, LineSink
+
+
+def test_spans_are_free_when_profiling_is_off():
+    assert not profiler.enabled()
+    assert profiler.span('anything', arg=1) is profiler.span('else'), \
+        'A disabled span should be a shared no-op.'
+    with profiler.span('nothing') as span:
+        assert span is None
+    assert profiler.phase_sink([]) is None
+
+
+def test_profiler_records_nested_spans(tmp_path):
+    output = tmp_path.joinpath('trace.json')
+    profiler.enable('drone-deploy test', output=str(output))
+    try:
+        with profiler.span('outer', deployment='foo'):
+            for _ in range(3):
+                with profiler.span('inner'):
+                    pass
+        # spans in a thread with no current span go under the root
+        thread = threading.Thread(target=lambda: profiler.span('worker').__enter__())
+        thread.start()
+        thread.join()
+    finally:
+        stream = io.StringIO()
+        recorded = profiler.finish(stream)
+    assert not profiler.enabled()
+
+    assert [child.name for child in recorded.root.children] == ['outer', 'worker']
+    assert len(recorded.root.children[0].children) == 3
+    summary = stream.getvalue()
+    assert '  outer' in summary and '    inner (x3)' in summary, 'Siblings should be merged.'
+
+    events = json.loads(output.read_text())['traceEvents']
+    assert [event['name'] for event in events][:2] == ['drone-deploy test', 'outer']
+    assert events[1]['args'] == {'deployment': 'foo'} and events[1]['ph'] == 'X'
+
+
+def test_profiler_cprofile_dump(tmp_path):
+    output = tmp_path.joinpath('run.prof')
+    profiler.enable('drone-deploy test', output=str(output))
+    sorted(range(1000), key=lambda n: -n)
+    profiler.finish(io.StringIO())
+    assert pstats.Stats(str(output)).total_calls > 0
+
+
+def test_phase_sink_splits_a_process_span():
+    phases = [(re.compile(r'^Refreshing'), 'refresh'), (re.compile(r'Creating\.\.\.'), 'apply')]
+    lines = []
+    profiler.enable('drone-deploy test')
+    try:
+        run_process("echo 'Refreshing state...'; echo 'Refreshing more'; "
+                    "echo 'aws_instance.drone: Creating...'",
+                    sinks=[LineSink(lambda name, line: lines.append(line)),
+                           profiler.phase_sink(phases)])
+    finally:
+        recorded = profiler.finish(io.StringIO())
+    assert len(lines) == 3
+    process = recorded.root.children[0]
+    assert process.name == 'echo'
+    assert [phase.name for phase in process.children] == ['refresh', 'apply']
+    assert all(phase.end is not None for phase in process.children)
+
+
+def test_cli_profile(runner, new_deployment, tmp_path):
+    result = runner.invoke(cli, ['--profile', 'show', 'foo'])
+    assert result.exit_code == 0
+    assert 'profile:' in result.output and 'drone-deploy show' in result.output
+    assert 'Deployment()' in result.output
+    assert not profiler.enabled()
+
+    output = tmp_path.joinpath('show.json')
+    result = runner.invoke(cli, ['show', 'foo'], env={'DRONE_DEPLOY_PROFILE_OUTPUT': str(output)})
+    assert result.exit_code == 0
+    names = {event['name'] for event in json.loads(output.read_text())['traceEvents']}
+    assert {'drone-deploy show', 'Deployment()'} <= names
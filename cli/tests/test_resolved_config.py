@@ -0,0 +1,70 @@
+import os
+import pytest
+from pathlib import Path
+from drone_deploy.deployment import Deployment
+from drone_deploy.resolved_config import ResolvedConfig, resolve_config
+
+
+def test_resolve_config_does_not_touch_os_environ():
+    before = dict(os.environ)
+    resolve_config({'drone_aws_region': 'us-east-1'}, 'foo', environ={})
+    assert dict(os.environ) == before, 'resolve_config() should not modify os.environ.'
+
+
+def test_resolve_config_env_overrides_config():
+    config = {'drone_aws_region': 'us-east-1', 'drone_vpc_id': 'vpc-123'}
+    resolved = resolve_config(config, 'foo', environ={'DRONE_AWS_REGION': 'us-west-2'})
+    assert resolved['drone_aws_region'] == 'us-west-2', 'env vars should win over config.yaml.'
+    assert resolved['drone_vpc_id'] == 'vpc-123', 'config.yaml values should be used if env is unset.'
+    assert resolved.tfvars['drone_aws_region'] == 'us-west-2'
+    assert 'DRONE_AWS_REGION' not in resolved.exports, 'env overrides should not be re-exported.'
+    assert resolved.exports['DRONE_VPC_ID'] == 'vpc-123'
+
+
+def test_resolve_config_generated_values():
+    config = {'drone_server_machine_name': 'drone', 'drone_server_hosted_zone': 'acme.com',
+              'drone_user_filter': ['alice', 'bob'], 'drone_server_allow_ssh': ['1.2.3.4/32']}
+    resolved = resolve_config(config, 'foo', environ={}, deployment_id='abc123',
+                              server_ami='ami-123')
+    assert resolved['drone_deployment_name'] == 'drone-foo'
+    assert resolved['drone_s3_bucket'] == 'drone-data.drone.acme.com'
+    assert len(resolved['drone_rpc_secret']) == 32, 'An rpc secret should have been generated.'
+    assert resolved.generated == {'drone_rpc_secret'}
+    assert resolved['drone_deployment_id'] == 'abc123'
+    assert resolved['drone_server_ami'] == 'ami-123'
+    assert resolved['drone_server_allow_ssh'] == ('1.2.3.4/32',)
+    assert resolved.tfvars['drone_server_allow_ssh'] == ('1.2.3.4/32',)
+    assert resolved.tfvars['drone_user_filter'] == 'alice,bob'
+    assert not any(k.startswith('TF_VAR_') for k in resolved.exports), 'Use the tfvars file.'
+
+
+def test_resolved_config_is_immutable():
+    resolved = resolve_config({}, 'foo', environ={})
+    with pytest.raises(AttributeError):
+        resolved.foo = 'bar'
+    with pytest.raises(TypeError):
+        resolved['drone_aws_region'] = 'us-east-1'
+    with pytest.raises(TypeError):
+        resolved.exports['FOO'] = 'bar'
+    assert not hasattr(resolved, '__dict__'), 'ResolvedConfig should use __slots__.'
+
+
+def test_resolved_config_round_trip():
+    resolved = resolve_config({'drone_server_allow_http': ['0.0.0.0/0']}, 'foo', environ={})
+    copy = ResolvedConfig.from_dict(resolved.to_dict())
+    assert dict(copy) == dict(resolved)
+    assert dict(copy.tfvars) == dict(resolved.tfvars)
+    assert dict(copy.exports) == dict(resolved.exports)
+    assert copy.generated == resolved.generated
+
+
+def test_deployments_do_not_share_environment(new_deployment, new_deployment2):
+    foo = Deployment(Path.cwd().joinpath('deployments', 'foo', 'config.yaml').resolve())
+    bar = Deployment(Path.cwd().joinpath('deployments', 'bar', 'config.yaml').resolve())
+    assert foo.config['drone_deployment_name'] == 'drone-foo'
+    assert bar.config['drone_deployment_name'] == 'drone-bar', 'bar picked up foo\'s settings.'
+    assert foo.terraform.env['DRONE_DEPLOYMENT_NAME'] == 'drone-foo'
+    assert bar.terraform.env['DRONE_DEPLOYMENT_NAME'] == 'drone-bar'
+    assert foo.terraform.tfvars['drone_deployment_name'] == 'drone-foo'
+    assert bar.terraform.tfvars['drone_deployment_name'] == 'drone-bar'
+    assert 'DRONE_DEPLOYMENT_NAME' not in os.environ, 'Deployment exported to os.environ.'
@@ -1,6 +1,6 @@
 import os
 import json
-# import subprocess
+import subprocess
 from shutil import which
 from pathlib import Path
 from ruamel.yaml import YAML
@@ -47,7 +47,9 @@ def test_new_deployment_packer_templates_present(new_deployment):
     assert aws_cli_path.exists(), 'aws-cli templates not present in new deployment'
     assert build_scripts_path.exists(), 'build-scripts templates not present in new deployment'
     assert drone_server_configs_path.exists(), 'drone-server-configs templates not present in new deployment'
-    assert count_files(build_scripts_path) >= 5, "missing some/all packer/build-scripts/*.sh files. Expecting at least 5."
+    assert count_files(build_scripts_path) >= 2, "missing some/all packer/build-scripts/*.sh files. Expecting at least 2."
+    assert count_files(foo_path.joinpath('base-scripts')) >= 3, "missing some/all packer/base-scripts/*.sh files. Expecting at least 3."
+    assert count_files(foo_path.joinpath('server-scripts')) >= 1, "missing packer/server-scripts/bootstrap_drone.sh."
 
 
 def test_new_deployment_packer_build_script(new_deployment):
@@ -84,3 +86,28 @@ def test_shellcheck_bash_scripts(new_deployment):
     else:
         print("shellcheck installed")
         pass
+
+
+def test_provision_script_runs_independent_steps_concurrently(new_deployment):
+    '''provision.sh runs steps once their dependencies succeed and skips the ones after a failure'''
+    provision_script = Path.cwd().joinpath('deployments', 'foo', 'packer', 'build-scripts', 'provision.sh')
+    script = f"""
+        source {provision_script}
+        PROVISION_POLL_INTERVAL=0.05
+        step slow "" sh -c 'sleep 1; echo pulled'
+        step fast "" sleep 0.2
+        step after_fast "fast" true
+        step broken "" false
+        step after_broken "broken" true
+        run_steps
+    """
+    result = subprocess.run(['bash', '-c', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    lines = result.stdout.split('\n')
+    assert result.returncode == 1, 'A failed step should fail the provisioning.'
+    assert '[slow] pulled' in lines, 'Step output should be prefixed with the step name.'
+    slow_done = next(i for i, line in enumerate(lines) if line.startswith('[slow] ok in'))
+    assert lines.index('[after_fast] starting') < slow_done, \
+        'Steps should start as soon as their dependencies are done.'
+    assert '[after_broken] skipped, broken did not succeed' in lines
+    assert 'critical path: slow' in result.stdout
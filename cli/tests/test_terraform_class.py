@@ -1,8 +1,11 @@
 import os
+import json
+import asyncio
 import pytest
 from pathlib import Path, PosixPath, WindowsPath
 from drone_deploy.deployment import Deployment
 from drone_deploy.terraform import Terraform
+from drone_deploy.process import ProcessResult
 
 
 @pytest.fixture()
@@ -56,10 +59,10 @@ def invalid_tf_state_file():
     os.remove(state_file)
 
 
-def test_tf_vars(deployment, new_deployment):
+def test_tfvars(deployment, new_deployment):
     tf = deployment.terraform
-    assert len(tf.tf_vars) > 0, "tf_vars failed to populate as expected."
-    assert 'drone_server_instance_type' in tf.tf_vars, 'tf_vars failed to populate as expected.'
+    assert len(tf.tfvars) > 0, "tfvars failed to populate as expected."
+    assert 'drone_server_instance_type' in tf.tfvars, 'tfvars failed to populate as expected.'
 
 
 def test_working_dir(deployment, new_deployment):
@@ -108,3 +111,34 @@ def test_terraform_wrapper_commands_present(mocker):
     terraform.plan.assert_called_once_with(tf_targets=['-target=aws_iam_policy.drone-builder-ec1'])
     terraform.apply.assert_called_once_with(tf_targets=['-target=aws_iam_policy.drone-builder-ec2'])
     terraform.destroy.assert_called_once_with(tf_targets=['-target=aws_iam_policy.drone-builder-ec3'])
+
+
+def test_terraform_aplan(new_deployment, deployment, mocker):
+    '''await deployment.terraform.aplan() runs terraform without a shell'''
+    runner = mocker.patch('drone_deploy.terraform.arun_process', new_callable=mocker.AsyncMock)
+    runner.return_value = ProcessResult(['terraform', 'plan'], 0, 0.1)
+    assert asyncio.run(deployment.terraform.aplan(['-target=aws_instance.foo', '-var=name=a b'])) == 0
+    argv = runner.call_args[0][0]
+    assert argv[:2] == ['terraform', 'plan'] and '-target=aws_instance.foo' in argv
+    assert '-var=name=a b' in argv, 'Args should be passed as is, not split on spaces.'
+    assert runner.call_args[1]['env']['DRONE_DEPLOYMENT_NAME'] == 'drone-foo'
+
+
+def test_write_var_file(deployment, new_deployment):
+    '''resolved variables are written to a tfvars file, only when they change'''
+    tf = deployment.terraform
+    var_file = tf.working_dir.joinpath(tf.VAR_FILE)
+    tf.write_var_file()
+    variables = json.loads(var_file.read_text())
+    assert variables['drone_deployment_name'] == 'drone-foo'
+    assert isinstance(variables['drone_server_allow_http'], list), 'Lists should be json lists.'
+    assert 'drone_server_base_ami' not in variables, 'Only declared variables should be written.'
+    assert oct(var_file.stat().st_mode & 0o777) == '0o600'
+
+    assert tf.write_var_file() is False, 'An unchanged var file should not be rewritten.'
+    reloaded = Deployment(deployment.config_file).terraform
+    assert reloaded.write_var_file() is False, \
+        'Reloading the deployment should render the same var file (e.g. the same rpc secret).'
+    tf.tfvars = dict(tf.tfvars, drone_vpc_id='vpc-changed')
+    assert tf.write_var_file() is True
+    assert json.loads(var_file.read_text())['drone_vpc_id'] == 'vpc-changed'
@@ -0,0 +1,122 @@
+import os
+import json
+import pytest
+from drone_deploy import tfstate
+from drone_deploy.tfstate import TfState, scan_outputs
+
+STATE_V3 = {
+    "version": 3,
+    "terraform_version": "0.11.14",
+    "serial": 7,
+    "lineage": "68212074-5905-8b20-e769-6cc400e53eb1",
+    "modules": [
+        {
+            "path": ["root"],
+            "outputs": {
+                "DRONE_BUILDER_ROLE_ARN": {"sensitive": False, "type": "string",
+                                           "value": "arn:aws:iam::1234567890:role/builder"}
+            },
+            "resources": {
+                f"aws_ssm_parameter.p{i}": {"type": "aws_ssm_parameter",
+                                            "primary": {"attributes": {"value": "x" * 100,
+                                                                       "note": "a \"}]\" b"}}}
+                for i in range(2000)
+            },
+            "depends_on": []
+        }
+    ]
+}
+
+STATE_V4 = {
+    "version": 4,
+    "serial": 3,
+    "outputs": {"DRONE_BUILDER_ROLE_ARN": {"value": "arn:v4", "type": "string"}},
+    "resources": [{"type": "aws_iam_role", "instances": [{"attributes": {"arn": "arn:v4"}}]}],
+}
+
+
+@pytest.fixture()
+def state_file(tmp_path):
+    terraform_dir = tmp_path.joinpath('terraform')
+    terraform_dir.mkdir()
+    return terraform_dir.joinpath('terraform.tfstate')
+
+
+def test_scan_outputs_v3_and_v4():
+    v3 = scan_outputs(json.dumps(STATE_V3, indent=4))
+    assert v3['outputs'] == {'DRONE_BUILDER_ROLE_ARN': 'arn:aws:iam::1234567890:role/builder'}
+    assert v3['serial'] == 7 and v3['lineage'] == STATE_V3['lineage']
+    v4 = scan_outputs(json.dumps(STATE_V4))
+    assert v4['outputs'] == {'DRONE_BUILDER_ROLE_ARN': 'arn:v4'}
+
+
+def test_scan_outputs_stops_at_the_outputs():
+    text = json.dumps(STATE_V3, indent=4)
+    prefix = text[:text.index('"resources"') + 20]
+    assert scan_outputs(prefix)['outputs'], 'Only the beginning of the state should be needed.'
+
+
+def test_scan_outputs_skips_values():
+    text = json.dumps({"other": {"a": ["}", "\"[", {"b": None}]}, "n": 1.5e3, "s": "x",
+                       "outputs": {"foo": {"value": [1, 2]}}})
+    assert scan_outputs(text)['outputs'] == {'foo': [1, 2]}
+
+
+def test_tfstate_reads_only_a_prefix(state_file, monkeypatch):
+    state_file.write_text(json.dumps(STATE_V3, indent=4))
+    monkeypatch.setattr(tfstate, 'READ_SIZE', 1024)
+    reads = []
+    real_open = open
+
+    def tracking_open(*args, **kwargs):
+        file = real_open(*args, **kwargs)
+        real_read = file.read
+        file.read = lambda size=-1: reads.append(size) or real_read(size)
+        return file
+    monkeypatch.setattr('builtins.open', tracking_open)
+    state = TfState(state_file)
+    assert state.outputs['DRONE_BUILDER_ROLE_ARN'] == 'arn:aws:iam::1234567890:role/builder'
+    assert -1 not in reads and sum(reads) < state_file.stat().st_size / 10
+
+
+def test_tfstate_memoizes_outputs(state_file):
+    state_file.write_text(json.dumps(STATE_V4))
+    cache_file = state_file.parent.parent.joinpath('.cache', 'tfstate-outputs.json')
+    assert TfState(state_file).outputs['DRONE_BUILDER_ROLE_ARN'] == 'arn:v4'
+    assert cache_file.exists(), 'The outputs should have been cached.'
+    assert oct(cache_file.stat().st_mode & 0o777) == '0o600'
+
+    # a cache hit doesn't need the state, a changed state invalidates the cache
+    cache = json.loads(cache_file.read_text())
+    cache['info']['outputs']['DRONE_BUILDER_ROLE_ARN'] = 'arn:cached'
+    cache_file.write_text(json.dumps(cache))
+    assert TfState(state_file).outputs['DRONE_BUILDER_ROLE_ARN'] == 'arn:cached'
+    state_file.write_text(json.dumps(dict(STATE_V4, serial=4)))
+    os.utime(state_file, ns=(0, 0))
+    assert TfState(state_file).outputs['DRONE_BUILDER_ROLE_ARN'] == 'arn:v4'
+
+
+def test_tfstate_memoizes_amis(state_file):
+    resources = [{"type": "aws_instance", "instances": [{"attributes": {"ami": "ami-0abc"}}]}]
+    state_file.write_text(json.dumps(dict(STATE_V4, resources=resources)))
+    assert TfState(state_file).amis() == {'ami-0abc'}
+    assert TfState(state_file).outputs['DRONE_BUILDER_ROLE_ARN'] == 'arn:v4'
+
+    cache_file = state_file.parent.parent.joinpath('.cache', 'tfstate-outputs.json')
+    cache = json.loads(cache_file.read_text())
+    assert cache['amis'] == ['ami-0abc'] and 'info' in cache, 'Both should be cached.'
+    cache['amis'] = ['ami-cached']
+    cache_file.write_text(json.dumps(cache))
+    assert TfState(state_file).amis() == {'ami-cached'}
+
+
+def test_tfstate_missing_and_invalid(state_file):
+    state = TfState(state_file)
+    assert not state.exists() and state.outputs == {}
+    state_file.write_text("}garbilygook}")
+    state.reset()
+    assert not state.exists() and state.outputs == {}
+    state_file.write_text('{"version": 3, "modules": [{"path": ["root"], "outp')
+    state.reset()
+    assert state.exists(), 'exists() only checks that the file looks like json.'
+    assert state.outputs == {}, 'A truncated state should have no outputs.'
@@ -1,6 +1,8 @@
 #!/usr/bin/env bash
 # Keith D. Adkins <keithdadkins@me.com> - 2019
 # Builds the drone server amazon machine image.
+# `drone-deploy build-ami` builds natively (with a local packer), this script is kept for
+# standalone builds.
 # Usage: build-drone-server-ami.sh [-h|--help] [-p|--profile] [--no-cache] [--rm]
 set -euo pipefail
 
@@ -213,19 +215,43 @@ build_drone_server_ami(){
     packer_build_cmd="$docker run --rm -v $(PWD)/packer:/tmp/packer --workdir=/tmp/packer hashicorp/packer:light build"
     # note: ${VARNAME%%[[:cntrl:]]} removes trailing /r's from strings. dang tty's.
 
+    # drone-deploy writes the deployment's settings to packer/drone-deploy.vars.json,
+    # otherwise pass them from the env
+    local packer_vars=()
+    if [ -f packer/drone-deploy.vars.json ]; then
+        packer_vars=(-var-file=drone-deploy.vars.json)
+    else
+        packer_vars=(
+            -var drone_aws_region="$DRONE_AWS_REGION"
+            -var aws_region="$DRONE_AWS_REGION"
+            -var drone_cli_version="$DRONE_CLI_VERSION"
+            -var drone_server_docker_image="$DRONE_SERVER_DOCKER_IMAGE"
+            -var drone_agent_docker_image="$DRONE_AGENT_DOCKER_IMAGE"
+            -var drone_docker_compose_version="$DRONE_DOCKER_COMPOSE_VERSION"
+            -var iam_instance_profile="$DRONE_DEPLOYMENT_NAME-builder"
+        )
+    fi
+
+    # the server AMI is built on a base AMI (OS updates, docker, compose, aws-cli image),
+    # which 'drone-deploy build-ami' builds and keeps up to date
+    if [ -z "${DRONE_SERVER_BASE_AMI:-}" ]; then
+        echo "Set DRONE_SERVER_BASE_AMI to the base AMI to build on (see packer/base-manifest.json)."
+        return 1
+    fi
+
+    # the provisioning files are uploaded as one archive (flattened into the builder's /tmp)
+    tar -czf packer/.payload.tar.gz -C packer/build-scripts . -C ../server-scripts . \
+        -C ../drone-server-configs .
+
     # note: ${VARNAME%%[[:cntrl:]]} removes trailing /r's from strings. dang tty's.
     $packer_build_cmd \
         -var aws_access_key="${DRONE_BUILDER_AWS_ACCESS_KEY_ID%%[[:cntrl:]]}" \
         -var aws_secret_key="${DRONE_BUILDER_AWS_SECRET_ACCESS_KEY%%[[:cntrl:]]}" \
         -var aws_session_token="${DRONE_BUILDER_AWS_SESSION_TOKEN%%[[:cntrl:]]}" \
         -var drone_deployment_uuid="${DRONE_DEPLOYMENT_ID%%[[:cntrl:]]}" \
-        -var drone_aws_region="$DRONE_AWS_REGION" \
-        -var aws_region="$DRONE_AWS_REGION" \
-        -var drone_cli_version="$DRONE_CLI_VERSION" \
-        -var drone_server_docker_image="$DRONE_SERVER_DOCKER_IMAGE" \
-        -var drone_agent_docker_image="$DRONE_AGENT_DOCKER_IMAGE" \
-        -var drone_docker_compose_version="$DRONE_DOCKER_COMPOSE_VERSION" \
-        -var iam_instance_profile="$DRONE_DEPLOYMENT_NAME-builder" \
+        -var payload_archive=.payload.tar.gz \
+        -var base_ami="${DRONE_SERVER_BASE_AMI%%[[:cntrl:]]}" \
+        "${packer_vars[@]}" \
         packer_build_drone_server_ami.json
 }
 
@@ -0,0 +1,196 @@
+#!/usr/bin/env bash
+# runs the provisioning steps for an AMI, each one as soon as the steps it depends on are done
+# Usage: provision.sh base|server
+#
+# Steps without dependencies between them (e.g. pulling the drone server and agent images)
+# run concurrently, their output prefixed with the step name. A summary of how long each
+# step took, and the critical path (the chain of steps that decided the total time), is
+# printed at the end. If a step fails, the steps that depend on it are skipped and
+# provision.sh exits 1 once the running steps finish.
+set -euo pipefail
+
+PROVISION_LOG_DIR=${PROVISION_LOG_DIR:-}
+PROVISION_POLL_INTERVAL=${PROVISION_POLL_INTERVAL:-0.2}
+
+declare -a step_names=()
+declare -A step_deps=() step_cmd=() step_status=() step_start=() step_end=()
+
+
+# step NAME "DEPENDENCY ..." COMMAND [ARG ...]
+step(){
+    local name=$1 deps=$2
+    shift 2
+    step_names+=("$name")
+    step_deps[$name]=$deps
+    step_cmd[$name]="$(printf '%q ' "$@")"
+}
+
+
+# the steps for packer_build_drone_base_ami.json (apt is only used by bootstrap_docker.sh)
+base_steps(){
+    step docker "" ./bootstrap_docker.sh
+    step compose "" ./bootstrap_docker_compose.sh
+    step aws_cli_image "docker" ./build_aws_cli_image.sh
+}
+
+
+# the steps for packer_build_drone_server_ami.json (docker is already on the base AMI)
+server_steps(){
+    step server_image "" ./bootstrap_drone.sh server-image
+    step agent_image "" ./bootstrap_drone.sh agent-image
+    step drone_cli "" ./bootstrap_drone.sh cli
+}
+
+
+now_ms(){
+    date +%s%3N
+}
+
+
+seconds(){
+    printf "%d.%01ds" $(( $1 / 1000 )) $(( $1 % 1000 / 100 ))
+}
+
+
+start_step(){
+    local name=$1
+    step_status[$name]=running
+    step_start[$name]=$(now_ms)
+    echo "[$name] starting"
+    (
+        set +e
+        eval "${step_cmd[$name]}" 2>&1 | sed -u "s/^/[$name] /"
+        echo "${PIPESTATUS[0]} $(now_ms)" > "$PROVISION_LOG_DIR/$name.done"
+    ) &
+}
+
+
+# starts every pending step whose dependencies have succeeded, and skips the ones with a
+# dependency that failed. Repeats until nothing changes, so skips propagate down the graph.
+schedule(){
+    local name dep ready changed=1
+    while [ "$changed" -eq 1 ]; do
+        changed=0
+        for name in "${step_names[@]}"; do
+            [ -n "${step_status[$name]:-}" ] && continue
+            ready=1
+            for dep in ${step_deps[$name]}; do
+                case "${step_status[$dep]:-}" in
+                    ok) ;;
+                    failed|skipped) ready=skipped; break ;;
+                    *) ready=0 ;;
+                esac
+            done
+            if [ "$ready" = skipped ]; then
+                step_status[$name]=skipped
+                echo "[$name] skipped, $dep did not succeed"
+                changed=1
+            elif [ "$ready" -eq 1 ]; then
+                start_step "$name"
+                changed=1
+            fi
+        done
+    done
+}
+
+
+# marks the running steps that have finished, returns 1 if none have
+collect(){
+    local name code end finished=1
+    for name in "${step_names[@]}"; do
+        [ "${step_status[$name]:-}" = running ] || continue
+        [ -f "$PROVISION_LOG_DIR/$name.done" ] || continue
+        read -r code end < "$PROVISION_LOG_DIR/$name.done"
+        step_end[$name]=$end
+        if [ "$code" -eq 0 ]; then
+            step_status[$name]=ok
+        else
+            step_status[$name]=failed
+        fi
+        echo "[$name] ${step_status[$name]} in $(seconds $(( end - ${step_start[$name]} )))"
+        finished=0
+    done
+    return $finished
+}
+
+
+running(){
+    local name
+    for name in "${step_names[@]}"; do
+        [ "${step_status[$name]:-}" = running ] && return 0
+    done
+    return 1
+}
+
+
+# follows the dependency that finished last, back from the step that finished last
+critical_path(){
+    local name dep last='' path=''
+    for name in "${step_names[@]}"; do
+        [ -n "${step_end[$name]:-}" ] || continue
+        if [ -z "$last" ] || [ "${step_end[$name]}" -gt "${step_end[$last]}" ]; then
+            last=$name
+        fi
+    done
+    while [ -n "$last" ]; do
+        path="$last${path:+ -> }$path"
+        name=$last
+        last=''
+        for dep in ${step_deps[$name]}; do
+            if [ -z "$last" ] || [ "${step_end[$dep]}" -gt "${step_end[$last]}" ]; then
+                last=$dep
+            fi
+        done
+    done
+    echo "$path"
+}
+
+
+summary(){
+    local name started=$1 time
+    printf "\n%-16s %-8s %8s %8s\n" STEP STATUS START TIME
+    for name in "${step_names[@]}"; do
+        if [ -n "${step_end[$name]:-}" ]; then
+            time=$(seconds $(( step_end[$name] - step_start[$name] )))
+            printf "%-16s %-8s %8s %8s\n" "$name" "${step_status[$name]}" \
+                "$(seconds $(( step_start[$name] - started )))" "$time"
+        else
+            printf "%-16s %-8s %8s %8s\n" "$name" "${step_status[$name]}" - -
+        fi
+    done
+    echo "critical path: $(critical_path) (total $(seconds $(( $(now_ms) - started ))))"
+}
+
+
+run_steps(){
+    local name started
+    started=$(now_ms)
+    if [ -z "$PROVISION_LOG_DIR" ]; then
+        PROVISION_LOG_DIR="$(mktemp -d)"
+        trap 'rm -rf "$PROVISION_LOG_DIR"' EXIT
+    fi
+
+    schedule
+    while running; do
+        collect || sleep "$PROVISION_POLL_INTERVAL"
+        schedule
+    done
+    wait
+    summary "$started"
+
+    for name in "${step_names[@]}"; do
+        [ "${step_status[$name]:-}" = ok ] || return 1
+    done
+}
+
+
+# run the steps when executed, only define them when sourced
+if [ "${BASH_SOURCE[0]}" = "$0" ]; then
+    case "${1:-}" in
+        base) base_steps ;;
+        server) server_steps ;;
+        *) echo "Usage: provision.sh base|server" && exit 1 ;;
+    esac
+    printf "\n\n\n\n***** PROVISIONING %s *****\n\n\n\n" "${1^^}"
+    run_steps
+fi
@@ -0,0 +1,60 @@
+#!/usr/bin/env bash
+# pulls the drone images and installs the drone cli
+# Usage: bootstrap_drone.sh [server-image|agent-image|cli]
+DRONE_CLI_VERSION=${DRONE_CLI_VERSION:-}
+DRONE_SERVER_DOCKER_IMAGE=${DRONE_SERVER_DOCKER_IMAGE:-}
+DRONE_AGENT_DOCKER_IMAGE=${DRONE_AGENT_DOCKER_IMAGE:-}
+set -euo pipefail
+
+printf "\n\n\n\n***** INSTALLING DRONE *****\n\n\n\n"
+
+# fail if env vars are not set
+var_fail_message="must be set in order to continue... exiting."
+[ -z "$DRONE_CLI_VERSION" ] && echo "DRONE_AWS_VERSION $var_fail_message" && exit 1
+[ -z "$DRONE_SERVER_DOCKER_IMAGE" ] && echo "DRONE_SERVER_DOCKER_IMAGE $var_fail_message" && exit 1
+[ -z "$DRONE_AGENT_DOCKER_IMAGE" ] && echo "DRONE_AGENT_DOCKER_IMAGE $var_fail_message" && exit 1
+
+
+# set our $aws command (just a shortcut instead of writing out a long docker run command everytime)
+get_docker_cmd(){
+    local docker_cmd='docker'
+    [ "$EUID" -eq 0 ] && docker_cmd="sudo docker"
+    echo "$docker_cmd"
+}
+docker="$(get_docker_cmd)"
+aws="$docker run --rm aws-cli -- aws"
+
+
+pull_server_image(){
+    $docker pull "$DRONE_SERVER_DOCKER_IMAGE"
+}
+
+pull_agent_image(){
+    $docker pull "$DRONE_AGENT_DOCKER_IMAGE"
+}
+
+install_drone_cli(){
+    # download to a private dir, so this can run alongside the other steps
+    local tmp_dir=
+    tmp_dir="$(mktemp -d)"
+    curl -fsSL "https://github.com/drone/drone-cli/releases/download/v$DRONE_CLI_VERSION/drone_linux_amd64.tar.gz" | tar zx -C "$tmp_dir"
+    sudo install -t /usr/local/bin "$tmp_dir/drone"
+    sudo chmod +x /usr/local/bin/drone
+    rm -rf "$tmp_dir"
+
+    # test drone cli install
+    if drone -v > /dev/null 2>&1; then
+        echo "installed drone cli"
+    else
+        echo "Error installing drone cli... exiting." && exit 1
+    fi
+}
+
+# run one step (see provision.sh, which runs them concurrently), or all of them in order
+case "${1:-all}" in
+    server-image) pull_server_image ;;
+    agent-image) pull_agent_image ;;
+    cli) install_drone_cli ;;
+    all) pull_server_image; pull_agent_image; install_drone_cli ;;
+    *) echo "Unknown step $1... exiting." && exit 1 ;;
+esac